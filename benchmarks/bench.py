@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Time notefile operations on synthesized trees of notes.
+
+Builds a tree of targets and notes (mixed YAML/JSON, visible/hidden/subdir
+notes, symlinked notes, and directory notes), times each benchmark, and writes
+the results as JSON so runs can be compared between versions:
+
+    $ python benchmarks/bench.py --notes 10000 --output before.json
+    $ python benchmarks/bench.py --notes 10000 --output after.json --compare before.json
+
+Everything runs in-process against the `notefile` that is imported (run from
+the repo root for the local copy). `$NOTEFILE_*` settings apply as usual and
+`--cli-args` adds flags (e.g. "--jobs 4") to every CLI call.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import notefile  # noqa: E402
+import notefile.cli  # noqa: E402
+
+FILES_PER_DIR = 200
+DIRS_PER_GROUP = 100
+
+MTIME = 1_600_000_000  # Targets' mtime is set so the notes can be written without a stat
+
+TAGS = [f"t{i:02d}" for i in range(50)]
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliett kilo lima mike "
+    "november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu"
+).split()
+
+# Every `LINK_EVERY`th note is also linked and every `MOVE_EVERY`th/`TOUCH_EVERY`th
+# target is moved/touched before the repair benchmarks
+LINK_EVERY = 97
+MOVE_EVERY = 211
+TOUCH_EVERY = 101
+
+MANIFEST = "notefile-benchmark.json"
+
+
+def make_tree(root, notes, seed=0):
+    """Create `notes` targets with notes under `root` (plus directory and link notes).
+
+    Notes are written directly rather than with `Notefile` so large trees build
+    quickly. Layouts cycle visible, hidden, subdir. Every fourth note is JSON
+    (with the same extension). Tags are skewed so a few are common, and some
+    notes are multi-line.
+
+    Returns
+    -------
+    dict
+        Counts of what was made.
+    """
+    from notefile.notefile import Notefile
+
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(TAGS))]
+    counts = dict(notes=0, dirs=0, links=0)
+    os.makedirs(root, exist_ok=True)
+
+    for i in range(notes):
+        dirpath = os.path.join(
+            root,
+            f"g{i // (FILES_PER_DIR * DIRS_PER_GROUP):03d}",
+            f"d{i // FILES_PER_DIR:05d}",
+        )
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(os.path.join(dirpath, "_notefiles"), exist_ok=True)
+            counts["dirs"] += 1
+
+        name = f"f{i:07d}.txt"
+        target = os.path.join(dirpath, name)
+        content = f"{i} {rng.random()}\n".encode()  # Unique for repair-orphaned
+        with open(target, "wb") as fobj:
+            fobj.write(content)
+        os.utime(target, (MTIME + i, MTIME + i))
+
+        data = {
+            "filesize": len(content),
+            "mtime": float(MTIME + i),
+            "target-type": "file",
+            "sha256": _sha256(content),
+            "tags": sorted(set(rng.choices(TAGS, weights, k=rng.randint(0, 4)))),
+            "notes": _text(rng),
+        }
+        fmt = "json" if i % 4 == 0 else "yaml"
+        layout = i % 3
+        notename = name + notefile.NOTESEXT
+        if layout == 1:
+            notename = "." + notename
+        elif layout == 2:
+            notename = os.path.join("_notefiles", notename)
+        with open(os.path.join(dirpath, notename), "wt") as fobj:
+            fobj.write(_json(data) if fmt == "json" else _yaml(data))
+        counts["notes"] += 1
+
+        if i % LINK_EVERY == 0 and layout == 0:
+            linkname = f"l{i:07d}.txt"
+            os.symlink(name, os.path.join(dirpath, linkname))
+            os.symlink(notename, os.path.join(dirpath, linkname + notefile.NOTESEXT))
+            counts["links"] += 1
+
+        if i % FILES_PER_DIR == FILES_PER_DIR - 1 or i == notes - 1:
+            sub = os.path.join(dirpath, "sub")
+            os.mkdir(sub)
+            note = Notefile(sub)
+            note.modify_tags(add=rng.choice(TAGS))
+            note.write()
+
+    with open(os.path.join(root, MANIFEST), "wt") as fobj:
+        json.dump(dict(notes=notes, seed=seed, **{"made": counts}), fobj)
+    return counts
+
+
+def _sha256(content):
+    import hashlib
+
+    return hashlib.sha256(content).hexdigest()
+
+
+def _text(rng):
+    lines = []
+    for _ in range(rng.choice([0, 1, 1, 1, 3, 10])):
+        lines.append(" ".join(rng.choices(WORDS, k=rng.randint(3, 15))))
+    return "\n".join(lines)
+
+
+def _json(data):
+    comment = f"JSON Formatted notes created with notefile version {notefile.__version__}"
+    res = {"__comment": comment}
+    res.update(data)
+    return json.dumps(res, indent=1, ensure_ascii=False)
+
+
+def _yaml(data):
+    lines = [f"# YAML Formatted notes created with notefile version {notefile.__version__}"]
+    for key, val in data.items():
+        if key == "tags":
+            lines.append("tags:" if val else "tags: []")
+            lines.extend(f"- {tag}" for tag in val)
+        elif key == "notes" and "\n" in val:
+            lines.append("notes: |-")
+            lines.extend(f"  {line}" for line in val.split("\n"))
+        elif key == "notes":
+            lines.append(f"notes: {val!r}" if not val else f"notes: {val}")
+        else:
+            lines.append(f"{key}: {val}")
+    return "\n".join(lines) + "\n"
+
+
+def cli(argv, extra=()):
+    """Run the CLI with the output discarded."""
+    with open(os.devnull, "wt") as null, contextlib.redirect_stdout(null):
+        notefile.cli.cli(list(argv) + list(extra))
+
+
+class Benchmarks:
+    """The benchmarks. Each is a method returning a function to time.
+
+    Setup (untimed) happens in the method. The returned function may return
+    the number of items it handled.
+    """
+
+    NAMES = [
+        "find",
+        "read",
+        "grep",
+        "query",
+        "tags",
+        "export",
+        "repair-metadata",
+        "repair-orphaned",
+    ]
+
+    def __init__(self, root, extra=()):
+        self.root = root
+        self.extra = list(extra)
+        self.moved = []
+
+    def find(self):
+        return lambda: sum(1 for _ in notefile.find(path=self.root, targetmode="both"))
+
+    def read(self):
+        from notefile.notefile import Notefile
+
+        paths = [note.destnote for note in notefile.find(path=self.root, targetmode="both")]
+
+        def run():
+            for path in paths:
+                Notefile(path).read()
+            return len(paths)
+
+        return run
+
+    def grep(self):
+        return lambda: cli(["grep", "-p", self.root, "kilo", "zulu"], self.extra)
+
+    def query(self):
+        query = "t('t01') and not t('t02') and g('alpha')"
+        return lambda: cli(["query", "-p", self.root, query], self.extra)
+
+    def tags(self):
+        return lambda: cli(["tags", "--tag-counts", "-p", self.root], self.extra)
+
+    def export(self):
+        return lambda: cli(["export", "-p", self.root], self.extra)
+
+    def repair_metadata(self):
+        # Touch some targets so there is something to repair
+        now = time.time()
+        for i, target in enumerate(self._targets(TOUCH_EVERY)):
+            os.utime(target, (now + i, now + i))
+        return lambda: cli(["repair-metadata", "-p", self.root], self.extra)
+
+    def repair_orphaned(self):
+        # Rename some targets (back and forth between runs) to orphan their notes.
+        # Not linked ones since the link would be a second candidate
+        if not self.moved:
+            self.moved = [t for t in self._targets(MOVE_EVERY) if _index(t) % LINK_EVERY]
+        moved = []
+        for target in self.moved:
+            base, ext = os.path.splitext(target)
+            dest = base[: -len(".mv")] + ext if base.endswith(".mv") else base + ".mv" + ext
+            os.rename(target, dest)
+            moved.append(dest)
+        self.moved = moved
+        return lambda: cli(["repair-orphaned", "-p", self.root], self.extra)
+
+    def _targets(self, every):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.startswith("f") and not name.endswith(notefile.NOTESEXT):
+                    if _index(name) % every == 0:
+                        yield os.path.join(dirpath, name)
+
+
+def _index(target):
+    return int(os.path.basename(target)[1:8])
+
+
+def run(root, names=None, repeat=3, extra=()):
+    """Run the benchmarks on the tree at `root` and return the results by name."""
+    bench = Benchmarks(root, extra=extra)
+    results = {}
+    for name in names or Benchmarks.NAMES:
+        times = []
+        count = None
+        for _ in range(repeat):
+            func = getattr(bench, name.replace("-", "_"))()
+            t0 = time.perf_counter()
+            count = func()
+            times.append(time.perf_counter() - t0)
+        results[name] = dict(
+            min=min(times),
+            median=statistics.median(times),
+            times=times,
+            count=count,
+        )
+        print(f"{name:>16s}: {min(times):9.3f} s (median {statistics.median(times):.3f} s)")
+    return results
+
+
+def compare(results, baseline):
+    """Print the ratio of each result's min time to that of the baseline."""
+    print(f"{'':>16s}  {'baseline':>9s}  {'this':>9s}  ratio")
+    for name, res in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        ratio = res["min"] / base["min"] if base["min"] else float("nan")
+        print(f"{name:>16s}: {base['min']:9.3f}  {res['min']:9.3f}  {ratio:5.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--notes",
+        type=int,
+        default=10_000,
+        help="[%(default)s] Number of notes in the tree. Try up to 1000000",
+    )
+    parser.add_argument(
+        "--dir",
+        help="""Build (or reuse, if it has the same number of notes) the tree here
+                rather than in a temporary directory that is removed after""",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="[%(default)s] Random seed")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="[%(default)s] Runs of each benchmark"
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=Benchmarks.NAMES,
+        help="Only run this benchmark. Can specify multiple",
+    )
+    parser.add_argument(
+        "--cli-args", default="", help="Flags added to every CLI call. E.g. '--jobs 4'"
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare to the results in this JSON file")
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    if args.dir:
+        root = os.path.abspath(args.dir)
+    else:
+        tmpdir = root = tempfile.mkdtemp(prefix="notefile-benchmark-")
+
+    try:
+        made = None
+        try:
+            with open(os.path.join(root, MANIFEST)) as fobj:
+                manifest = json.load(fobj)
+            if manifest["notes"] == args.notes and manifest["seed"] == args.seed:
+                made = manifest["made"]
+                print(f"Reusing the tree at {root}")
+        except (OSError, ValueError, KeyError):
+            pass
+        if made is None:
+            shutil.rmtree(root, ignore_errors=True)
+            print(f"Building {args.notes} notes at {root}")
+            t0 = time.perf_counter()
+            made = make_tree(root, args.notes, seed=args.seed)
+            print(f"Built in {time.perf_counter() - t0:.1f} s: {made}")
+
+        results = run(root, args.only, args.repeat, extra=shlex.split(args.cli_args))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        "notefile version": notefile.__version__,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": dict(
+            notes=args.notes, seed=args.seed, repeat=args.repeat, cli_args=args.cli_args
+        ),
+        "made": made,
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare) as fobj:
+            compare(results, json.load(fobj))
+    if args.output:
+        with open(args.output, "wt") as fobj:
+            json.dump(report, fobj, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -26,11 +26,15 @@ repair-orphaned
 cat
 find
 export
+import
 search
 grep
 query
 tags
-note-path"""
+note-path
+cache
+watch
+serve"""
 
 commands = [l.strip() for l in commands.split("\n") if l.strip()]
 commands.insert(0, None)
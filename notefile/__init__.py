@@ -40,7 +40,18 @@ def warn(*args, **kwargs):
 
 
 from .find import find
-from .notefile import Notefile, get_filenames
+
+# `Notefile` (and the YAML, query, and search machinery it uses) is imported on
+# first access so that commands and scripts that do not need it start quickly.
+_LAZY_NOTEFILE = {"Notefile", "get_filenames"}
+
+
+def __getattr__(name):
+    if name in _LAZY_NOTEFILE:
+        from . import notefile
+
+        return getattr(notefile, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def query_help(print_help=True, safe=None):
@@ -0,0 +1,87 @@
+"""
+Aho-Corasick automaton for matching many literal strings in one pass.
+
+Used by `search.GrepMatcher` for `--fixed-strings` grep with many expressions,
+where a regex alternation (or one regex per expression with `--all`) costs time
+proportional to the number of expressions.
+"""
+
+from collections import deque
+
+
+class AhoCorasick:
+    """Find occurrences of many literal words in a single scan of the text.
+
+    Parameters
+    ----------
+    words:
+        Non-empty literal strings. Duplicates are allowed; each is reported
+        by its index.
+
+    Notes
+    -----
+    The automaton is built as a full transition table (one dict per state) so
+    each character of the text costs one lookup, independent of the number of
+    words.
+    """
+
+    def __init__(self, words):
+        self.words = list(words)
+        if not all(self.words):
+            raise ValueError("Words must not be empty")
+
+        # Trie
+        goto = [{}]
+        out = [[]]  # Indices of words ending at each state
+        for i, word in enumerate(self.words):
+            state = 0
+            for c in word:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][c] = nxt
+                    goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append(i)
+
+        # Failure links and the full transition table, breadth first so that
+        # the failure state of each state is done before it
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            for c, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]].get(c, 0)
+                out[nxt].extend(out[fail[nxt]])
+                queue.append(nxt)
+
+        self._delta = delta
+        self._out = [tuple(o) for o in out]
+
+    def finditer(self, text):
+        """Yield `(end, index)` for each occurrence of word `index` ending at `end`.
+
+        `end` is exclusive so the occurrence is `text[end - len(word):end]`.
+        Occurrences are in order of their end.
+        """
+        delta, out = self._delta, self._out
+        state = 0
+        for i, c in enumerate(text):
+            state = delta[state].get(c, 0)
+            if out[state]:
+                for index in out[state]:
+                    yield i + 1, index
+
+    def search(self, text):
+        """Return whether any word occurs in `text`"""
+        delta, out = self._delta, self._out
+        state = 0
+        for c in text:
+            state = delta[state].get(c, 0)
+            if out[state]:
+                return True
+        return False
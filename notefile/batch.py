@@ -0,0 +1,219 @@
+"""
+Apply tag and note changes to many notes in one call.
+
+`apply()` (and `iter_apply()`) take a stream of changes, each a path and the
+tags to add or remove and note text to add, and read, modify, and write each
+note on a pool of threads. This is what `notefile mod --from-file` and
+`--stdin0` use, and replaces calling `cli()` (or building a `Notefile`) once per
+file in scripts:
+
+    >>> import notefile.batch
+    >>> notefile.batch.apply(
+    ...     [{"path": "a.jpg", "add": ["trip"]}, {"path": "b.jpg", "note": "hi"}],
+    ... )
+    Bunch(**{'written': 2, 'unchanged': 0, 'failed': 0})
+
+Changes to the same note are applied in order. Results are in input order and
+memory is bounded by the number of changes in flight, not the stream.
+"""
+
+import os
+
+from . import cache, debug, warn
+
+THREADS = 4
+
+# Keys of a change. Any can also be given to `apply()` for every change
+_CHANGE_KEYS = {"path", "add", "remove", "note", "fields", "replace", "refresh"}
+
+
+def env_threads():
+    """Return the number of threads from `$NOTEFILE_BATCH_THREADS` or `THREADS`."""
+    return int(os.environ.get("NOTEFILE_BATCH_THREADS", "").strip() or THREADS)
+
+
+def apply(changes, **kwargs):
+    """Apply `changes` and return the number of notes `written`, `unchanged`, and `failed`.
+
+    Takes the same arguments as `iter_apply()`.
+    """
+    from .utils import Bunch
+
+    summary = Bunch(written=0, unchanged=0, failed=0)
+    for result in iter_apply(changes, **kwargs):
+        summary[result.status] += 1
+    return summary
+
+
+def iter_apply(
+    changes,
+    *,
+    noteopts=None,
+    threads=None,
+    dry_run=False,
+    add=(),
+    remove=(),
+    note=None,
+    fields=None,
+    replace=False,
+    refresh=False,
+):
+    """Apply changes to notes and yield a result for each.
+
+    Parameters
+    ----------
+    changes:
+        Iterable of paths or of mappings with (all but 'path' optional):
+
+        - 'path': the target (or note) path
+        - 'add', 'remove': a tag or list of tags to add or remove
+        - 'note': text to add to the note field (or replace it with 'replace')
+        - 'fields': a mapping of other fields to text to add (or replace)
+        - 'replace': replace rather than append the note text
+        - 'refresh': also refresh the target's metadata
+
+        Consumed lazily.
+    noteopts:
+        Keyword arguments for `Notefile`.
+    threads:
+        Number of threads reading and writing notes. `None` uses
+        `$NOTEFILE_BATCH_THREADS` (default `THREADS`). Serial when the note cache
+        is enabled since its connection belongs to this thread.
+    dry_run:
+        Do not write anything. Notes that would change are reported 'written'.
+    add, remove, note, fields, replace, refresh:
+        Applied to every change before its own. Tags and fields are combined
+        with those of the change and the change's 'note' comes after `note`.
+
+    Yields
+    ------
+    Bunch
+        `path`, `status` ('written', 'unchanged', or 'failed'), `note` (the
+        `Notefile` or `None`), and `error` (the exception or `None`), in the order
+        of `changes`.
+    """
+    from collections import deque
+
+    from .utils import Bunch
+
+    defaults = dict(
+        add=add, remove=remove, note=note, fields=fields, replace=replace, refresh=refresh
+    )
+    noteopts = noteopts or {}
+    if threads is None:
+        threads = env_threads()
+    if cache.writer() is not None:
+        threads = 1
+
+    def result(change, future):
+        try:
+            note, status = future() if callable(future) else future.result()
+            return Bunch(path=change["path"], status=status, note=note, error=None)
+        except Exception as E:
+            warn(f"Could not modify {change['path']!r}: {E}")
+            return Bunch(path=change["path"], status="failed", note=None, error=E)
+
+    changes = (_merge(defaults, change) for change in changes)
+    if threads <= 1:
+        for change in changes:
+            yield result(change, lambda: _apply_one(change, noteopts, dry_run))
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    window = deque()  # (change, future)
+    inflight = {}  # key: latest future for that note
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="notefile-batch") as pool:
+        for change in changes:
+            key = os.path.abspath(change["path"])
+            prior = inflight.get(key)
+            if prior is not None and not prior.done():
+                debug(f"batch: waiting on earlier change to {key!r}")
+                prior.exception()  # Wait without raising
+
+            future = pool.submit(_apply_one, change, noteopts, dry_run)
+            inflight[key] = future
+            window.append((change, future))
+            while len(window) > 4 * threads or (window and window[0][1].done()):
+                done, future = window.popleft()
+                if inflight.get(os.path.abspath(done["path"])) is future:
+                    del inflight[os.path.abspath(done["path"])]
+                yield result(done, future)
+        while window:
+            yield result(*window.popleft())
+
+
+def read_changes(lines):
+    """Yield changes from lines of paths or JSON objects (as for `iter_apply()`).
+
+    Blank lines are skipped. Lines starting with '{' are JSON and anything else
+    is a path (without the line ending).
+    """
+    import json
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        yield json.loads(line) if line.lstrip().startswith("{") else line
+
+
+def read_paths0(stream, blocksize=2**16):
+    """Yield the NUL-separated paths of a binary stream (e.g., from `find -print0`)."""
+    rest = b""
+    while True:
+        block = stream.read(blocksize)
+        if not block:
+            break
+        *paths, rest = (rest + block).split(b"\0")
+        yield from (os.fsdecode(path) for path in paths if path)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def _merge(defaults, change):
+    """Return a full change from the defaults and a path or mapping."""
+    if isinstance(change, (str, os.PathLike)):
+        change = {"path": change}
+    unknown = set(change) - _CHANGE_KEYS
+    if unknown:
+        raise ValueError(f"Unrecognized change keys {sorted(unknown)}")
+    if "path" not in change:
+        raise ValueError(f"Change {change!r} has no 'path'")
+
+    notes = [n for n in [defaults["note"], change.get("note")] if n is not None]
+    return dict(
+        path=os.fspath(change["path"]),
+        add=_tags(defaults["add"]) + _tags(change.get("add", ())),
+        remove=_tags(defaults["remove"]) + _tags(change.get("remove", ())),
+        note="\n".join(notes) if notes else None,
+        fields={**(defaults["fields"] or {}), **(change.get("fields") or {})},
+        replace=change.get("replace", defaults["replace"]),
+        refresh=change.get("refresh", defaults["refresh"]),
+    )
+
+
+def _tags(tags):
+    return [tags] if isinstance(tags, str) else list(tags)
+
+
+def _apply_one(change, noteopts, dry_run):
+    """Apply one change. Returns `(note, status)`."""
+    from .notefile import Notefile
+
+    note = Notefile(change["path"], **noteopts)
+    note.modify_tags(add=change["add"], remove=change["remove"])
+    if change["note"] is not None:
+        note.add_note(change["note"], replace=change["replace"])
+    for field, text in change["fields"].items():
+        note.add_note(text, replace=change["replace"], field=field)
+    if change["refresh"]:
+        note.repair_metadata(force=False, defer_hash=True)
+
+    if not note.ismod():
+        if not dry_run:
+            note.write()  # Not written but rebuilds links like `mod`
+        return note, "unchanged"
+    if not dry_run:
+        note.write()
+    return note, "written"
@@ -0,0 +1,492 @@
+"""
+Optional SQLite note cache.
+
+The cache is secondary storage: note files remain authoritative and are always
+written first. When enabled, `Notefile.read()` trusts cached records without
+validating against the filesystem, `Notefile.write()` refreshes the record
+after the atomic rename, and `find()` enumerates cached notes rather than
+walking directories.
+
+The cache is off by default. It is enabled with `$NOTEFILE_USE_CACHE` or the
+`--cache` CLI flag and stored at `$NOTEFILE_CACHE_DB` (default
+`~/.cache/notefile/notefile-cache.sqlite3`).
+
+The database also holds a file-hash memo keyed by (device, inode, size,
+mtime_ns). Since the key is checked against the file, the memo is used
+whenever the cache is enabled, including by repair commands.
+
+See `codex-material/design-docs/cache-design.md` for the design.
+"""
+
+import json
+import os
+import time
+
+from . import debug, fs, nfjson, profiling, warn
+
+SCHEMA_VERSION = 2
+RECORD_VERSION = 1
+
+DEFAULT_DB = os.path.join("~", ".cache", "notefile", "notefile-cache.sqlite3")
+
+# Files modified this recently are not memoized since a later write within the
+# filesystem's timestamp resolution would not change the key
+HASH_RACY_WINDOW = 2.0
+
+# Run-level state. Reset by configure() on every CLI call.
+ENABLED = False
+TRUST_READS = True
+DBPATH = None
+
+_cache = None
+
+
+def env_enabled():
+    """Return whether `$NOTEFILE_USE_CACHE` enables the cache."""
+    return os.environ.get("NOTEFILE_USE_CACHE", "false").strip().lower() == "true"
+
+
+def env_dbpath():
+    """Return the cache database path from `$NOTEFILE_CACHE_DB` or the default."""
+    path = os.environ.get("NOTEFILE_CACHE_DB", "").strip() or DEFAULT_DB
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def configure(enabled=None, trust_reads=True, dbpath=None):
+    """Set the cache behavior for this run.
+
+    Parameters
+    ----------
+    enabled:
+        `True` or `False` to override `$NOTEFILE_USE_CACHE`. `None` uses the
+        environment.
+    trust_reads:
+        When false, reads (and `find`) go to disk but successful reads and
+        writes still refresh the cache. Used by repair commands.
+    dbpath:
+        Database path. `None` uses `$NOTEFILE_CACHE_DB` or the default.
+    """
+    global ENABLED, TRUST_READS, DBPATH, _cache
+    ENABLED = env_enabled() if enabled is None else bool(enabled)
+    TRUST_READS = trust_reads
+    dbpath = env_dbpath() if dbpath is None else os.path.abspath(dbpath)
+    if _cache is not None and _cache.path != dbpath:
+        _cache.close()
+        _cache = None
+    DBPATH = dbpath
+
+
+def writer():
+    """Return the active cache for updates or `None` when disabled."""
+    if not ENABLED:
+        return None
+    global _cache
+    if DBPATH is None:
+        configure(enabled=ENABLED, trust_reads=TRUST_READS)
+    if _cache is None:
+        _cache = NoteCache(DBPATH)
+    return _cache
+
+
+def reader():
+    """Return the active cache for trusted reads or `None`."""
+    if not TRUST_READS:
+        return None
+    return writer()
+
+
+def clear(dbpath=None):
+    """Delete the cache database (and SQLite side files)."""
+    global _cache
+    dbpath = DBPATH if dbpath is None else dbpath
+    if dbpath is None:
+        dbpath = env_dbpath()
+    if _cache is not None and _cache.path == dbpath:
+        _cache.close()
+        _cache = None
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        try:
+            os.unlink(dbpath + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _jsonable(obj):
+    """Return whether `obj` round-trips through JSON without changing type."""
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return True
+    if isinstance(obj, list):
+        return all(_jsonable(i) for i in obj)
+    if isinstance(obj, dict):
+        return all(isinstance(k, str) and _jsonable(v) for k, v in obj.items())
+    return False
+
+
+def _i64(value):
+    """Map an unsigned 64-bit stat field onto SQLite's signed INTEGER."""
+    return value - 2**64 if value >= 2**63 else value
+
+
+def _hashkey(st):
+    """Return the memo key for an `os.stat_result`."""
+    return (_i64(st.st_dev), _i64(st.st_ino), st.st_size, st.st_mtime_ns)
+
+
+class CacheRecordError(ValueError):
+    pass
+
+
+class NoteCache:
+    """Thin adapter around the SQLite database. Not a second copy of `Notefile`."""
+
+    def __init__(self, path):
+        """Open (lazily) the cache database at `path`."""
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._batch = 0
+
+    @property
+    def conn(self):
+        """Return a connection for this process, creating the schema as needed."""
+        if self._conn is None or self._pid != os.getpid():
+            import sqlite3  # Lazy
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._init_schema()
+        return self._conn
+
+    def _init_schema(self):
+        """Create tables, resetting the database on a schema-version mismatch."""
+        conn = self._conn
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row and row[0] != str(SCHEMA_VERSION):
+            debug(f"cache schema {row[0]} != {SCHEMA_VERSION}. Resetting")
+            for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'meta'"
+            ).fetchall():
+                conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                canonical_note_path TEXT PRIMARY KEY,
+                primary_target_path TEXT NOT NULL,
+                record_version INTEGER NOT NULL,
+                state_json TEXT NOT NULL,
+                data_json TEXT NOT NULL,
+                text TEXT,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS aliases (
+                alias_path TEXT PRIMARY KEY,
+                canonical_note_path TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS aliases_canonical ON aliases (canonical_note_path);
+            CREATE TABLE IF NOT EXISTS tags (
+                tag TEXT NOT NULL,
+                canonical_note_path TEXT NOT NULL,
+                PRIMARY KEY (tag, canonical_note_path)
+            );
+            CREATE INDEX IF NOT EXISTS tags_canonical ON tags (canonical_note_path);
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (dev, ino)
+            );
+            """)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",
+            (str(SCHEMA_VERSION),),
+        )
+        conn.commit()
+
+    def close(self):
+        """Close the connection if it is open in this process."""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.commit()
+            self._conn.close()
+        self._conn = None
+
+    def _commit(self):
+        if not self._batch:
+            self.conn.commit()
+
+    def batch(self):
+        """Context manager that defers commits until the block exits."""
+        import contextlib
+
+        @contextlib.contextmanager
+        def _batch():
+            self._batch += 1
+            try:
+                yield self
+            finally:
+                self._batch -= 1
+                self._commit()
+
+        return _batch()
+
+    def get(self, path):
+        """Return the record for a note or target path, or `None`.
+
+        Records with an incompatible `record_version` are treated as misses.
+        """
+        path = os.path.abspath(path)
+        row = self.conn.execute(
+            """
+            SELECT n.canonical_note_path, n.record_version, n.state_json, n.data_json, n.text
+            FROM aliases a JOIN notes n ON a.canonical_note_path = n.canonical_note_path
+            WHERE a.alias_path = ?
+            """,
+            (path,),
+        ).fetchone()
+        return self._row_to_record(row)
+
+    def _row_to_record(self, row):
+        if row is None:
+            return None
+        if len(row) == 3:  # Without data
+            canonical, version, state = row
+            record = dict(canonical_note_path=canonical)
+        else:
+            canonical, version, state, data, text = row
+            record = dict(canonical_note_path=canonical, data=nfjson.loads(data), text=text)
+        if version != RECORD_VERSION:
+            debug(f"cache record version mismatch for {canonical!r}")
+            return None
+        record["state"] = nfjson.loads(state)
+        return record
+
+    def put(self, record):
+        """Insert or replace a record and its aliases."""
+        canonical = record["canonical_note_path"]
+        conn = self.conn
+        conn.execute("DELETE FROM aliases WHERE canonical_note_path = ?", (canonical,))
+        conn.execute("DELETE FROM tags WHERE canonical_note_path = ?", (canonical,))
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO notes
+                (canonical_note_path, primary_target_path, record_version,
+                 state_json, data_json, text, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                canonical,
+                record["primary_target_path"],
+                RECORD_VERSION,
+                json.dumps(record["state"], ensure_ascii=False),
+                json.dumps(record["data"], ensure_ascii=False),
+                record.get("text"),
+                time.time(),
+            ),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO aliases (alias_path, canonical_note_path) VALUES (?, ?)",
+            [(alias, canonical) for alias in record["aliases"]],
+        )
+        tags = record["data"].get("tags") or []
+        conn.executemany(
+            "INSERT OR IGNORE INTO tags (tag, canonical_note_path) VALUES (?, ?)",
+            [(tag, canonical) for tag in set(tags) if isinstance(tag, str)],
+        )
+        self._commit()
+
+    def discard(self, path):
+        """Remove the record owning `path` (a note or target path), if any."""
+        path = os.path.abspath(path)
+        conn = self.conn
+        row = conn.execute(
+            "SELECT canonical_note_path FROM aliases WHERE alias_path = ?", (path,)
+        ).fetchone()
+        canonical = row[0] if row else path
+        conn.execute("DELETE FROM aliases WHERE canonical_note_path = ?", (canonical,))
+        conn.execute("DELETE FROM tags WHERE canonical_note_path = ?", (canonical,))
+        conn.execute("DELETE FROM notes WHERE canonical_note_path = ?", (canonical,))
+        self._commit()
+
+    @staticmethod
+    def _range(root):
+        """Return `(lo, hi)` bounds for paths below `root`.
+
+        Range scans on the primary key are used rather than LIKE so the index is used.
+        """
+        root = os.path.abspath(root).rstrip(os.sep)
+        return root + os.sep, root + chr(ord(os.sep) + 1)
+
+    def iter_records(self, root, with_data=True):
+        """Yield records whose note path is at or below the directory `root`.
+
+        With `with_data=False`, records carry only the reconstruction state.
+        """
+        columns = "canonical_note_path, record_version, state_json"
+        if with_data:
+            columns += ", data_json, text"
+        cursor = self.conn.execute(
+            f"""
+            SELECT {columns}
+            FROM notes WHERE canonical_note_path >= ? AND canonical_note_path < ?
+            """,
+            self._range(root),
+        )
+        for row in cursor:
+            record = self._row_to_record(row)
+            if record is not None:
+                yield record
+
+    def note_tags(self, roots):
+        """Return `{canonical_note_path: set(tags)}` for every cached note below `roots`.
+
+        Notes without tags map to an empty set so that membership also answers
+        whether a note is cached at all.
+        """
+        res = {}
+        for root in roots:
+            for path, tag in self.conn.execute(
+                """
+                SELECT n.canonical_note_path, t.tag FROM notes n
+                LEFT JOIN tags t ON t.canonical_note_path = n.canonical_note_path
+                WHERE n.canonical_note_path >= ? AND n.canonical_note_path < ?
+                    AND n.record_version = ?
+                """,
+                self._range(root) + (RECORD_VERSION,),
+            ):
+                tags = res.setdefault(path, set())
+                if tag is not None:
+                    tags.add(tag)
+        return res
+
+    def tag_postings(self, tags, roots):
+        """Return `{tag: set(canonical_note_path)}` for the given tags below `roots`."""
+        res = {tag: set() for tag in tags}
+        for root in roots:
+            lo, hi = self._range(root)
+            for tag in tags:
+                res[tag].update(
+                    path
+                    for (path,) in self.conn.execute(
+                        """
+                        SELECT canonical_note_path FROM tags WHERE tag = ?
+                            AND canonical_note_path >= ? AND canonical_note_path < ?
+                        """,
+                        (tag, lo, hi),
+                    )
+                )
+        return res
+
+    def clear_notes(self):
+        """Remove every note record but keep the file-hash memo."""
+        conn = self.conn
+        for table in ["aliases", "tags", "notes"]:
+            conn.execute(f"DELETE FROM {table}")
+        self._commit()
+
+    def get_hash(self, st):
+        """Return the memoized sha256 for an `os.stat_result` or `None`."""
+        row = self.conn.execute(
+            """
+            SELECT sha256 FROM hashes
+            WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?
+            """,
+            _hashkey(st),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_hash(self, st, digest):
+        """Memoize the sha256 for an `os.stat_result`, replacing any for that inode."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)",
+            _hashkey(st) + (digest,),
+        )
+        self._commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+
+def store(note):
+    """Best-effort cache update from a note's in-memory state. Never raises."""
+    cache = writer()
+    if cache is None:
+        return
+    try:
+        record = note._to_cache_record()
+    except CacheRecordError as E:
+        debug(f"Not caching {note.destnote0!r}: {E}")
+        return
+    try:
+        cache.put(record)
+    except Exception as E:  # Cache failure after a good write is non-fatal
+        warn(f"Could not update cache for {note.destnote0!r}: {E}")
+
+
+def discard(path):
+    """Best-effort removal of a cached note. Never raises."""
+    cache = writer()
+    if cache is None:
+        return
+    try:
+        cache.discard(path)
+    except Exception as E:
+        warn(f"Could not update cache for {path!r}: {E}")
+
+
+def memo_lookup(path):
+    """Return `(stat, digest)` for `path` from the hash memo.
+
+    `digest` is `None` on a miss. `stat` is `None` when the cache is disabled.
+    """
+    cache = writer()
+    if cache is None:
+        return None, None
+    st = fs.stat(path)
+    try:
+        digest = cache.get_hash(st)
+    except Exception as E:
+        warn(f"Could not read hash memo for {path!r}: {E}")
+        return None, None
+    if digest is not None:
+        debug(f"hash memo hit {path!r}")
+    return st, digest
+
+
+def memo_record(path, st, digest):
+    """Memoize `digest` for `path` as it was at `st` (from `memo_lookup()`).
+
+    Skipped if the file changed since `st` or was modified within
+    `HASH_RACY_WINDOW` seconds.
+    """
+    cache = writer()
+    if cache is None or st is None:
+        return
+    if (
+        _hashkey(fs.stat(path, cached=False)) != _hashkey(st)
+        or time.time() - st.st_mtime <= HASH_RACY_WINDOW
+    ):
+        return
+    try:
+        cache.put_hash(st, digest)
+    except Exception as E:
+        warn(f"Could not update hash memo for {path!r}: {E}")
+
+
+def sha256(path):
+    """Hash a file with SHA-256, using the cache's hash memo when enabled.
+
+    Unchanged files (same device, inode, size, and mtime_ns) are not reread.
+    """
+    from .utils import sha256 as _sha256
+
+    st, digest = memo_lookup(path)
+    if digest is None:
+        digest = _sha256(path)
+        memo_record(path, st, digest)
+    else:
+        profiling.count("hash.memo")
+    return digest
@@ -1,11 +1,26 @@
 import argparse
-import json
 import os
 import sys
-
-from . import FORMAT, HIDDEN, NOTEFIELD, SAFE_QUERY, SUBDIR, __version__, debug, utils
-from .nfyaml import pss, ruamel_yaml, yaml
-from .notefile import Notefile
+import time
+
+from . import (
+    FORMAT,
+    HIDDEN,
+    NOTEFIELD,
+    SAFE_QUERY,
+    SUBDIR,
+    __version__,
+    cache,
+    debug,
+    fs,
+    profiling,
+    snapshots,
+    utils,
+)
+
+# Everything else (notes, YAML, queries, search) is imported where it is used so
+# that a single quick call like `note-path` or `cat` only loads what it needs. See
+# `test_startup_imports`.
 
 # 100 --------------------------------------------------------------------------------------------->
 
@@ -19,8 +34,7 @@ def cli(argv=None):
         Optional argument vector. When omitted, arguments are read from
         `sys.argv[1:]`.
     """
-    from . import query_help
-
+    forward = argv is None  # Command-line calls may run on `notefile serve`
     if not argv:
         argv = sys.argv[1:]
 
@@ -34,6 +48,117 @@ def cli(argv=None):
     if argv and argv[0] == "version":
         argv[0] = "--version"
 
+    if forward:
+        from .daemon import forward
+
+        returncode = forward(argv)
+        if returncode is not None:
+            sys.exit(returncode)
+
+    parser = build_parser(prog, command=_command_name(argv))
+    args = parser.parse_args(argv)
+
+    global DEBUG
+    if args.debug:
+        DEBUG = True
+    else:  # reset by environ
+        DEBUG = os.environ.get("NOTEFILE_DEBUG", "").strip().lower() == "true"
+
+    if DEBUG:  # May have been set not at CLI
+        debug("argv: {}".format(repr(argv)))
+        debug(args)
+
+    # Repair commands need disk truth but should still keep the cache current
+    repair = args.command in {"repair", "repair-metadata", "repair-orphaned"}
+    cache.configure(enabled=getattr(args, "cache", None), trust_reads=not repair)
+    snapshots.configure(enabled=getattr(args, "snapshots", None))
+    profiling.configure(
+        enabled=getattr(args, "profile", None), dump=getattr(args, "profile_dump", None)
+    )
+    fs.configure(cache=False if args.command in {"watch", "serve"} else None)
+
+    profiler = None
+    if profiling.DUMP:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    t0 = time.perf_counter()
+    try:
+        if args.command in {"edit", "mod"}:
+            SingleMod(args)
+        elif args.command in {"copy", "replace"}:
+            CopyReplace(args)
+        elif args.command == "change-tag":
+            ChangeTag(args)
+        elif args.command == "format":
+            FormatChangeCLI(args)
+        elif args.command in {"vis", "show", "hide"}:
+            if args.command != "vis":
+                args.mode = args.command
+            VisChangeCLI(args)
+        elif args.command == "cat":  # no need to call an object
+            from .notefile import Notefile
+
+            note = Notefile(args.file, note_field=args.note_field)
+            print(note.cat(tags=args.tags, full=args.full))
+        elif args.command in {"find", "export", "search", "grep", "query", "tags"}:
+            args.tag = set(getattr(args, "tag", []))
+            if args.command == "tags":
+                args.tag_mode = True
+            if args.command == "export":
+                args.export = True
+
+            tagkeys = ["tag_mode", "tag_counts", "tag_count_order"]
+            args.tag_mode = any(getattr(args, k, False) for k in tagkeys)
+
+            SearchCLI(args)
+        elif args.command in {"repair", "repair-metadata", "repair-orphaned"}:
+            RepairCLI(args)
+        elif args.command == "note-path":
+            NotePathCLI(args)
+        elif args.command == "import":
+            ImportCLI(args)
+        elif args.command == "cache":
+            CacheCLI(args)
+        elif args.command == "watch":
+            WatchCLI(args)
+        elif args.command == "serve":
+            from . import daemon
+
+            if args.stop:
+                if not daemon.stop(args.socket):
+                    sys.exit(1)
+            else:
+                daemon.serve(args.socket)
+    except Exception as E:
+        if DEBUG:
+            raise
+        print(f"ERROR: {E}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        fs.configure(cache=False)  # Only for this call
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profiling.DUMP)
+        if profiling.ENABLED:
+            profiling.report(args.command, time.perf_counter() - t0)
+
+
+def build_parser(prog="notefile", command=None):
+    """Build the command-line argument parser.
+
+    Parameters
+    ----------
+    prog:
+        Program name shown in usage and help.
+    command:
+        When given, only build the subparser for this command. Building all of
+        them is a large part of the startup time of a quick call. If `command`
+        is not a command, all are built.
+    """
+    from . import query_help
+
     subparsers = {}
 
     ## Parents:
@@ -50,6 +175,41 @@ def cli(argv=None):
                 `--note-field FIELD --note TEXT` is equivalent to 
                 `--field-note FIELD TEXT`""",
     )
+    global_parent_group.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=argparse.SUPPRESS,  # So it can be given before or after the command
+        help="""Use (or do not use) the SQLite note cache. Default is off unless 
+                $NOTEFILE_USE_CACHE is 'true'. Location is $NOTEFILE_CACHE_DB or 
+                ~/.cache/notefile/notefile-cache.sqlite3. When enabled, cached notes 
+                are trusted and not checked against the filesystem. Rebuild with 
+                `cache build`. File hashes are also memoized so unchanged files are 
+                not rehashed""",
+    )
+    global_parent_group.add_argument(
+        "--snapshots",
+        action=argparse.BooleanOptionalAction,
+        default=argparse.SUPPRESS,
+        help="""Use (or do not use) directory snapshots so searches only list directories 
+                changed since the last search. Default is off unless $NOTEFILE_SNAPSHOTS 
+                is 'true'. Location is $NOTEFILE_SNAPSHOT_DB or 
+                ~/.cache/notefile/notefile-snapshots.sqlite3. Not used when the cache 
+                answers the search""",
+    )
+    global_parent_group.add_argument(
+        "--profile",
+        action="store_true",
+        default=argparse.SUPPRESS,
+        help="""Print the time and calls of each stage (walk, reads, parsing, queries, 
+                hashing, writes, etc.) to stderr when done. Also $NOTEFILE_PROFILE""",
+    )
+    global_parent_group.add_argument(
+        "--profile-dump",
+        metavar="FILE",
+        default=argparse.SUPPRESS,
+        help="""Also run under cProfile and write the stats to FILE (see pstats). 
+                Implies --profile. Also $NOTEFILE_PROFILE_DUMP""",
+    )
     global_parent_group.add_argument(
         "--version", action="version", version="%(prog)s-" + __version__
     )
@@ -93,6 +253,30 @@ def cli(argv=None):
     find_parent_group.add_argument(
         "-x", "--one-file-system", action="store_true", help="Do not cross filesystem boundaries"
     )
+    find_parent_group.add_argument(
+        "--walk-threads",
+        type=int,
+        metavar="N",
+        default=None,
+        help="""List directories ahead of the search with N threads. Helps on network 
+                filesystems. Results are in the same order. Default is 
+                $NOTEFILE_WALK_THREADS or 0 (off)""",
+    )
+    find_parent_group.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        default=None,
+        help="""Read (and grep/query/tag test) notes, and serialize exports, with N 
+                worker processes. Specify 'all' for one per CPU. Default is 
+                $NOTEFILE_JOBS or 1. Reads are serial when they come from the cache""",
+    )
+    find_parent_group.add_argument(
+        "--unordered",
+        action="store_true",
+        help="""With --jobs, output results as they are ready rather than in the 
+                same order as a serial search""",
+    )
     find_parent_group.add_argument(
         "--type",
         choices=["dir", "file", "both"],
@@ -171,6 +355,16 @@ def cli(argv=None):
                 May need to escape them for bash parsing. Can specify multiple. 
                 If note contents are not strings, will use the `str()` representation""",
     )
+    search_parent_grep.add_argument(
+        "--patterns-file",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="""Read additional grep expressions from FILE, one per line (blank lines
+                are skipped). Use '-' for stdin. Can specify multiple. With
+                --fixed-strings, large keyword lists are matched in a single pass over
+                each note""",
+    )
     search_parent_grep.add_argument(
         "--fixed-strings",
         action="store_true",
@@ -272,6 +466,22 @@ def cli(argv=None):
         help="""Do *not* compute the SHA256 of the file. Will not be able to repair 
                 orphaned notes""",
     )
+    new_parent_group.add_argument(
+        "--hash-workers",
+        type=int,
+        metavar="N",
+        default=None,
+        help="""Number of threads used to compute file hashes when repairing many 
+                notes. Default is $NOTEFILE_HASH_WORKERS or 4""",
+    )
+    new_parent_group.add_argument(
+        "--hash-bwlimit",
+        metavar="RATE",
+        default=None,
+        help="""Limit the total read bandwidth when hashing files. Specify bytes/s 
+                with an optional K, M, G suffix (powers of 1024). E.g., '100M'.
+                Default is $NOTEFILE_HASH_BWLIMIT or no limit""",
+    )
     new_parent_group.add_argument(
         "--no-refresh",
         action="store_false",
@@ -466,7 +676,12 @@ def cli(argv=None):
         description="Run `%(prog)s <command> -h` for help",
     )
 
-    subparsers["mod"] = subpar.add_parser(
+    def add_parser(name, **kwargs):
+        if command is not None and name != command:
+            return _UnusedParser()
+        return subpar.add_parser(name, **kwargs)
+
+    subparsers["mod"] = add_parser(
         "mod",
         parents=[editmod_parent, new_parent, global_parent],
         help=(
@@ -474,16 +689,43 @@ def cli(argv=None):
             "Prints each target whose note was written"
         ),
     )
-    subparsers["mod"].add_argument("file", help="Specify file(s)", nargs="+")
+    subparsers["mod"].add_argument("file", help="Specify file(s)", nargs="*")
+    mod_batch = subparsers["mod"].add_argument_group(
+        title="Batch",
+        description="""Modify many notes in one call. The modifications above apply to 
+                        every file. Prints a summary to stderr""",
+    )
+    mod_batch.add_argument(
+        "--from-file",
+        metavar="FILE",
+        help="""Read files to modify from FILE ('-' for stdin), one per line. Lines 
+                can also be JSON objects such as '{"path": "a.txt", "add": ["t1"], 
+                "remove": "t2", "note": "text", "fields": {"field": "text"}}' to 
+                set the modifications of each file (after those from the command 
+                line)""",
+    )
+    mod_batch.add_argument(
+        "--stdin0",
+        action="store_true",
+        help="Read NUL-separated files to modify from stdin (e.g., from `find -print0`)",
+    )
+    mod_batch.add_argument(
+        "--threads",
+        type=int,
+        metavar="N",
+        default=None,
+        help="""Modify notes on N threads with --from-file or --stdin0. Default is 
+                $NOTEFILE_BATCH_THREADS or 4. Always 1 with the cache""",
+    )
 
-    subparsers["edit"] = subpar.add_parser(
+    subparsers["edit"] = add_parser(
         "edit",
         parents=[editmod_parent, new_parent, global_parent],
         help="Shortcut for '%(prog)s mod --edit'. Prints each target whose note was written",
     )
     subparsers["edit"].add_argument("file", help="Specify file(s)", nargs="+")
 
-    subparsers["copy"] = subpar.add_parser(
+    subparsers["copy"] = add_parser(
         "copy",
         help=(
             "Copy the notes from SRC to DST(s). DST must not have any notes. "
@@ -499,7 +741,7 @@ def cli(argv=None):
         "DST", nargs="+", help="Destination file. Must not have ANY notes"
     )
 
-    subparsers["replace"] = subpar.add_parser(
+    subparsers["replace"] = add_parser(
         "replace",
         help=(
             "Replace/Update some or all of the content in SRC to notes in DST. "
@@ -536,7 +778,7 @@ def cli(argv=None):
                 text-based or the dest must not have anything in the field""",
     )
 
-    subparsers["change-tag"] = subpar.add_parser(
+    subparsers["change-tag"] = add_parser(
         "change-tag",
         help="Change one tag to another (or multiple) and display the results",
         parents=[
@@ -554,13 +796,13 @@ def cli(argv=None):
         "-n", "--dry-run", action="store_true", help="""Do not make changes"""
     )
 
-    subparsers["vis"] = subpar.add_parser(
+    subparsers["vis"] = add_parser(
         "vis",
         help="Change the visibility of file(s)/dir(s)",
         parents=[global_parent, find_parent, disp_parent],
     )
     for mode in ["show", "hide"]:
-        subparsers[mode] = subpar.add_parser(
+        subparsers[mode] = add_parser(
             mode,
             help=f"Shortcut for '%(prog)s vis {mode}'",
             parents=[global_parent, find_parent, disp_parent],
@@ -595,7 +837,7 @@ def cli(argv=None):
                 in '_notefiles'. Default is based on original setting""",
         )
 
-    subparsers["format"] = subpar.add_parser(
+    subparsers["format"] = add_parser(
         "format",
         help="Change the format of file(s)/dir(s)",
         parents=[
@@ -619,7 +861,7 @@ def cli(argv=None):
         "-n", "--dry-run", action="store_true", help="""Do not make changes"""
     )
 
-    subparsers["repair"] = subpar.add_parser(
+    subparsers["repair"] = add_parser(
         "repair",
         help="Repair notefile(s): metadata and orphaned",
         parents=[
@@ -634,7 +876,7 @@ def cli(argv=None):
     subparsers[
         "repair",
         "m",
-    ] = subpar.add_parser(
+    ] = add_parser(
         "repair-metadata",
         help="Repair notefile(s): metadata",
         parents=[
@@ -648,7 +890,7 @@ def cli(argv=None):
     subparsers[
         "repair",
         "o",
-    ] = subpar.add_parser(
+    ] = add_parser(
         "repair-orphaned",
         help="Repair notefile(s): orphaned",
         parents=[
@@ -661,7 +903,7 @@ def cli(argv=None):
     )
 
     ## Single item see
-    subparsers["cat"] = subpar.add_parser("cat", help="Print the note", parents=[global_parent])
+    subparsers["cat"] = add_parser("cat", help="Print the note", parents=[global_parent])
     subparsers["cat"].add_argument("file", help="Specify file to cat")
     subparsers["cat"].add_argument(
         "-f",
@@ -672,7 +914,7 @@ def cli(argv=None):
     subparsers["cat"].add_argument("-t", "--tags", action="store_true", help="Display the tags")
 
     ## Multi-item search and/or see
-    subparsers["find"] = subpar.add_parser(
+    subparsers["find"] = add_parser(
         "find",
         help="Find and list all notes",
         parents=[
@@ -687,7 +929,7 @@ def cli(argv=None):
         help=("Find orphaned notes only. Does not repair. See repair-orphaned to repair"),
     )
 
-    subparsers["export"] = subpar.add_parser(
+    subparsers["export"] = add_parser(
         "export",
         help=(
             "Shortcut for '%(prog)s find --export'. "
@@ -704,7 +946,32 @@ def cli(argv=None):
         "path", nargs="*", action="extend", help="Additional --path arguments"
     )
 
-    subparsers["search"] = subpar.add_parser(
+    subparsers["import"] = add_parser(
+        "import",
+        help=(
+            "Apply an export (any --export-format) back onto the notes. Exported fields "
+            "replace those of each note (others are kept) and notes are only written if "
+            "they change. Prints each note that was written"
+        ),
+        parents=[
+            new_parent,
+            global_parent,
+        ],
+    )
+    subparsers["import"].add_argument(
+        "file", nargs="?", default="-", help="Export file. Default '-' for stdin"
+    )
+    subparsers["import"].add_argument(
+        "--import-format",
+        choices=["auto", "yaml", "json", "jsonl"],
+        default="auto",
+        help="[%(default)s] Format of the export. 'auto' detects it from the first line",
+    )
+    subparsers["import"].add_argument(
+        "-n", "--dry-run", action="store_true", help="""Do not make changes"""
+    )
+
+    subparsers["search"] = add_parser(
         "search",
         help="Find and list all notes with criteria",
         parents=[
@@ -715,7 +982,7 @@ def cli(argv=None):
         ],
     )
 
-    subparsers["grep"] = subpar.add_parser(
+    subparsers["grep"] = add_parser(
         "grep",
         help="Shortcut for '%(prog)s search --grep'",
         parents=[
@@ -729,7 +996,7 @@ def cli(argv=None):
         "grep", nargs="*", action="extend", help="Additional --grep expressions"
     )
 
-    subparsers["query"] = subpar.add_parser(
+    subparsers["query"] = add_parser(
         "query",
         help="""Shortcut for '%(prog)s search --query'. Also has additional details 
                 on queries""",
@@ -746,7 +1013,7 @@ def cli(argv=None):
         "query", nargs="*", action="extend", help="""Additional queries added to any --query."""
     )
 
-    subparsers["tags"] = subpar.add_parser(
+    subparsers["tags"] = add_parser(
         "tags",
         help="Shortcut for '%(prog)s search --tag-mode --tag'",
         parents=[
@@ -759,7 +1026,7 @@ def cli(argv=None):
     subparsers["tags"].add_argument("tag", nargs="*", action="extend")
 
     # Path
-    subparsers["note-path"] = subpar.add_parser(
+    subparsers["note-path"] = add_parser(
         "note-path",
         help="Return the existing notefile path for a target",
         parents=[
@@ -774,79 +1041,101 @@ def cli(argv=None):
     )
     subparsers["note-path"].add_argument("path", help="Specify the target path")
 
-    args = parser.parse_args(argv)
-
-    global DEBUG
-    if args.debug:
-        DEBUG = True
-    else:  # reset by environ
-        DEBUG = os.environ.get("NOTEFILE_DEBUG", "").strip().lower() == "true"
-
-    if DEBUG:  # May have been set not at CLI
-        debug("argv: {}".format(repr(argv)))
-        debug(args)
+    subparsers["cache"] = add_parser(
+        "cache",
+        help="Maintain the optional SQLite note cache",
+        parents=[global_parent, find_parent],
+    )
+    subparsers["cache"].add_argument(
+        "action",
+        choices=["build", "clear"],
+        help="""'clear' deletes the cache database and directory snapshots. 'build' 
+                clears the cached notes (but not the file-hash memo) and then repopulates them from the notes 
+                found in the path(s). Always uses the cache regardless of 
+                --cache/--no-cache""",
+    )
+    subparsers["cache"].add_argument(
+        "path", nargs="*", action="extend", help="Additional --path arguments"
+    )
 
-    try:
-        if args.command in {"edit", "mod"}:
-            SingleMod(args)
-        elif args.command in {"copy", "replace"}:
-            CopyReplace(args)
-        elif args.command == "change-tag":
-            ChangeTag(args)
-        elif args.command == "format":
-            FormatChangeCLI(args)
-        elif args.command in {"vis", "show", "hide"}:
-            if args.command != "vis":
-                args.mode = args.command
-            VisChangeCLI(args)
-        elif args.command == "cat":  # no need to call an object
-            note = Notefile(args.file, note_field=args.note_field)
-            print(note.cat(tags=args.tags, full=args.full))
-        elif args.command in {"find", "export", "search", "grep", "query", "tags"}:
-            args.tag = set(getattr(args, "tag", []))
-            if args.command == "tags":
-                args.tag_mode = True
-            if args.command == "export":
-                args.export = True
+    subparsers["watch"] = add_parser(
+        "watch",
+        help="""Watch directories and keep the note cache up to date as notes and their 
+                targets change. Prints 'updated', 'removed', 'orphaned', or 'changed' 
+                (target metadata drifted) with the note path as it happens""",
+        parents=[global_parent],
+    )
+    subparsers["watch"].add_argument(
+        "path", nargs="*", default=["."], help="Directories to watch. Default '.'"
+    )
+    subparsers["watch"].add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="""Specify a glob pattern of names to ignore. Directories are also matched 
+                with a trailing '/'. Can specify multiple times.""",
+    )
+    subparsers["watch"].add_argument(
+        "--match-exclude-case", action="store_true", help="Match case on exclude patterns"
+    )
+    subparsers["watch"].add_argument(
+        "--poll",
+        type=float,
+        metavar="SECONDS",
+        help="Poll every SECONDS rather than use inotify (which is Linux only)",
+    )
 
-            tagkeys = ["tag_mode", "tag_counts", "tag_count_order"]
-            args.tag_mode = any(getattr(args, k, False) for k in tagkeys)
+    subparsers["serve"] = add_parser(
+        "serve",
+        help="""Serve commands from a long-running process. Command-line calls of 
+                cat, mod, tags, find, search, grep, query, and note-path are run by it 
+                (when they do not read stdin or edit) to avoid startup costs""",
+        parents=[global_parent],
+    )
+    subparsers["serve"].add_argument(
+        "--socket",
+        metavar="PATH",
+        help="""Unix socket path. Default is $NOTEFILE_SOCKET, or 
+                $XDG_RUNTIME_DIR/notefile.sock, or ~/.cache/notefile/notefile.sock. 
+                Set $NOTEFILE_DAEMON to 'false' to not use a running server""",
+    )
+    subparsers["serve"].add_argument(
+        "--stop", action="store_true", help="Stop the running server. Exit 1 if none"
+    )
 
-            SearchCLI(args)
-        elif args.command in {"repair", "repair-metadata", "repair-orphaned"}:
-            RepairCLI(args)
-        elif args.command == "note-path":
-            NotePathCLI(args)
-    except Exception as E:
-        if DEBUG:
-            raise
-        print(f"ERROR: {E}", file=sys.stderr)
-        sys.exit(1)
+    if command is not None and command not in subpar.choices:
+        return build_parser(prog)  # Not a command. Let argparse report it
+    return parser
 
 
-################## Currently undocumented...
-nproc = os.environ.get("NOTEFILE_PAR", "1")
-if nproc.strip().lower() == "all":
-    nproc = os.cpu_count()
-if int(nproc) > 1:
-    import multiprocessing as mp
+def _command_name(argv):
+    """Return the first positional argument of `argv` (the command) or None"""
+    argv = iter(argv)
+    for arg in argv:
+        if len(arg) > 4 and "--note-field".startswith(arg):  # Takes a value
+            next(argv, None)
+        elif arg == "--":
+            return None
+        elif not arg.startswith("-"):
+            return arg
+    return None
 
-    def _r(note):
-        return note.read()
 
-    def noteread(notes):
-        with mp.Pool() as pool:
-            yield from pool.imap_unordered(_r, notes, chunksize=100)
+class _UnusedParser:
+    """Stand-in for the parser of a command that is not being run. Accepts and
+    ignores argument definitions"""
 
-else:
+    def __getattr__(self, attr):
+        return self._ignore
 
-    def noteread(notes):
-        """Read each note from an iterator sequentially."""
-        for note in notes:
-            yield note.read()
+    def _ignore(self, *args, **kwargs):
+        return self
 
 
-################## /Currently undocumented...
+def noteread(notes):
+    """Read each note from an iterator sequentially."""
+    for note in notes:
+        yield note.read()
 
 
 class BaseCLI:
@@ -867,6 +1156,7 @@ class BaseCLI:
 
         noteopts = kwargs.pop("noteopts", {})
         noteopts["note_field"] = args.note_field
+        self._find_noteopts = noteopts  # For parallel reads
         yield from find(
             path=args.path,
             excludes=args.exclude,
@@ -875,10 +1165,83 @@ class BaseCLI:
             one_file_system=args.one_file_system,
             exclude_links=args.exclude_links,
             noteopts=noteopts,
+            threads=getattr(args, "walk_threads", None),
             targetmode=args.target_type,
             **kwargs,
         )
 
+    def _cache_roots(self):
+        """Return the search paths that the cache can answer for (directories only)."""
+        return [p for p in (self.args.path or ["."]) if fs.isdir(p)]
+
+    @staticmethod
+    def _indexed(note):
+        """Whether a note's tags can come from the cache's tag index (not yet read)."""
+        return note._from_cache and note._data is None
+
+    def cached_tags(self):
+        """Return `{note path: tags}` from the cache's tag index, or `None` if unused."""
+        if not hasattr(self, "_cached_tags"):
+            db = cache.reader()
+            self._cached_tags = db.note_tags(self._cache_roots()) if db is not None else None
+        return self._cached_tags
+
+    def indexed_tag_paths(self, tags, match_all=False):
+        """Return the cached note paths with any (or all) of `tags`, or `None` if unused.
+
+        Answered from the tag postings with set unions/intersections.
+        """
+        db = cache.reader()
+        if db is None or not tags:
+            return None
+        postings = db.tag_postings(tags, self._cache_roots())
+        sets = list(postings.values())
+        return set.intersection(*sets) if match_all else set.union(*sets)
+
+    def note_tags(self, note):
+        """Return a note's tags, from the tag index when the note has not been read."""
+        if self._indexed(note):
+            index = self.cached_tags()
+            tags = index.get(os.path.abspath(note.destnote0)) if index is not None else None
+            if tags is not None:
+                return tags
+        return note.data.tags
+
+    def noteread(self, notes, filter=None):
+        """Read notes and apply the optional `filter`, in parallel with --jobs > 1.
+
+        Reads are serial when the cache is trusted since they do not parse notes.
+        """
+        from .search import parallel_read, parse_jobs
+
+        args = self.args
+        jobs = parse_jobs(getattr(args, "jobs", None))
+        if jobs > 1 and cache.reader() is None:
+            return parallel_read(
+                notes,
+                jobs,
+                filter=filter,
+                ordered=not getattr(args, "unordered", False),
+                noteopts=getattr(self, "_find_noteopts", None),
+            )
+        if filter is not None and cache.reader() is None:
+            # Reject on the raw text before parsing. Not with a trusted cache
+            # since it doesn't parse anyway
+            notes = (note for note in notes if filter.prefilter(note))
+        notes = noteread(notes)
+        if filter is not None:
+            notes = (note for note in notes if filter(note))
+        return notes
+
+    def hashpool(self):
+        """Return a `HashPool` configured from --hash-workers and --hash-bwlimit."""
+        from .hashing import HashPool
+
+        return HashPool(
+            workers=getattr(self.args, "hash_workers", None),
+            bwlimit=getattr(self.args, "hash_bwlimit", None),
+        )
+
     @property
     def noteopts(self):
         """Return `Notefile` constructor options derived from CLI flags."""
@@ -959,7 +1322,7 @@ class DisplayMIXIN:
         tags = defaultdict(list)
 
         for note in notes:
-            for tag in note.data.tags:
+            for tag in self.note_tags(note):
                 tags[tag].append(self.display_name(note))
 
         if not tags:
@@ -979,7 +1342,9 @@ class DisplayMIXIN:
             else:
                 resdict[tag] = sorted(tags[tag], key=str.lower)
 
-        yaml.dump(resdict, self.outbuffer)
+        from . import nfyaml
+
+        nfyaml.dump(resdict, self.outbuffer)
         self.outbuffer.flush()
 
         if self.args.symlink:
@@ -989,107 +1354,64 @@ class DisplayMIXIN:
                     utils.symlink_file(note, dirdest)
 
     def export(self, notes):
-        """Write notes in the selected export format."""
-        res = {"__comment": None}
-        res["description"] = "notefile export"
-        res["time"] = utils.now_string()
-        res["notefile version"] = __version__
-        if self.args.export_format in ["yaml", "json"]:
-            res["notes"] = {}
-            for note in notes:
-                res["notes"][note.names0.filename] = note.data
-
-            if self.args.export_format == "yaml":
-                del res["__comment"]
-                res = pss(res)
-                res = ruamel_yaml.comments.CommentedMap(res)
-                res.yaml_set_start_comment("YAML formatted notefile export")
-
-                yaml.dump(res, self.outbuffer)
-            else:
-                res["__comment"] = "YAML formatted notefile export"
-                dump = json.dumps(res, indent=1, ensure_ascii=False)
-                self.write_output(dump.encode("utf8"))  # Needs to be bytes so two step
-        else:
-            res["__comment"] = "json lines formatted notefile export"
+        """Write notes in the selected export format as they are read."""
+        from .export import write_export
+        from .search import parse_jobs
 
-            meta = json.dumps(res, ensure_ascii=False)
-            self.write_output(meta.encode("utf8") + b"\n")
-
-            for note in notes:
-                row = {"__filename": note.names0.filename}
-                row.update(note.data)
-                row = json.dumps(row, ensure_ascii=False)
-                self.write_output(row.encode("utf8") + b"\n")
-                self.outbuffer.flush()
+        jobs = parse_jobs(getattr(self.args, "jobs", None))
+        write_export(notes, self.outbuffer, self.args.export_format, jobs=jobs)
 
 
 class SearchCLI(DisplayMIXIN, BaseCLI):
     def __init__(self, args):
         """Execute a read-only search-style command."""
+        from .search import SearchFilter, read_patterns
+
         self.args = args
 
         orphaned = getattr(self.args, "orphaned", False)
 
+        for path in getattr(args, "patterns_file", []):
+            args.grep = list(args.grep) + read_patterns(path)
+
+        # Tag-only work can be answered by the cache's tag index without loading
+        # note data at all
+        tagonly = not (args.export or getattr(args, "grep", None) or getattr(args, "query", None))
+        if tagonly:
+            self.tag_paths = self.indexed_tag_paths(
+                getattr(args, "tag", None), match_all=getattr(args, "tag_all", False)
+            )
+
         # Build the pipeline. Do not read for find. Do not query for export.
-        notes = self.find(include_orphaned=orphaned)
+        # Nothing here writes so the notes are read-only
+        notes = self.find(noteopts=dict(readonly=True), include_orphaned=orphaned, lazy=tagonly)
         if orphaned:
             notes = (note for note in notes if note.orphaned)
 
         if args.command != "find":  # no need to read if not testing or exporting
-            notes = noteread(notes)  # May be parallel in the future
+            self.filter = None
             if args.command != "export":
                 # Read stdin on query if -
                 args.query = [
                     q if q != "-" else sys.stdin.read().strip() for q in getattr(args, "query", [])
                 ]
-                # Process. Do the query
-                notes = (note for note in notes if self.test(note))
+                self.filter = SearchFilter.from_args(args)
+
+            if tagonly and cache.reader() is not None:
+                if self.filter is not None:
+                    notes = (note for note in notes if self.test(note))
+            else:
+                # Read and test together so --jobs can do both in the workers
+                notes = self.noteread(notes, filter=self.filter)
 
         self.display_dispatch(notes)
 
     def test(self, note):
         """Return whether a note matches the active grep/query/tag filters."""
-        args = self.args
-
-        grepopts = dict(
-            matchcase=args.match_expr_case,
-            full_note=args.full_note,
-            full_word=args.full_word,
-            fixed_strings=args.fixed_strings,
-            match_any=not args.all,
-        )
-
-        m = False  # whether we did anything
-        if args.grep:
-            t = note.grep(args.grep, **grepopts)
-            if args.all and not t:
-                return False  # short circuit
-            elif not args.all and t:
-                return True
-            m = True
-        if args.query:
-            t = note.query(args.query, allow_exception=args.allow_exception, **grepopts)
-            if args.all and not t:
-                return False  # short circuit
-            elif not args.all and t:
-                return True
-            m = True
-        if args.tag:
-            tags = set(t.lower() for t in note.data.tags)
-            if args.tag_all:
-                t = len(args.tag - tags) == 0
-            else:
-                t = len(args.tag.intersection(tags)) > 0
-            if args.all and not t:
-                return False  # short circuit
-            elif not args.all and t:
-                return True
-            m = True
-
-        # At this point, we either hit them all with ALL, we hit none with ANY,
-        # or didn't have a query
-        return args.all or not m
+        tag_paths = getattr(self, "tag_paths", None)
+        if tag_paths is not None and self._indexed(note):
+            return self.filter(note, tag_hit=os.path.abspath(note.destnote0) in tag_paths)
+        return self.filter(note)
 
 
 class SingleMod(BaseCLI):
@@ -1100,6 +1422,16 @@ class SingleMod(BaseCLI):
         if self.args.command == "edit":
             self.args.edit = True
 
+        if getattr(args, "from_file", None) or getattr(args, "stdin0", False):
+            if args.edit or args.stdin:
+                raise ValueError("Cannot use --edit or --stdin with --from-file or --stdin0")
+            if args.stdin0 and args.from_file == "-":
+                raise ValueError("Cannot use --stdin0 with '--from-file -'. Both read stdin")
+            self.batchmod()
+            return
+
+        if not args.file:
+            raise ValueError("Must specify file(s), --from-file, or --stdin0")
         if not (args.edit or args.tag or args.remove or args.note or args.stdin or args.field_note):
             raise ValueError(
                 "Must specify at least one of --edit, --tag, --remove, --note, "
@@ -1113,28 +1445,85 @@ class SingleMod(BaseCLI):
         """Apply note edits to each explicitly requested file."""
         args = self.args
         seen = set()
-        for file in args.file:
-            note = Notefile(file, **self.noteopts)
+        with self.hashpool() as pool:
+            # Each note is written before the next is read so that a failure
+            # keeps the earlier changes and a repeated file sees its last write
+            for file in args.file:
+                note = pool.resolve(self.modify(file))
+                note.write()
+                if note.was_written:
+                    self.emit_notes([note], dedupe=True, seen=seen)
 
-            note.modify_tags(add=args.tag, remove=args.remove)
-            if args.stdin or args.note:
-                note.add_note(args.addnote, replace=args.replace)  # also does strip()
-            for field, field_note in args.field_note:
-                note.add_note(field_note, replace=args.replace, field=field)
-            if args.edit:
-                note.interactive_edit(full=args.full, manual=args.manual, tags_only=args.tags_only)
+    def batchmod(self):
+        """Apply the modifications to the files from --from-file and --stdin0 on threads."""
+        import contextlib
+        import itertools
 
-            if args.refresh:
-                note.repair_metadata(force=False)
+        from . import batch
 
-            note.write()
-            if note.was_written:
-                self.emit_notes([note], dedupe=True, seen=seen)
+        args = self.args
+
+        fields = {}
+        for field, field_note in args.field_note:
+            fields[field] = "\n".join(filter(None, [fields.get(field), field_note]))
+
+        summary = dict(written=0, unchanged=0, failed=0)
+        with contextlib.ExitStack() as stack:
+            changes = [args.file]
+            if args.stdin0:
+                changes.append(batch.read_paths0(sys.stdin.buffer))
+            if args.from_file == "-":
+                changes.append(batch.read_changes(sys.stdin))
+            elif args.from_file:
+                fobj = stack.enter_context(open(args.from_file, encoding="utf8"))
+                changes.append(batch.read_changes(fobj))
+
+            results = batch.iter_apply(
+                itertools.chain.from_iterable(changes),
+                noteopts=self.noteopts,
+                threads=args.threads,
+                add=args.tag,
+                remove=args.remove,
+                note="\n".join(args.note) if args.note else None,
+                fields=fields,
+                replace=args.replace,
+                refresh=args.refresh,
+            )
+            seen = set()
+            for result in results:
+                summary[result.status] += 1
+                if result.status == "written":
+                    self.emit_notes([result.note], dedupe=True, seen=seen)
+
+        print(", ".join(f"{k}: {v}" for k, v in summary.items()), file=sys.stderr)
+        if summary["failed"]:
+            raise ValueError(f"Could not modify {summary['failed']} note(s)")
+
+    def modify(self, file):
+        """Apply the requested modifications to one note without writing it."""
+        from .notefile import Notefile
+
+        args = self.args
+        note = Notefile(file, **self.noteopts)
+
+        note.modify_tags(add=args.tag, remove=args.remove)
+        if args.stdin or args.note:
+            note.add_note(args.addnote, replace=args.replace)  # also does strip()
+        for field, field_note in args.field_note:
+            note.add_note(field_note, replace=args.replace, field=field)
+        if args.edit:
+            note.interactive_edit(full=args.full, manual=args.manual, tags_only=args.tags_only)
+
+        if args.refresh:
+            note.repair_metadata(force=False, defer_hash=True)
+        return note
 
 
 class CopyReplace(BaseCLI):
     def __init__(self, args):
         """Copy or replace note content from one source to one or more targets."""
+        from .notefile import Notefile
+
         self.args = args
         src = Notefile(args.SRC, **self.noteopts)
 
@@ -1164,8 +1553,16 @@ class ChangeTag(DisplayMIXIN, BaseCLI):
             self.outbuffer.write(b"# DRY RUN\n")
             self.outbuffer.flush()
 
-        notes = self.find()
-        notes = noteread(notes)
+        # With the cache, only notes that carry the old tag need to be read
+        tag_paths = self.indexed_tag_paths([self.old])
+        notes = self.find(lazy=tag_paths is not None)
+        if tag_paths is not None:
+            notes = (
+                note
+                for note in notes
+                if not self._indexed(note) or os.path.abspath(note.destnote0) in tag_paths
+            )
+        notes = self.noteread(notes)
         notes = (self.change(note) for note in notes)
         notes = (note for note in notes if note is not None)
 
@@ -1202,7 +1599,7 @@ class VisChangeCLI(DisplayMIXIN, BaseCLI):
     # need to do it here. It's a waste but oh well!
     def display_tags(self, notes):
         """Read notes before delegating to tag display."""
-        notes = noteread(notes)
+        notes = self.noteread(notes)
         return super().display_tags(notes)
 
 
@@ -1216,7 +1613,7 @@ class FormatChangeCLI(DisplayMIXIN, BaseCLI):
             self.outbuffer.flush()
 
         notes = self.find(noteopts=dict(format=args.format, rewrite_format=True))
-        notes = noteread(notes)
+        notes = self.noteread(notes)
         notes = (note for note in notes if note.format != note.format0)
         if not args.dry_run:
             # Force writing. Prev set rewrite_format=True!
@@ -1228,7 +1625,7 @@ class FormatChangeCLI(DisplayMIXIN, BaseCLI):
     # vectorized in the future)
     def display_tags(self, notes):
         """Read notes before delegating to tag display."""
-        notes = noteread(notes)
+        notes = self.noteread(notes)
         return super().display_tags(notes)
 
 
@@ -1246,20 +1643,31 @@ class RepairCLI(BaseCLI):
         args = self.args
 
         notes = self.find(noteopts=self.noteopts, include_orphaned=False)
-        notes = noteread(notes)
-        for note in notes:
-            if note.orphaned:
-                continue  # can happen iff path is DIRECTLY specified
-            if note.repair_metadata(dry_run=args.dry_run, force=args.force_refresh):
+        notes = self.noteread(notes)
+        notes = (
+            note
+            for note in notes
+            if not note.orphaned  # can happen iff path is DIRECTLY specified
+            and note.repair_metadata(
+                dry_run=args.dry_run, force=args.force_refresh, defer_hash=True
+            )
+        )
+        with self.hashpool() as pool:
+            for note in pool.resolve_deferred(notes):
                 note.write()
                 print(f'repaired{" (DRY-RUN)" if args.dry_run else ""}: {note.names0.filename}')
 
     def repair_orphaned(self):
-        """Attempt to relocate every orphaned note in the search result."""
+        """Attempt to relocate every orphaned note in the search result.
+
+        The search path is walked once for all of the orphans.
+        """
+        from .repair import repair_orphaned
+
         args = self.args
         notes = self.find(noteopts=self.noteopts, include_orphaned=True)
         notes = (note for note in notes if note.orphaned)
-        notes = noteread(notes)
+        notes = self.noteread(notes)
 
         match = set(args.match) if args.match else {"mtime", "hash"}
 
@@ -1273,31 +1681,99 @@ class RepairCLI(BaseCLI):
             for path in args.path:
                 if not path:
                     continue
-                args.search_path.append(path if os.path.isdir(path) else os.path.dirname(path))
-
-        for note in notes:
-            r = note.repair_orphaned(
-                mtime=mtime,
-                filehash=filehash,
-                name=name,
-                dry_run=args.dry_run,
-                search_path=args.search_path,
-                search_excludes=args.search_exclude,
-                search_matchcase=args.search_match_exclude_case,
-                search_maxdepth=args.search_maxdepth,
-                search_one_file_system=args.search_one_file_system,
-                search_exclude_links=args.search_exclude_links,
-            )
+                args.search_path.append(path if fs.isdir(path) else os.path.dirname(path))
+
+        repaired = repair_orphaned(
+            notes,
+            mtime=mtime,
+            filehash=filehash,
+            name=name,
+            dry_run=args.dry_run,
+            search_path=args.search_path,
+            search_excludes=args.search_exclude,
+            search_matchcase=args.search_match_exclude_case,
+            search_maxdepth=args.search_maxdepth,
+            search_one_file_system=args.search_one_file_system,
+            search_exclude_links=args.search_exclude_links,
+        )
+        for note, r in repaired:
             if r:
                 print(f"{prefix}{note.destnote0} --> {r}")
 
 
+class ImportCLI(BaseCLI):
+    def __init__(self, args):
+        """Write the notes of an export that differ from those on disk."""
+        from .export import import_notes, read_export
+
+        self.args = args
+        if args.dry_run:
+            self.write_output(b"# DRY RUN\n")
+            self.outbuffer.flush()
+
+        def run(stream):
+            records = read_export(stream, format=args.import_format)
+            self.emit_notes(import_notes(records, noteopts=self.noteopts, dry_run=args.dry_run))
+
+        if args.file == "-":
+            run(sys.stdin)
+        else:
+            with open(args.file, encoding="utf8") as stream:
+                run(stream)
+
+
 class NotePathCLI(BaseCLI):
     def __init__(self, args):
         """Print the existing or candidate notefile path for one target path."""
+        from .notefile import Notefile
+
         self.args = args
         note = Notefile(args.path, **self.noteopts)
         if args.candidate or note.exists:
             print(note.destnote0, flush=True)
         elif not note.exists:
             sys.exit(1)
+
+
+class CacheCLI(BaseCLI):
+    def __init__(self, args):
+        """Clear or rebuild the SQLite note cache."""
+        self.args = args
+        if args.action == "clear":
+            cache.clear()
+            snapshots.clear()
+            return
+
+        # build: clear, then repopulate from filesystem truth using ordinary reads.
+        # The hash memo is kept since it is validated against each file anyway
+        args.target_type = "both"
+        cache.configure(enabled=True, trust_reads=False, dbpath=cache.DBPATH)
+        count = 0
+        with cache.writer().batch():
+            cache.writer().clear_notes()
+            for note in self.noteread(self.find(include_orphaned=True)):
+                count += 1
+        print(f"cached {count} notes", flush=True)
+
+
+class WatchCLI(BaseCLI):
+    def __init__(self, args):
+        """Keep the note cache current and report note changes until interrupted."""
+        from .watch import NoteWatcher
+
+        self.args = args
+        cache.configure(enabled=True, trust_reads=False, dbpath=cache.DBPATH)
+
+        def report(status, path):
+            print(f"{status}: {path}", flush=True)
+
+        watcher = NoteWatcher(
+            args.path,
+            excludes=args.exclude,
+            matchcase=args.match_exclude_case,
+            poll=args.poll,
+            noteopts=dict(note_field=args.note_field),
+            report=report,
+        )
+        with watcher:
+            watcher.run()
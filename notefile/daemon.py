@@ -0,0 +1,313 @@
+"""
+Long-running notefile server (`notefile serve`) and its client.
+
+The server answers CLI commands over a Unix domain socket so that editor and
+file-manager hooks calling `notefile cat`/`mod`/`note-path` per file do not pay
+for interpreter startup and imports every time. It keeps parsed notes
+(`notefile.PARSED`), directory listings (`find.LISTINGS`), and compiled grep
+expressions and queries warm between requests.
+
+`cli()` forwards command-line calls for `COMMANDS` to the server when it is
+running (unless `$NOTEFILE_DAEMON` is 'false'). Calls that read stdin or open
+an editor are not forwarded, nor are calls whose `$NOTEFILE_*` environment or
+version differ from the server's. Those run in the calling process.
+
+Requests are handled one at a time since each one changes into the client's
+directory and captures stdout and stderr. The protocol is a single JSON line
+from the client and a single JSON reply from the server:
+
+    request: {"argv": [...], "cwd": "...", "env": {...}, "version": "..."}
+             or {"stop": true}
+    reply:   {"stdout": "...", "stderr": "...", "returncode": N}
+             or {"fallback": "<reason to run in the client>"}
+
+The socket is `$NOTEFILE_SOCKET` or `$XDG_RUNTIME_DIR/notefile.sock` (when set)
+or `~/.cache/notefile/notefile.sock`, and is only accessible by the user.
+"""
+
+import json
+import os
+import sys
+
+from . import __version__, debug, fs, warn
+
+COMMANDS = frozenset({"cat", "mod", "tags", "find", "search", "grep", "query", "note-path"})
+
+# Kept between requests by the server
+PARSED_SIZE = 10000
+LISTINGS_SIZE = 10000
+
+# Environment variables that do not change what a command does
+_CLIENT_ENV = {"NOTEFILE_SOCKET", "NOTEFILE_DAEMON"}
+
+# Flags (or their prefixes) of calls that must run in the calling process
+_LOCAL_FLAGS = ["--stdin", "--stdin0", "--edit", "--profile", "--profile-dump"]
+
+# Output is sent as text. This round trips undecodable bytes
+_ENCODING = "utf8"
+_ERRORS = "surrogateescape"
+
+
+def socket_path(path=None):
+    """Return the server socket path: `path`, `$NOTEFILE_SOCKET`, or the default."""
+    if not path:
+        path = os.environ.get("NOTEFILE_SOCKET", "").strip()
+    if not path:
+        rundir = os.environ.get("XDG_RUNTIME_DIR", "").strip()
+        if rundir:
+            path = os.path.join(rundir, "notefile.sock")
+        else:
+            path = os.path.join("~", ".cache", "notefile", "notefile.sock")
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def _env():
+    return {
+        k: v for k, v in os.environ.items() if k.startswith("NOTEFILE_") and k not in _CLIENT_ENV
+    }
+
+
+def forwardable(argv):
+    """Whether a command line can run on the server.
+
+    Not for commands outside of `COMMANDS`, that may read stdin or open an
+    editor, or that are profiled. Unsure cases (e.g., combined short flags) are
+    not forwarded.
+    """
+    from .cli import _command_name
+
+    if _command_name(argv) not in COMMANDS:
+        return False
+    for arg in argv:
+        if arg == "--":
+            break
+        if arg == "-" or arg.endswith("=-"):
+            return False
+        name = arg.split("=", 1)[0]
+        if any(len(name) > 2 and f.startswith(name) for f in _LOCAL_FLAGS):
+            return False
+        if arg.startswith("-") and not arg.startswith("--") and {"s", "e"} & set(arg[1:]):
+            return False  # -s (stdin), -e (edit), or a combination
+    return True
+
+
+def forward(argv, path=None):
+    """Run a command line on the server if it is running.
+
+    Parameters
+    ----------
+    argv:
+        Argument vector for `cli()`.
+    path:
+        Socket path. Defaults to `socket_path()`.
+
+    Returns
+    -------
+    int or None
+        The exit code after writing the command's output, or `None` if it was
+        not run on the server (and should be run here).
+    """
+    if os.environ.get("NOTEFILE_DAEMON", "true").strip().lower() == "false":
+        return None
+    path = socket_path(path)
+    if not fs.exists(path) or not forwardable(argv):
+        return None
+
+    req = {"argv": list(argv), "cwd": os.getcwd(), "env": _env(), "version": __version__}
+    try:
+        sock = _connect(path)
+    except OSError as E:
+        debug(f"server not available at {path!r}: {E}")
+        return None
+
+    # The command may have run from here on so never run it again locally
+    with sock:
+        reply = _exchange(sock, req)
+
+    if "fallback" in reply:
+        debug(f"server declined: {reply['fallback']}")
+        return None
+
+    sys.stdout.flush()
+    sys.stdout.buffer.write(reply["stdout"].encode(_ENCODING, _ERRORS))
+    sys.stdout.flush()
+    sys.stderr.write(reply["stderr"])
+    sys.stderr.flush()
+    return reply["returncode"]
+
+
+def request(argv, path=None):
+    """Run a command line on the server and return its reply.
+
+    Unlike `forward()`, this raises `OSError` if the server is not running and
+    returns the reply (`stdout`, `stderr`, `returncode` or `fallback`) rather
+    than writing it.
+    """
+    req = {"argv": list(argv), "cwd": os.getcwd(), "env": _env(), "version": __version__}
+    with _connect(socket_path(path)) as sock:
+        return _exchange(sock, req)
+
+
+def running(path=None):
+    """Return whether a server is accepting connections at the socket."""
+    try:
+        with _connect(socket_path(path)):
+            return True
+    except OSError:
+        return False
+
+
+def stop(path=None):
+    """Ask the server to exit. Return whether one was running."""
+    try:
+        with _connect(socket_path(path)) as sock:
+            _exchange(sock, {"stop": True})
+    except OSError:
+        return False
+    return True
+
+
+def _connect(path):
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj).encode("utf8") + b"\n")
+
+
+def _recv(sock):
+    """Read one JSON line (or until the other end closes)."""
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    if not chunks:
+        raise ConnectionError("Connection closed without a reply")
+    return json.loads(b"".join(chunks))
+
+
+def _exchange(sock, obj):
+    _send(sock, obj)
+    return _recv(sock)
+
+
+def serve(path=None):
+    """Serve requests on the socket until stopped (`stop()` or a signal).
+
+    Parameters
+    ----------
+    path:
+        Socket path. Defaults to `socket_path()`.
+    """
+    import importlib
+    import socket
+    import stat
+
+    from .utils import LRU
+
+    # The modules rather than `notefile.find()` and `notefile.Notefile`
+    find = importlib.import_module(".find", __package__)
+    notefile = importlib.import_module(".notefile", __package__)
+
+    path = socket_path(path)
+    if running(path):
+        raise ValueError(f"Already serving on {path!r}")
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        st = fs.lstat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        # Only remove a stale socket. Never a file or link at a mistyped path
+        if not stat.S_ISSOCK(st.st_mode):
+            raise ValueError(f"{path!r} exists and is not a socket")
+        os.unlink(path)
+
+    notefile.PARSED = LRU(PARSED_SIZE)
+    find.LISTINGS = LRU(LISTINGS_SIZE)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)  # Only the user may connect
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    print(f"serving on {path}", flush=True)
+
+    env = _env()
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    request = _recv(conn)
+                    if request.get("stop"):
+                        _send(conn, {"returncode": 0})
+                        break
+                    _send(conn, _handle(request, env))
+                except Exception as E:  # Keep serving other clients
+                    warn(f"Request failed: {E!r}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        notefile.PARSED = find.LISTINGS = None
+
+
+def _handle(request, env):
+    """Run one request's command line and return the reply."""
+    import io
+    import traceback
+
+    from .cli import cli
+
+    if request.get("version") != __version__:
+        return {"fallback": f"version {request.get('version')} != {__version__}"}
+    if request.get("env") != env:
+        return {"fallback": "environment differs"}
+
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding=_ENCODING, errors=_ERRORS, write_through=True)
+    stderr = io.StringIO()
+    saved = sys.stdin, sys.stdout, sys.stderr, os.getcwd()
+    sys.stdin, sys.stdout, sys.stderr = io.StringIO(), stdout, stderr
+    try:
+        os.chdir(request["cwd"])
+        cli(list(request["argv"]))
+        returncode = 0
+    except SystemExit as E:
+        if E.code is None or isinstance(E.code, int):
+            returncode = E.code or 0
+        else:
+            print(E.code, file=sys.stderr)
+            returncode = 1
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr, cwd = saved
+        os.chdir(cwd)
+
+    stdout.flush()
+    return {
+        "stdout": stdout.buffer.getvalue().decode(_ENCODING, _ERRORS),
+        "stderr": stderr.getvalue(),
+        "returncode": returncode,
+    }
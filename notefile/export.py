@@ -0,0 +1,389 @@
+"""
+Streaming notes export and import.
+
+`write_export()` writes the export formats one note at a time rather than
+building the whole document first, so memory does not grow with the number of
+notes and output starts right away. The 'yaml' and 'json' documents are the
+same as dumping all of the notes at once: each note is serialized as the only
+entry of the 'notes' mapping and the lines that wrap it are dropped.
+
+Output is flushed every `FLUSH_INTERVAL` seconds rather than after every note.
+With `jobs`, notes are serialized by worker processes (in order). That mostly
+helps YAML, which is much slower to write than JSON.
+
+`read_export()` reads any of the formats back one note at a time and
+`import_notes()` writes the notes that differ from those on disk. jsonl is read
+line by line. YAML as written by `write_export()` (or edited keeping its layout)
+is parsed one note at a time, otherwise it is loaded all at once. JSON is read
+into memory as text but only one note at a time is decoded.
+"""
+
+import json
+import re
+import time
+
+from . import __version__, debug, profiling, warn
+
+FORMATS = ("yaml", "json", "jsonl")
+
+FLUSH_INTERVAL = 0.5
+
+# Written before the first and between notes
+_OPENERS = {"yaml": "notes:\n", "json": "{\n"}
+_SEPARATORS = {"json": ",\n"}
+
+COMMENTS = {
+    "yaml": "YAML formatted notefile export",
+    "json": "YAML formatted notefile export",  # Historical
+    "jsonl": "json lines formatted notefile export",
+}
+
+
+def write_export(notes, out, format="yaml", *, jobs=1, chunksize=64):
+    """Write notes to `out` in an export format.
+
+    Parameters
+    ----------
+    notes:
+        Iterable of read `Notefile` objects. Consumed lazily.
+    out:
+        Binary stream (a text stream also works).
+    format:
+        One of `FORMATS`.
+    jobs:
+        Number of worker processes to serialize notes with. 1 serializes here.
+    chunksize:
+        Notes per worker task.
+
+    Returns
+    -------
+    int
+        The number of notes written.
+    """
+    from . import utils
+
+    if format not in FORMATS:
+        raise ValueError(f"Unrecognized export format {format!r}. Use one of {FORMATS}")
+
+    write = _writer(out)
+    meta = {
+        "description": "notefile export",
+        "time": utils.now_string(),
+        "notefile version": __version__,
+    }
+
+    items = ((note.names0.filename, note.data) for note in notes)
+    if jobs > 1:
+        entries = _parallel_entries(items, format, jobs, chunksize)
+    else:
+        entries = (entry(format, name, data) for name, data in items)
+
+    write(header(format, meta))
+    count = 0
+    last = time.monotonic()
+    for text in entries:
+        write((_SEPARATORS if count else _OPENERS).get(format, "") + text)
+        count += 1
+        if time.monotonic() - last >= FLUSH_INTERVAL:
+            out.flush()
+            last = time.monotonic()
+    write(footer(format, empty=not count))
+    out.flush()
+    return count
+
+
+def header(format, meta):
+    """Return the text before the first note."""
+    if format == "yaml":
+        from . import nfyaml
+
+        res = nfyaml.ruamel_yaml.comments.CommentedMap(nfyaml.pss(meta))
+        res.yaml_set_start_comment(COMMENTS[format])
+        return _yaml_dump(res)  # Up to the notes
+
+    res = {"__comment": COMMENTS[format], **meta}
+    if format == "jsonl":
+        return json.dumps(res, ensure_ascii=False) + "\n"
+
+    res["notes"] = {}
+    text = json.dumps(res, indent=1, ensure_ascii=False)
+    return text[: -len("{}\n}")]  # Up to the notes
+
+
+@profiling.timed("export.serialize")
+def entry(format, name, data):
+    """Return the text of one note (without a separator)."""
+    if format == "jsonl":
+        row = {"__filename": name}
+        row.update(data)
+        return json.dumps(row, ensure_ascii=False) + "\n"
+
+    if format == "yaml":
+        from . import nfyaml
+
+        text = _yaml_dump({"notes": {name: nfyaml.pss(data)}})
+        return text[len("notes:\n") :]
+
+    text = json.dumps({"notes": {name: data}}, indent=1, ensure_ascii=False)
+    return text[len('{\n "notes": {\n') : -len("\n }\n}")]
+
+
+def footer(format, empty=False):
+    """Return the text after the last note."""
+    if format == "yaml":
+        return "notes: {}\n" if empty else ""
+    if format == "json":
+        return "{}\n}" if empty else "\n }\n}"
+    return ""
+
+
+def _yaml_dump(obj):
+    import io
+
+    from . import nfyaml
+
+    buf = io.StringIO()
+    nfyaml.dump(obj, buf)
+    return buf.getvalue()
+
+
+def _writer(out):
+    """Return a function writing text to `out` as bytes (or as text if it must)."""
+
+    def write(text):
+        try:
+            out.write(text.encode("utf8"))
+        except TypeError:
+            out.write(text)
+
+    return write
+
+
+def _parallel_entries(items, format, jobs, chunksize):
+    """Yield `entry()` for each `(name, data)`, in order, serialized by worker processes.
+
+    Only a few chunks are in flight at a time so memory stays bounded.
+    """
+    import multiprocessing as mp
+    from collections import deque
+
+    from .search import _chunked
+
+    def collect():
+        texts, stats = window.popleft().get()
+        profiling.merge(stats)
+        return texts
+
+    window = deque()
+    initargs = (profiling.ENABLED, False)
+    with mp.Pool(jobs, initializer=profiling.configure, initargs=initargs) as pool:
+        for chunk in _chunked(items, chunksize):
+            window.append(pool.apply_async(_entries, (format, chunk)))
+            while len(window) > 2 * jobs:
+                yield from collect()
+        while window:
+            yield from collect()
+
+
+def _entries(format, chunk):
+    return [entry(format, name, data) for name, data in chunk], profiling.take()
+
+
+def read_export(stream, format="auto"):
+    """Yield `(name, data)` for each note in an export.
+
+    Parameters
+    ----------
+    stream:
+        Text stream of the export.
+    format:
+        One of `FORMATS` or 'auto' to detect it from the first line.
+
+    Raises
+    ------
+    ValueError
+        If the export is not in the format.
+    """
+    if format == "auto":
+        format, first = _detect(stream)
+    else:
+        first = ""
+    if format not in FORMATS:
+        raise ValueError(f"Unrecognized export format {format!r}. Use one of {FORMATS}")
+    debug(f"reading {format} export")
+
+    if format == "jsonl":
+        yield from _read_jsonl(first, stream)
+    elif format == "json":
+        yield from _read_json(first + stream.read())
+    else:
+        yield from _read_yaml(first, stream)
+
+
+def import_notes(records, *, noteopts=None, dry_run=False):
+    """Write the notes in `records` that differ from those on disk.
+
+    The record's fields replace those of the note. Fields that are not in the
+    record are kept (so a partial record, e.g. only 'tags', can be used to edit
+    notes) and new notes get their target's metadata. Notes are compared as with
+    `Notefile.ismod()` so the 'last-updated' and 'notefile version' fields
+    alone do not cause a write. New notes are created as set by `noteopts`.
+    Records whose target does not exist are skipped with a warning.
+
+    Parameters
+    ----------
+    records:
+        Iterable of `(name, data)` such as from `read_export()`.
+    noteopts:
+        Keyword arguments for `Notefile`.
+    dry_run:
+        Do not write anything.
+
+    Yields
+    ------
+    Notefile
+        Each note that was (or, with `dry_run`, would be) written.
+    """
+    from .notefile import Notefile, _target_exists
+    from .utils import Bunch
+
+    noteopts = noteopts or {}
+    for name, data in records:
+        if not isinstance(data, dict):
+            warn(f"Skipping {name!r}. Note data is not a mapping")
+            continue
+        note = Notefile(name, **noteopts)
+        if not note.exists and not _target_exists(note.names0.filename):
+            warn(f"Skipping {name!r}. The target does not exist")
+            continue
+        note.read()
+
+        data = {**note.data, **data}
+        data.pop("__comment", None)
+        note.data = Bunch(**data)
+        if not note.ismod():
+            debug(f"import: {name!r} unchanged")
+            continue
+        if not dry_run:
+            note.write()
+        yield note
+
+
+def _detect(stream):
+    """Return the format of an export and the (consumed) first line."""
+    first = stream.readline()
+    while first and not first.strip():
+        first = stream.readline()
+    if not first.lstrip().startswith("{"):
+        return "yaml", first
+    try:
+        row = json.loads(first)
+    except ValueError:
+        return "json", first  # Incomplete object so a multi-line document
+    if isinstance(row, dict) and "notes" in row and "__filename" not in row:
+        return "json", first  # All on one line
+    return "jsonl", first
+
+
+def _read_jsonl(first, stream):
+    import itertools
+
+    for line in itertools.chain([first], stream):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if "__filename" not in row:  # The metadata
+            continue
+        yield row.pop("__filename"), row
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _read_json(text):
+    """Decode the entries of the 'notes' object one at a time."""
+    decoder = json.JSONDecoder()
+
+    def skip(i, expect=None):
+        i = _WHITESPACE.match(text, i).end()
+        if expect is not None:
+            if text[i : i + 1] != expect:
+                raise ValueError(f"Expected {expect!r} at position {i} of the JSON export")
+            i = _WHITESPACE.match(text, i + 1).end()
+        return i
+
+    def items(i):
+        """Yield `(key, i)` with `i` at the start of the value. The caller moves `i` past it"""
+        i = skip(i, "{")
+        while text[i : i + 1] != "}":
+            key, i = decoder.raw_decode(text, i)
+            i = yield key, skip(i, ":")
+            i = skip(i)
+            if text[i : i + 1] == ",":
+                i = skip(i + 1)
+        yield None, i + 1
+
+    top = items(0)
+    key, i = next(top)
+    while key is not None:
+        if key == "notes":
+            notes = items(i)
+            name, i = next(notes)
+            while name is not None:
+                data, i = decoder.raw_decode(text, i)
+                yield name, data
+                name, i = notes.send(i)
+        else:
+            _, i = decoder.raw_decode(text, i)
+        key, i = top.send(i)
+
+
+_NOTES_LINE = re.compile(r"notes:\s*(#.*)?$")
+
+
+def _read_yaml(first, stream):
+    """Parse the 'notes' mapping one entry at a time by its indentation.
+
+    Falls back to loading the whole document if it is not laid out as a block
+    mapping under a top-level 'notes:' line.
+    """
+    import itertools
+
+    from .nfyaml import load_yaml
+
+    lines = itertools.chain([first], stream)
+    head = []
+    for line in lines:
+        head.append(line)
+        if _NOTES_LINE.match(line):
+            break
+    else:
+        data = load_yaml("".join(head)) or {}
+        yield from (data.get("notes") or {}).items()
+        return
+
+    indent = None
+    entry = []
+    for line in lines:
+        stripped = line.lstrip(" ")
+        blank = not stripped.strip() or stripped.startswith("#")
+        if not blank:
+            level = len(line) - len(stripped)
+            if level == 0:  # The end of the notes
+                break
+            if indent is None:
+                indent = level
+            if level == indent and not stripped.startswith(":"):  # ':' ends a '? ' key
+                yield from _yaml_entries(entry, load_yaml)
+                entry = []
+        entry.append(line)
+    yield from _yaml_entries(entry, load_yaml)
+
+
+def _yaml_entries(lines, load_yaml):
+    if not any(line.strip() and not line.lstrip().startswith("#") for line in lines):
+        return
+    notes = load_yaml("notes:\n" + "".join(lines))["notes"]
+    if not isinstance(notes, dict):
+        raise ValueError("The 'notes' of the YAML export must be a mapping")
+    yield from notes.items()
@@ -5,8 +5,17 @@ Main module-level utilities
 import os
 import sys
 
-from . import NOTESEXT
-from .notefile import Notefile
+from . import NOTESEXT, fs, profiling
+
+NOTE_SUBDIRS = ["_notefiles", ".notefiles"]
+
+# Directory listings (a `utils.LRU` keyed by path) kept by a long-running process
+# such as `notefile serve`. `None` to always list.
+LISTINGS = None
+
+# Directories modified this recently are not kept since a later change within the
+# filesystem's timestamp resolution would not change their mtime
+LISTING_RACY_WINDOW = 2.0
 
 
 def find(
@@ -19,6 +28,7 @@ def find(
     include_orphaned=False,
     empty=None,
     noteopts=None,
+    threads=None,
     **kwargs,
 ):
     """Yield notes or raw paths discovered under one or more roots.
@@ -45,6 +55,11 @@ def find(
         Filter by empty-note status. `None` disables this filter.
     noteopts:
         Keyword arguments passed to `Notefile` for yielded notes.
+    threads:
+        Number of threads used to list directories ahead of the walk. Helps
+        on high-latency (e.g. network) filesystems. The order of results is
+        unchanged. `None` uses `$NOTEFILE_WALK_THREADS` (default 0, listing
+        in the calling thread).
 
     Other Parameters
     ----------------
@@ -52,6 +67,9 @@ def find(
         Internal flag that yields raw file paths instead of `Notefile` objects.
     targetmode:
         Internal target-type filter used by CLI repair flows.
+    lazy:
+        Internal flag. When notes come from the cache, defer loading note data
+        until it is accessed.
 
     Yields
     ------
@@ -62,6 +80,7 @@ def find(
     """
     filemode = kwargs.pop("filemode", False)  # Hidden argument
     targetmode = kwargs.pop("targetmode", "file")
+    lazy = kwargs.pop("lazy", False)
     if kwargs:
         raise ValueError(f"Unrecognized arguments: {list(kwargs)}")
 
@@ -81,8 +100,10 @@ def find(
                 include_orphaned=include_orphaned,
                 empty=empty,
                 noteopts=noteopts,
+                threads=threads,
                 filemode=filemode,
                 targetmode=targetmode,
+                lazy=lazy,
             ):
                 name = r if filemode else r.names0.filename
                 if name not in seen:
@@ -90,6 +111,7 @@ def find(
                 seen.add(name)
         return
 
+    from .notefile import Notefile
     from .utils import _dot_sort, exclude_in_place
 
     if noteopts is None:
@@ -97,14 +119,42 @@ def find(
 
     path = str(path)  # Path objects
 
-    if os.path.isfile(path):
+    if fs.isfile(path):
         yield Notefile(path, **noteopts) if not filemode else path
         return
 
-    dev0 = os.stat(path).st_dev
-    for root, dirs, files in os.walk(path):
+    from . import cache
+
+    db = None if filemode else cache.reader()
+    if db is not None:
+        yield from _find_cached(
+            db,
+            path,
+            excludes=excludes,
+            matchcase=matchcase,
+            maxdepth=maxdepth,
+            exclude_links=exclude_links,
+            include_orphaned=include_orphaned,
+            empty=empty,
+            noteopts=noteopts,
+            targetmode=targetmode,
+            lazy=lazy,
+        )
+        return
+
+    if threads is None:
+        threads = int(os.environ.get("NOTEFILE_WALK_THREADS", "0").strip() or 0)
+
+    # Snapshots only hold what is needed to find notes
+    from . import snapshots
+
+    store = None if filemode else snapshots.store()
+
+    dev0 = fs.stat(path).st_dev if one_file_system else None
+    for root, dirs, files, listing in _walk(path, threads=threads, snapshots=store):
+        entries, subentries = listing
         if filemode and targetmode in {"dir", "both"}:
-            if not exclude_links or not os.path.islink(root):
+            if not exclude_links or not fs.islink(root):
                 yield root
 
         # Do regular excludes of files
@@ -118,26 +168,28 @@ def find(
         )
 
         # Add subdirs but also check for excludes. Add them to files
-        for subname in ["_notefiles", ".notefiles"]:
+        for subname in NOTE_SUBDIRS:
             try:
                 dirs.remove(subname)  # will error if not here
-                subfiles = os.listdir(os.path.join(root, subname))
-                exclude_in_place(
-                    subfiles,
-                    excludes,
-                    matchcase=matchcase,
-                    isdir=False,
-                    remove_noteext=True,
-                    keep_notes_only=not filemode,
-                )
-                files.extend(os.path.join(subname, subfile) for subfile in subfiles)
             except ValueError:
                 continue
+            subfiles = list(subentries.get(subname, []))
+            exclude_in_place(
+                subfiles,
+                excludes,
+                matchcase=matchcase,
+                isdir=False,
+                remove_noteext=True,
+                keep_notes_only=not filemode,
+            )
+            files.extend(os.path.join(subname, subfile) for subfile in subfiles)
 
         exclude_in_place(dirs, excludes, matchcase=matchcase, isdir=True)
 
         if one_file_system:
-            dirs[:] = [d for d in dirs if os.stat(os.path.join(root, d)).st_dev == dev0]
+            # A kept listing's cached stat would miss a mount made since it was listed
+            fresh = LISTINGS is not None
+            dirs[:] = [d for d in dirs if _device(entries[d], fresh) == dev0]
 
         rel = os.path.relpath(root, path)
         depth = rel.count("/") + 1 if rel != "." else 0
@@ -153,7 +205,7 @@ def find(
             if filemode:
                 if targetmode == "dir":
                     continue
-                if isnote or (exclude_links and os.path.islink(ffile)):
+                if isnote or (exclude_links and _islink(entries, subentries, file, ffile)):
                     continue
                 yield ffile
                 continue
@@ -161,7 +213,7 @@ def find(
             if not isnote:
                 continue
 
-            nf = Notefile(ffile, **noteopts)
+            nf = Notefile.from_listing(ffile, listing, **noteopts)
             if exclude_links and nf.islink:
                 continue
             if targetmode != "both":
@@ -181,3 +233,268 @@ def find(
                     continue
 
             yield nf
+
+
+def _isdir(entry):
+    """`DirEntry.is_dir()` (following links) treating errors as not a dir, like `os.walk`."""
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _device(entry, fresh=False):
+    """`st_dev` of a listed entry (following links). Stat again if `fresh`."""
+    return (fs.stat(entry.path, cached=False) if fresh else entry.stat()).st_dev
+
+
+def _islink(entries, subentries, name, path):
+    """Whether a listed file is a symlink, using the listing when possible."""
+    subname, _, leaf = name.rpartition(os.sep)
+    entry = subentries.get(subname, {}).get(leaf) if subname else entries.get(name)
+    try:
+        return entry.is_symlink() if entry is not None else fs.islink(path)
+    except OSError:
+        return False
+
+
+@profiling.timed("walk.list")
+def _scandir(path, snapshots=None):
+    """List a directory, and its note subdirectories, for `_walk()`.
+
+    Returns `(entries, subentries)` mapping names to `os.DirEntry` (with
+    `subentries` keyed by note subdirectory) or `None` if `path` cannot be
+    listed. Like `os.walk`, such directories are skipped.
+
+    With `LISTINGS`, a kept listing is reused while the directory and its note
+    subdirectories are unchanged (by inode and mtime). Otherwise, with a
+    `snapshots.SnapshotStore`, its snapshot of the directory is replayed under
+    the same condition.
+    """
+    if LISTINGS is None:
+        if snapshots is not None:
+            return snapshots.listing(path)
+        return _scandir_fresh(path)
+
+    signature = _listing_signature(path)
+    if signature is None:
+        return _scandir_fresh(path)
+    kept = LISTINGS.get(path)
+    if kept is not None and kept[0] == signature:
+        return kept[1]
+
+    listing = _scandir_fresh(path)
+    if listing is not None and _keep_listing(listing, signature):
+        LISTINGS.put(path, (signature, listing))
+    return listing
+
+
+def _listing_signature(path, window=None):
+    """Return `(inode, mtime_ns)` of `path` and each note subdirectory, or `None`.
+
+    `None` if any cannot be read or was modified within `window` seconds
+    (default `LISTING_RACY_WINDOW`).
+    """
+    import time
+
+    if window is None:
+        window = LISTING_RACY_WINDOW
+
+    signature = []
+    for p in [path] + [os.path.join(path, subname) for subname in NOTE_SUBDIRS]:
+        try:
+            st = fs.stat(p)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        except OSError:
+            return None
+        if time.time() - st.st_mtime <= window:
+            return None
+        signature.append((st.st_ino, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def _keep_listing(listing, signature, symlinks=False):
+    """Whether a listing can be reused while its directories are unchanged.
+
+    Not with symlinks (unless `symlinks`, for listings that check links when
+    asked) since the entries cache whether the target is a directory, which can
+    change without changing the directory. Not if a note subdirectory could not
+    be listed (or appeared or left between the stat and the listing).
+    """
+    entries, subentries = listing
+    for subname, sig in zip(NOTE_SUBDIRS, signature[1:]):
+        if (sig is not None) != (subname in subentries):
+            return False
+    if symlinks:
+        return True
+    for listed in [entries, *subentries.values()]:
+        for entry in listed.values():
+            try:
+                if entry.is_symlink():
+                    return False
+            except OSError:
+                return False
+    return True
+
+
+def _scandir_fresh(path):
+    """`_scandir()` without kept listings."""
+    try:
+        with fs.scandir(path) as it:
+            entries = {entry.name: entry for entry in it}
+    except OSError:
+        return None
+
+    subentries = {}
+    for subname in NOTE_SUBDIRS:
+        entry = entries.get(subname)
+        if entry is None or not _isdir(entry):
+            continue
+        try:
+            with fs.scandir(entry.path) as it:
+                subentries[subname] = {sub.name: sub for sub in it}
+        except OSError:
+            pass
+    return entries, subentries
+
+
+def _walk(top, threads=0, snapshots=None):
+    """Top-down `os.walk(top)` replacement built on `os.scandir`.
+
+    Yields `(root, dirs, files, (entries, subentries))` where the latter come
+    from `_scandir()`. As with `os.walk`, `dirs` may be edited in place to prune
+    and order the walk, and symlinked directories are listed in `dirs` but not
+    walked into.
+
+    With `threads`, directories near the top of the pending stack are listed
+    ahead of time on a thread pool. That only changes when the listings are
+    made, not the order of the walk. `snapshots` is passed to `_scandir()` and
+    committed when the walk ends.
+    """
+    pool = None
+    if threads and threads > 0:
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="notefile-walk")
+    window = 4 * threads
+
+    stack = [[top, None]]  # [path, future or None]
+    try:
+        while stack:
+            root, future = stack.pop()
+            listing = future.result() if future is not None else _scandir(root, snapshots)
+            if listing is None:
+                continue
+            entries, subentries = listing
+
+            dirs, files = [], []
+            for name, entry in entries.items():
+                (dirs if _isdir(entry) else files).append(name)
+
+            yield root, dirs, files, listing
+
+            for name in reversed(dirs):
+                entry = entries.get(name)
+                if entry is None or not entry.is_symlink():
+                    stack.append([os.path.join(root, name), None])
+
+            if pool is not None:
+                for item in stack[-window:]:
+                    if item[1] is None:
+                        item[1] = pool.submit(_scandir, item[0], snapshots)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if snapshots is not None:
+            snapshots.commit()
+
+
+def _find_cached(
+    db,
+    path,
+    *,
+    excludes,
+    matchcase,
+    maxdepth,
+    exclude_links,
+    include_orphaned,
+    empty,
+    noteopts,
+    targetmode,
+    lazy=False,
+):
+    """Yield notes under `path` from the note cache instead of walking.
+
+    Applies the same exclude, depth, link, type, orphan, and empty filters as the
+    filesystem walk, in Python, and yields in walk order. `one_file_system` is not
+    applied since that would require probing the filesystem.
+    """
+    from . import cache
+    from .notefile import Notefile
+    from .utils import _dot_sort, exclude_in_place
+
+    root = os.path.abspath(path)
+    if os.path.isabs(path):
+        rebase = None
+    else:
+        cwd = os.getcwd()
+        rebase = lambda p: os.path.relpath(p, cwd)
+
+    entries = []
+    for record in db.iter_records(root, with_data=not lazy):
+        rel = os.path.relpath(record["canonical_note_path"], root)
+        *dirparts, name = rel.split(os.sep)
+        if dirparts and dirparts[-1] in {"_notefiles", ".notefiles"}:
+            name = os.path.join(dirparts.pop(), name)
+
+        if maxdepth is not None and len(dirparts) > maxdepth:
+            continue
+
+        keep = [os.path.basename(name)]
+        exclude_in_place(keep, excludes, matchcase=matchcase, isdir=False, remove_noteext=True)
+        if not keep:
+            continue
+        excluded = False
+        for part in dirparts:
+            keep = [part]
+            exclude_in_place(keep, excludes, matchcase=matchcase, isdir=True)
+            if not keep:
+                excluded = True
+                break
+        if excluded:
+            continue
+
+        key = (tuple(d.lower() for d in dirparts), _dot_sort(name))
+        entries.append((key, record))
+
+    entries.sort(key=lambda e: e[0])
+
+    for _, record in entries:
+        try:
+            nf = Notefile.from_cache_record(record, rebase=rebase, **noteopts)
+        except cache.CacheRecordError:
+            # e.g. a different --note-field. Fall back to the note file
+            notepath = record["canonical_note_path"]
+            nf = Notefile(rebase(notepath) if rebase else notepath, **noteopts)
+
+        if exclude_links and nf.islink:
+            continue
+        if targetmode != "both":
+            if targetmode == "dir" and not nf.isdir0:
+                continue
+            if targetmode == "file" and not nf.isfile0:
+                continue
+
+        if nf.orphaned and not include_orphaned:
+            continue
+
+        if empty is not None:  # True or False
+            isempty = nf.isempty()
+            if empty and not isempty:
+                continue
+            if not empty and isempty:
+                continue
+
+        yield nf
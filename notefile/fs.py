@@ -0,0 +1,193 @@
+"""
+Filesystem probes of notes and their targets.
+
+Existence, type, and stat checks go through these functions rather than
+`os.path` so that each probe is one system call and is counted by `--profile`
+(as 'fs.stat', 'fs.lstat', 'fs.scandir', and 'fs.readlink'). Notably,
+`lexists()` (exists or is a broken link) is a single `lstat` rather than the
+`stat` then `lstat` of `os.path.exists(path) or os.path.islink(path)`.
+
+Errors other than the path not existing are treated as not existing, as with
+`os.path`.
+
+Within a CLI call, `stat()` and `lstat()` results (including that a path does not
+exist) are kept in a run-scoped cache so each path is probed at most once. An
+`lstat` of something other than a link also answers a `stat`. notefile's own
+writes, links, and moves `invalidate()` what they change (and the directory
+holding it). The cache is set up by `configure()` and is off outside of `cli()`,
+for `watch` and `serve`, and with `$NOTEFILE_STAT_CACHE=false`. Hits are counted
+as 'fs.cached'. Every probe takes `cached=False` to skip the cache (e.g., in
+long-running code).
+"""
+
+import os
+import stat as _stat
+
+from . import profiling
+
+# Run-scoped cache. More than this many paths clears it
+CACHE_SIZE = 200_000
+
+_stats = None  # path: stat_result or _MISSING. `None` when not caching
+_lstats = None
+_cwd = None
+
+_MISSING = object()
+
+
+def env_cache():
+    """Return whether `$NOTEFILE_STAT_CACHE` allows the run-scoped cache (default true)."""
+    return os.environ.get("NOTEFILE_STAT_CACHE", "true").strip().lower() != "false"
+
+
+def configure(cache=None):
+    """Start (or stop) the run-scoped cache, dropping anything in it.
+
+    Parameters
+    ----------
+    cache:
+        `True` or `False` to override `$NOTEFILE_STAT_CACHE`. `None` uses the
+        environment. Relative paths are taken relative to the current directory
+        so call this again after changing it.
+    """
+    global _stats, _lstats, _cwd
+    if env_cache() if cache is None else cache:
+        _stats, _lstats, _cwd = {}, {}, os.getcwd()
+    else:
+        _stats = _lstats = _cwd = None
+
+
+def invalidate(*paths):
+    """Drop what is cached about `paths` and the directories holding them."""
+    if _stats is None:
+        return
+    for path in paths:
+        key = _key(path)
+        for k in [key, os.path.dirname(key)]:
+            _stats.pop(k, None)
+            _lstats.pop(k, None)
+
+
+def _key(path):
+    return os.path.normpath(os.path.join(_cwd, os.fspath(path)))
+
+
+def _probe(func, cache, key, path, name):
+    """Call `func(path)`, recording the result (or that `path` does not exist) in `cache`."""
+    if profiling.ENABLED:
+        profiling.count(name)
+    try:
+        st = func(path)
+    except (FileNotFoundError, NotADirectoryError):
+        if cache is not None:
+            cache[key] = _MISSING
+        raise
+    if cache is not None:
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        cache[key] = st
+    return st
+
+
+def _missing(path):
+    import errno
+
+    return FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.fspath(path))
+
+
+def stat(path, *, cached=True):
+    """`os.stat(path)`. Raises `OSError`.
+
+    Uses the run-scoped cache unless `cached` is false (e.g., to check whether
+    a file changed).
+    """
+    stats = _stats if cached else None
+    if stats is None:
+        return _probe(os.stat, None, None, path, "fs.stat")
+
+    key = _key(path)
+    st = stats.get(key)
+    if st is None:
+        st = _lstats.get(key)
+        if st is not None and st is not _MISSING and _stat.S_ISLNK(st.st_mode):
+            st = None
+    if st is None:
+        return _probe(os.stat, stats, key, path, "fs.stat")
+    if profiling.ENABLED:
+        profiling.count("fs.cached")
+    if st is _MISSING:
+        raise _missing(path)
+    return st
+
+
+def lstat(path, *, cached=True):
+    """`os.lstat(path)`. Raises `OSError`. See `stat()`."""
+    lstats = _lstats if cached else None
+    if lstats is None:
+        return _probe(os.lstat, None, None, path, "fs.lstat")
+
+    key = _key(path)
+    st = lstats.get(key)
+    if st is None:
+        return _probe(os.lstat, lstats, key, path, "fs.lstat")
+    if profiling.ENABLED:
+        profiling.count("fs.cached")
+    if st is _MISSING:
+        raise _missing(path)
+    return st
+
+
+def exists(path, *, cached=True):
+    """Whether `path` exists, following links."""
+    try:
+        stat(path, cached=cached)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def lexists(path, *, cached=True):
+    """Whether `path` exists or is a (possibly broken) link."""
+    try:
+        lstat(path, cached=cached)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def isdir(path, *, cached=True):
+    """Whether `path` is a directory, following links."""
+    try:
+        return _stat.S_ISDIR(stat(path, cached=cached).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def isfile(path, *, cached=True):
+    """Whether `path` is a regular file, following links."""
+    try:
+        return _stat.S_ISREG(stat(path, cached=cached).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def islink(path, *, cached=True):
+    """Whether `path` is a symlink."""
+    try:
+        return _stat.S_ISLNK(lstat(path, cached=cached).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def scandir(path):
+    """`os.scandir(path)`. Use as a context manager."""
+    if profiling.ENABLED:
+        profiling.count("fs.scandir")
+    return os.scandir(path)
+
+
+def readlink(path):
+    """`os.readlink(path)`."""
+    if profiling.ENABLED:
+        profiling.count("fs.readlink")
+    return os.readlink(path)
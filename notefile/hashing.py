@@ -0,0 +1,183 @@
+"""
+Threaded file hashing for notes with a deferred SHA-256.
+
+hashlib releases the GIL while hashing so a thread pool keeps several reads in
+flight. Hash-memo lookups and updates (see `cache.sha256()`) stay in the calling
+thread since the SQLite connection is not shared across threads.
+
+The worker count and an optional read-bandwidth cap default to
+`$NOTEFILE_HASH_WORKERS` (default 4) and `$NOTEFILE_HASH_BWLIMIT` (default no
+limit).
+"""
+
+import collections
+import os
+import threading
+import time
+
+from . import cache, debug, utils
+
+DEFAULT_WORKERS = 4
+
+_RATE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_rate(rate):
+    """Parse a bandwidth like '50M', '1.5G/s', or '200KB' into bytes per second.
+
+    Units are powers of 1024. Returns `None` (no limit) for empty or zero.
+    """
+    if rate is None:
+        return None
+    if isinstance(rate, (int, float)):
+        return rate or None
+
+    txt = rate.strip().upper()
+    for suffix in ["/S", "B"]:
+        if txt.endswith(suffix):
+            txt = txt[: -len(suffix)]
+    unit = txt[-1:] if txt[-1:] in _RATE_UNITS else ""
+    num = txt[: len(txt) - len(unit)]
+    try:
+        value = float(num or "0") * _RATE_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Invalid bandwidth {rate!r}. Use, e.g., '100M' for 100 MiB/s")
+    if value < 0:
+        raise ValueError(f"Invalid bandwidth {rate!r}")
+    return value or None
+
+
+def env_workers():
+    """Return the worker count from `$NOTEFILE_HASH_WORKERS` or the default."""
+    return int(os.environ.get("NOTEFILE_HASH_WORKERS", "").strip() or DEFAULT_WORKERS)
+
+
+def env_bwlimit():
+    """Return the bandwidth cap (bytes/s) from `$NOTEFILE_HASH_BWLIMIT` or `None`."""
+    return parse_rate(os.environ.get("NOTEFILE_HASH_BWLIMIT", ""))
+
+
+class RateLimiter:
+    """Pace reads across all threads to `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def __call__(self, nbytes):
+        """Account for `nbytes` read, blocking as needed to stay under the rate."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class HashPool:
+    """Compute deferred SHA-256 hashes on a pool of threads.
+
+    Use as a context manager to shut down the threads.
+
+    Parameters
+    ----------
+    workers:
+        Number of hashing threads. `None` uses `$NOTEFILE_HASH_WORKERS`.
+        With 1 (or fewer), files are hashed in the calling thread.
+    bwlimit:
+        Total read bandwidth cap in bytes per second or a string such as
+        '100M'. `None` uses `$NOTEFILE_HASH_BWLIMIT`.
+    """
+
+    def __init__(self, workers=None, bwlimit=None):
+        self.workers = env_workers() if workers is None else int(workers)
+        bwlimit = env_bwlimit() if bwlimit is None else parse_rate(bwlimit)
+        self.throttle = RateLimiter(bwlimit) if bwlimit else None
+        self._executor = None
+        debug(f"hash pool: workers={self.workers} bwlimit={bwlimit}")
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="notefile-hash"
+            )
+        return self._executor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the threads, if started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _hash(self, path):
+        return utils.sha256(path, throttle=self.throttle)
+
+    def _submit(self, note, inline=False):
+        """Start hashing the note's target if its hash is deferred.
+
+        Returns `(path, stat, result)` where `result` is a digest or a future,
+        or `None` if nothing needs to be hashed. Hashes in the calling thread
+        if `inline`.
+        """
+        from .notefile import DEFERRED_HASH
+
+        if not note.isfile or note.data.get("sha256") != DEFERRED_HASH:
+            return None
+        path = note.names.filename
+        st, digest = cache.memo_lookup(path)
+        if digest is None:
+            if self.workers > 1 and not inline:
+                digest = self.executor.submit(self._hash, path)
+            else:
+                digest = self._hash(path)
+                cache.memo_record(path, st, digest)
+        return path, st, digest
+
+    def _finish(self, note, job):
+        """Store the computed hash in the note and the memo."""
+        if job is None:
+            return note
+        path, st, digest = job
+        if not isinstance(digest, str):
+            digest = digest.result()
+            cache.memo_record(path, st, digest)
+        note.data["sha256"] = digest
+        return note
+
+    def resolve(self, note):
+        """Return `note` with any deferred SHA-256 computed (in this thread).
+
+        For notes handled one at a time that must not be read ahead of writing
+        the previous one (e.g., `mod`). The bandwidth cap and memo still apply.
+        """
+        return self._finish(note, self._submit(note, inline=True))
+
+    def resolve_deferred(self, notes, window=None):
+        """Yield `notes` in order, each with any deferred SHA-256 computed.
+
+        Up to `window` notes (default 4 per worker) are held while their
+        hashes are computed so the pool stays busy without reading ahead
+        indefinitely.
+        """
+        window = window or 4 * max(self.workers, 1)
+        pending = collections.deque()
+        for note in notes:
+            pending.append((note, self._submit(note)))
+            while len(pending) > window or (pending and _done(pending[0][1])):
+                yield self._finish(*pending.popleft())
+        while pending:
+            yield self._finish(*pending.popleft())
+
+
+def _done(job):
+    return job is None or isinstance(job[2], str) or job[2].done()
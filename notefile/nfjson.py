@@ -0,0 +1,45 @@
+"""
+JSON parsing with orjson when it is installed.
+
+`loads()` uses orjson if it can be imported and falls back to the standard
+library for anything orjson rejects (e.g., NaN) or would read differently
+(integers beyond 64 bits become floats), so results and errors are those of
+`json.loads()`.
+
+Serialization always uses the standard library. Notes are written with
+`indent=1`, which orjson does not support, and orjson writes NaN as `null`.
+"""
+
+import json
+import re
+
+from . import debug
+
+orjson = None  # Imported on the first `loads()`. It pulls in zoneinfo, uuid, etc.
+_orjson_checked = False
+
+JSONDecodeError = json.JSONDecodeError
+
+# orjson reads integers outside of [-2**63, 2**64) as floats
+_LONG_DIGITS = re.compile(r"\d{19}")
+
+
+def loads(txt):
+    """Parse JSON text. Raises `JSONDecodeError` if it is invalid."""
+    if not _orjson_checked:
+        _load_orjson()
+    if orjson is not None and not _LONG_DIGITS.search(txt):
+        try:
+            return orjson.loads(txt)
+        except orjson.JSONDecodeError:
+            pass  # The standard library may still accept it (or raise)
+    return json.loads(txt)
+
+
+def _load_orjson():
+    global orjson, _orjson_checked
+    try:
+        import orjson
+    except ImportError:
+        debug("no orjson. Using json to load")
+    _orjson_checked = True
@@ -1,5 +1,7 @@
+import functools
 import io
 import re
+import threading
 
 from . import debug
 
@@ -12,18 +14,62 @@ from . import debug
 # https://github.com/yaml/pyyaml/issues/121
 # However I do not want to make pyyaml *also* a requirement so it will use it
 # if it can or fall back
-try:
-    import ruamel_yaml
-    from ruamel_yaml.scalarstring import LiteralScalarString as PreservedScalarString
-except ImportError:
-    import ruamel.yaml as ruamel_yaml
-    from ruamel.yaml.scalarstring import LiteralScalarString as PreservedScalarString
+#
+# Both are imported on first use so that reading and writing JSON notes never
+# loads them. `ruamel_yaml`, `yaml`, `yaml_safe`, and `PreservedScalarString`
+# are module attributes set up by `_load_ruamel()` (via `__getattr__`), so use
+# them as `nfyaml.yaml` rather than importing the names.
+#
+# The ruamel_yaml objects keep their emitter and parser state on the object so
+# they are not thread-safe. `dump()` and `load_ruamel_yaml()` use them under a
+# lock so notes can be read and written from threads.
+
+_RUAMEL_NAMES = {"ruamel_yaml", "PreservedScalarString", "yaml", "yaml_safe"}
+
+_lock = threading.RLock()
+
+
+def _load_ruamel():
+    """Import ruamel.yaml and set up the module-level YAML objects"""
+    if "yaml_safe" in globals():
+        return
+    with _lock:
+        if "yaml_safe" not in globals():
+            _import_ruamel()
+
+
+def _import_ruamel():
+    global ruamel_yaml, PreservedScalarString, yaml, yaml_safe
+    try:
+        import ruamel_yaml as _ruamel_yaml
+        from ruamel_yaml.scalarstring import LiteralScalarString
+    except ImportError:
+        import ruamel.yaml as _ruamel_yaml
+        from ruamel.yaml.scalarstring import LiteralScalarString
+    debug("loaded ruamel.yaml")
+
+    ruamel_yaml = _ruamel_yaml
+    PreservedScalarString = LiteralScalarString
+    yaml = ruamel_yaml.YAML()
+    yaml_safe = ruamel_yaml.YAML(typ="safe")
 
-yaml = ruamel_yaml.YAML()
 
-YAML_UNPRINTABLE_RE = re.compile(
-    r"[^\x09\x0A\x0D\x20-\x7E\x85\xA0-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]"
-)
+def __getattr__(name):
+    if name in _RUAMEL_NAMES:
+        _load_ruamel()
+        return globals()[name]
+    if name == "YAML_UNPRINTABLE_RE":
+        return _unprintable_re()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+YAML_UNPRINTABLE = r"[^\x09\x0A\x0D\x20-\x7E\x85\xA0-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]"
+
+
+@functools.lru_cache(None)
+def _unprintable_re():
+    # Compiling the wide character class is slow enough to matter at startup
+    return re.compile(YAML_UNPRINTABLE)
 
 
 def _escape_unprintable_yaml_chars(text):
@@ -39,7 +85,7 @@ def _escape_unprintable_yaml_chars(text):
         else:
             return f"\\U{codepoint:08X}"
 
-    return YAML_UNPRINTABLE_RE.sub(replace, text)
+    return _unprintable_re().sub(replace, text)
 
 
 def pss(item):
@@ -57,24 +103,46 @@ def pss(item):
             item[key] = pss(val)
         return item
     elif isinstance(item, str) and "\n" in item:
-        if YAML_UNPRINTABLE_RE.search(item):
+        if _unprintable_re().search(item):
             item = _escape_unprintable_yaml_chars(item)
+        _load_ruamel()
         return PreservedScalarString(item)
     else:
         return item
 
 
-# Note debug()that this will *still* not show with `--debug` since CLI hasn't
-# been parsed. Set NOTEFILE_DEBUG to see it
-yaml_safe = ruamel_yaml.YAML(typ="safe")
+def dump(data, stream):
+    """Dump `data` to `stream` with the round-trip `yaml`. Safe to call from threads."""
+    _load_ruamel()
+    with _lock:
+        yaml.dump(data, stream)
 
 
 def load_ruamel_yaml(txt):
-    return yaml_safe.load(txt)
+    _load_ruamel()
+    with _lock:
+        return yaml_safe.load(txt)
+
 
+_loader = None
 
-try:
-    import yaml as pyyaml
+
+def load_yaml(txt):
+    """Load YAML text with pyyaml (CSafeLoader if possible) or ruamel_yaml"""
+    global _loader
+    if _loader is None:
+        _loader = _get_loader()
+    return _loader(txt)
+
+
+def _get_loader():
+    # Note that debug() will *still* not show with `--debug` since CLI hasn't
+    # been parsed. Set NOTEFILE_DEBUG to see it
+    try:
+        import yaml as pyyaml
+    except ImportError:
+        debug("no pyyaml. Fallback to ruamel_yaml to load")
+        return load_ruamel_yaml
 
     debug("loaded pyyaml")
     try:
@@ -85,17 +153,17 @@ try:
         debug("no CSafeLoader")
         from yaml import SafeLoader
 
-    def load_yaml(txt):
+    def load_pyyaml(txt):
         """pyyaml loader"""
         return pyyaml.load(txt, Loader=SafeLoader)
 
-except ImportError:
-    debug("no pyyaml. Fallback to ruamel_yaml to load")
-    load_yaml = load_ruamel_yaml
+    return load_pyyaml
 
 
 def yamltxt(data):
     """Serialize a Python object to YAML text using the configured dumper."""
+    data = pss(data)
+    _load_ruamel()
     with io.StringIO() as stream:
-        yaml.dump(pss(data), stream)
+        dump(data, stream)
         return stream.getvalue()
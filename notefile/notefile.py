@@ -4,9 +4,10 @@ import io
 import json
 import os
 import shlex
-import shutil
 import stat
 import sys
+import threading
+import time
 import warnings
 from pathlib import Path
 
@@ -21,13 +22,16 @@ from . import (
     SAFE_QUERY,
     SUBDIR,
     __version__,
+    cache,
     debug,
-    find,
+    fs,
+    nfjson,
+    nfyaml,
+    profiling,
     warn,
 )
-from .nfyaml import load_yaml, pss, ruamel_yaml, yaml, yamltxt
-from .safe_eval import SafeEvalError, safe_eval
-from .utils import Bunch, flattenlist, normalize_tags, now_string, sha256, tmpfileinpath
+from .nfyaml import load_yaml, pss, yamltxt
+from .utils import Bunch, flattenlist, normalize_tags, now_string, tmpfileinpath
 
 TARGET_TYPE_FIELD = "target-type"
 DIR_SUBDIRS_FIELD = "dir-subdirs"
@@ -51,6 +55,47 @@ _TESTEDIT = False  # Only used in testing
 
 DEFERRED_HASH = "**NOT YET COMPUTED**"
 
+# Parsed data by note text (a `utils.LRU`) so that a long-running process such as
+# `notefile serve` does not parse unchanged notes again. `None` to not keep them.
+PARSED = None
+
+
+def _parse(txt):
+    """Parse note text. Return `(data, format)`. Uses (and fills) `PARSED` if set."""
+    parsed = PARSED.get(txt) if PARSED is not None else None
+    if parsed is None:
+        t0 = time.perf_counter() if profiling.ENABLED else None
+        try:
+            parsed = nfjson.loads(txt), "json"
+        except nfjson.JSONDecodeError:
+            parsed = load_yaml(txt), "yaml"  # Including the JSON attempt
+        if profiling.ENABLED:
+            profiling.add("parse." + parsed[1], time.perf_counter() - t0)
+        if PARSED is not None:
+            PARSED.put(txt, parsed)
+    data, fmt = parsed
+    return (_snapshot(data) if PARSED is not None else data), fmt
+
+
+# Types of parsed note values that cannot be modified in place
+_ATOMIC = frozenset({str, int, float, bool, type(None), bytes})
+
+
+def _snapshot(data):
+    """Copy parsed note data for comparison later.
+
+    Only the dicts and lists are copied. The values in them are immutable and
+    are shared so, unlike `copy.deepcopy()`, large text costs nothing to copy.
+    Anything else (rare, e.g., a YAML set) is deep copied.
+    """
+    if isinstance(data, dict):
+        return {key: _snapshot(val) for key, val in data.items()}
+    if isinstance(data, list):
+        return [_snapshot(val) for val in data]
+    if type(data) in _ATOMIC:
+        return data
+    return copy.deepcopy(data)
+
 
 def _reject_special_target_path(filename):
     """Reject `.` and `..` as note targets."""
@@ -61,7 +106,7 @@ def _reject_special_target_path(filename):
 
 def _target_exists(path):
     """Return true when a path exists or is a symlink, even if broken."""
-    return os.path.exists(path) or os.path.islink(path)
+    return fs.lexists(path)
 
 
 def _join_for_hash(items):
@@ -74,14 +119,19 @@ def directory_info(path):
 
     The hash and counts track only immediate children, matching `os.listdir()`.
     """
-    entries = sorted(os.listdir(path))
+    with fs.scandir(path) as it:
+        listed = sorted(it, key=lambda entry: entry.name)
+    entries = [entry.name for entry in listed]
     subdirs = 0
     files = 0
-    for entry in entries:
-        full = os.path.join(path, entry)
-        if os.path.isdir(full):
+    for entry in listed:
+        try:
+            isdir = entry.is_dir()  # Follows links like os.path.isdir
+        except OSError:
+            isdir = False
+        if isdir:
             subdirs += 1
-        elif not entry.endswith(NOTESEXT):
+        elif not entry.name.endswith(NOTESEXT):
             files += 1
 
     import hashlib
@@ -126,6 +176,10 @@ class Notefile:
     note_field [NOTEFIELD]
         The field for reading and writing notes
 
+    readonly [False]
+        Do not keep a copy of the data as read. Saves time and memory for notes
+        that are only read (e.g., searches and exports) but cannot be written
+
     Notable Attributes:
     -------------------
     Any attribute with 0 is the original. The version without 0 is the refferent
@@ -171,6 +225,7 @@ class Notefile:
     Most methods also return itself for convenience
     """
 
+    @profiling.timed("note.init")
     def __init__(
         self,
         filename,
@@ -181,6 +236,8 @@ class Notefile:
         link="both",
         hashfile=True,
         note_field=NOTEFIELD,
+        readonly=False,
+        _listing=None,
     ):
         """Create a note wrapper around a target file or directory.
 
@@ -202,6 +259,11 @@ class Notefile:
             Track SHA-256 for file targets.
         note_field:
             Field name used for the primary note body.
+        readonly:
+            Do not keep a copy of the data as read to tell whether it changed.
+            `ismod()` and `write()` then raise `ValueError`.
+        _listing:
+            Internal. See `from_listing()`.
         """
         ## Notation:
         #   _0 names re the original file for a link (or when 'symlink' mode).
@@ -209,6 +271,7 @@ class Notefile:
         self.hashfile = hashfile
         self.link = link
         self.note_field = note_field
+        self.readonly = readonly
         # _0 is specified format. NOT actual format which will get reset
         self.format = self.format0 = format.lower()
         self.rewrite_format = rewrite_format
@@ -226,7 +289,15 @@ class Notefile:
         # Cache the first note-location probe. For ordinary files, the active
         # target does not change below, and find() constructs many Notefile
         # objects without reading note contents.
-        initial_note_location = hidden_chooser(self.names, hidden=hidden, subdir=subdir)
+        # With a directory listing (from find), existence comes from the listing
+        # rather than probing the filesystem.
+        listed = _listing_lookup(self.names, _listing) if _listing is not None else None
+        initial_note_location = hidden_chooser(
+            self.names,
+            hidden=hidden,
+            subdir=subdir,
+            exists=(lambda path: listed(path) is not None) if listed else exists_or_link,
+        )
         self.destnote0, self.exists0, self.is_hidden0, self.is_subdir0 = initial_note_location
 
         ## Handle links. If both or source, reset to the referent if the link
@@ -235,12 +306,17 @@ class Notefile:
             raise ValueError("'link' must be in {'both','symlink','source'}")
 
         # Be False even if link for 'symlink' mode
-        self.islink = os.path.islink(self.names.filename) and link in {"both", "source"}
+        if listed:
+            entry = listed(self.names.filename)
+            self.islink = entry is not None and entry.is_symlink()
+        else:
+            self.islink = fs.islink(self.names.filename)
+        self.islink = self.islink and link in {"both", "source"}
 
         if self.islink:
             # Edge Case: Note created in symlink mode but isn't being modified
             # as such. Change to that
-            if os.path.isfile(self.destnote0) and not os.path.islink(self.destnote0):
+            if fs.isfile(self.destnote0) and not fs.islink(self.destnote0):
                 warn(
                     f"Linked file ({repr(self.names0.filename)}) has conflicting notes. "
                     "Changing to 'symlink' mode"
@@ -248,7 +324,7 @@ class Notefile:
                 self.islink = False
                 self.link == "symlink"
             else:
-                self.dest0 = os.readlink(self.names.filename)
+                self.dest0 = fs.readlink(self.names.filename)
                 dest = os.path.join(os.path.dirname(self.names.filename), self.dest0)
                 self.names = get_filenames(dest)  # reset this
 
@@ -268,9 +344,17 @@ class Notefile:
         self.filename = self.names.filename
         self.filename0 = self.names0.filename
 
-        self.target_type0, target_exists0 = self._detect_target_type_and_exists(
-            self.names0.filename
-        )
+        if listed and not self.islink:
+            entry = listed(self.names0.filename)
+            if entry is not None:
+                self.target_type0, target_exists0 = ("dir" if entry.is_dir() else "file"), True
+            else:
+                self.target_type0 = "dir" if self._requested_dir else "file"
+                target_exists0 = False
+        else:
+            self.target_type0, target_exists0 = self._detect_target_type_and_exists(
+                self.names0.filename
+            )
         # Same target path means the target type and original-target existence
         # checks can share the stat result collected above.
         if self.names.filename == self.names0.filename:
@@ -286,23 +370,21 @@ class Notefile:
         self.orphaned = not target_exists0
 
         self.txt = None
+        self._raw = None
         self._data = None
         self._write_count = 0
+        self._from_cache = False
 
     def _detect_target_type(self, filename):
         """Infer whether a target path should be treated as a file or directory."""
-        if os.path.isdir(filename):
-            return "dir"
-        if not _target_exists(filename) and self._requested_dir:
-            return "dir"
-        return "file"
+        return self._detect_target_type_and_exists(filename)[0]
 
     def _detect_target_type_and_exists(self, filename):
         """Infer target type and existence using one filesystem stat when possible."""
         try:
-            st = os.stat(filename)
+            st = fs.stat(filename)
         except OSError:
-            if os.path.islink(filename):
+            if fs.islink(filename):
                 return "file", True
             if self._requested_dir:
                 return "dir", False
@@ -330,17 +412,15 @@ class Notefile:
         """Resolve the best available target type for the source and active target."""
         persisted = self._persisted_target_type()
 
-        if _target_exists(self.names0.filename):
-            actual0 = self._detect_target_type(self.names0.filename)
+        actual0, exists0 = self._detect_target_type_and_exists(self.names0.filename)
+        if exists0:
             if persisted and persisted != actual0:
                 self._warn_target_type_mismatch(persisted, actual0, self.names0.filename)
             return actual0, actual0
 
-        actual = (
-            self._detect_target_type(self.names.filename)
-            if _target_exists(self.names.filename)
-            else None
-        )
+        actual, exists = self._detect_target_type_and_exists(self.names.filename)
+        if not exists:
+            actual = None
         if actual:
             if persisted and persisted != actual:
                 self._warn_target_type_mismatch(persisted, actual, self.names.filename)
@@ -367,27 +447,25 @@ class Notefile:
             data[TARGET_TYPE_FIELD] = "dir"
             return data
 
-        stat = os.stat(self.names.filename)
+        stat = fs.stat(self.names.filename)
         data = {"filesize": stat.st_size, "mtime": stat.st_mtime, TARGET_TYPE_FIELD: "file"}
         if self.hashfile:
             data["sha256"] = DEFERRED_HASH
         return data
 
+    @profiling.timed("note.read")
     def read(self):
-        """Read the note file, normalize its data, and cache the original state."""
-        if self.exists:
-            debug("loading {}".format(self.destnote))
-            try:
-                self.txt = Path(self.destnote).read_text()
-            except FileNotFoundError:
-                self.txt = self._read_from_broken_link_from_hide()
-            try:
-                self._data = json.loads(self.txt)
-                self.format = "json"
-            except json.JSONDecodeError:
-                self._data = load_yaml(self.txt)
-                self.format = "yaml"
+        """Read the note file, normalize its data, and cache the original state.
+
+        When the note cache is enabled, a cached record is trusted and the note
+        file is not opened. A miss falls back to disk and repopulates the cache.
+        """
+        if self.exists and self._read_from_cache():
+            return self
 
+        if self.exists:
+            self.txt, self._raw = self.read_raw(), None
+            self._data, self.format = _parse(self.txt)
             self._data.pop("__comment", None)
         else:
             debug("New notefile")
@@ -396,7 +474,7 @@ class Notefile:
                 self._data.update(self._target_metadata())
                 self.txt = self.writes()
             except Exception as E:
-                if os.path.islink(self.names0.filename):
+                if fs.islink(self.names0.filename):
                     warn(
                         f"{repr(self.names0.filename)} is a broken link to {repr(self.names.filename)}."
                     )
@@ -436,12 +514,228 @@ class Notefile:
         self._data = Bunch(**self._data)
         self._refresh_target_type_flags()
 
-        # Make a copy for compare later. Use deep copy in case mutable
-        # objects are modified
-        self._data0 = copy.deepcopy(self._data)
+        self._track()
+
+        if self.exists:
+            cache.store(self)
 
         return self  # for convenience
 
+    def read_raw(self):
+        """Return the raw note text without parsing it. `None` for a new note.
+
+        The text is kept for the next `read()` so a note that passes a raw-text
+        test (see `SearchFilter.prefilter()`) is not opened twice.
+        """
+        if not self.exists:
+            return None
+        if self._raw is None:
+            debug("loading {}".format(self.destnote))
+            try:
+                with profiling.stage("read.io"):
+                    self._raw = Path(self.destnote).read_text()
+            except FileNotFoundError:
+                self._raw = self._read_from_broken_link_from_hide()
+        return self._raw
+
+    def _read_from_cache(self):
+        """Load data from a trusted cache record. Return whether it was a hit."""
+        db = cache.reader()
+        if db is None:
+            return False
+        try:
+            record = db.get(self.destnote0)
+        except Exception as E:
+            warn(f"Could not read cache: {E}")
+            return False
+        if record is None:
+            return False
+        state = record["state"]
+        if state.get("note_field") != self.note_field or state.get("link") != self.link:
+            return False  # Reconstructed data depends on these. Fail closed
+        debug(f"cache hit {self.destnote0}")
+        profiling.count("cache.hit")
+        self._load_record(record)
+        return True
+
+    def _load_record(self, record):
+        """Finish a read from a cache (or parallel-read) record. Internal."""
+        self._load_cache_record(record)
+        self._refresh_target_type_flags()
+        self._track()
+
+    def _track(self):
+        """Keep a copy of the data as read for `ismod()` unless read-only."""
+        self._data0 = None if self.readonly else _snapshot(self._data)
+
+    def _load_cache_record(self, record):
+        """Populate note data and text from a cache record."""
+        self._data = Bunch(**record["data"])
+        self.txt = record["text"]
+        self.format = record["state"]["format"]
+
+    def _to_cache_record(self):
+        """Return the cache record for this note. Internal.
+
+        Raises `cache.CacheRecordError` when the note cannot be cached faithfully,
+        e.g. YAML data (dates, non-string keys) that does not round-trip via JSON.
+        """
+        if not self.exists:
+            raise cache.CacheRecordError("note does not exist")
+        if self._data is None:
+            raise cache.CacheRecordError("note has not been read")
+        data = dict(self._data)
+        if not cache._jsonable(data):
+            raise cache.CacheRecordError("data is not JSON round-trippable")
+
+        abspath = os.path.abspath
+        state = dict(
+            filename=abspath(self.filename),
+            filename0=abspath(self.filename0),
+            destnote=abspath(self.destnote),
+            destnote0=abspath(self.destnote0),
+            exists=self.exists,
+            exists0=self.exists0,
+            is_hidden=self.is_hidden,
+            is_hidden0=self.is_hidden0,
+            is_subdir=self.is_subdir,
+            is_subdir0=self.is_subdir0,
+            islink=self.islink,
+            dest0=getattr(self, "dest0", None),
+            link=self.link,
+            target_type=self.target_type,
+            target_type0=self.target_type0,
+            orphaned=self.orphaned,
+            format=self.format,
+            note_field=self.note_field,
+        )
+        return dict(
+            canonical_note_path=state["destnote0"],
+            primary_target_path=state["filename0"],
+            aliases=sorted({state["destnote0"], state["filename0"]}),
+            state=state,
+            data=data,
+            text=self.txt,
+        )
+
+    @classmethod
+    def from_listing(cls, filename, listing, **noteopts):
+        """Construct a note using a directory listing rather than probing the filesystem.
+
+        Parameters
+        ----------
+        filename:
+            Note or target path in the listed directory.
+        listing:
+            `(entries, subentries)` for the directory containing the target where
+            `entries` maps names to `os.DirEntry` objects and `subentries` maps
+            '_notefiles' and '.notefiles' (if present) to their own such mapping.
+            This is what `find()`'s walker produces.
+        **noteopts:
+            The usual `Notefile` constructor options.
+
+        Notes
+        -----
+        Symlinked targets still probe the link's referent.
+        """
+        return cls(filename, _listing=listing, **noteopts)
+
+    @classmethod
+    def from_cache_record(cls, record, rebase=None, **noteopts):
+        """Reconstruct a note from a cache record without touching the filesystem.
+
+        Internal. Used by cache-backed `find()`.
+
+        Parameters
+        ----------
+        record:
+            Record returned by the cache.
+        rebase:
+            Optional callable applied to the stored absolute paths, e.g. to make
+            them relative like a filesystem walk would.
+        **noteopts:
+            The usual `Notefile` constructor options.
+        """
+        opts = dict(
+            hidden=HIDDEN,
+            subdir=SUBDIR,
+            format=FORMAT,
+            rewrite_format=False,
+            link="both",
+            hashfile=True,
+            note_field=NOTEFIELD,
+            readonly=False,
+        )
+        opts.update(noteopts)
+
+        state = record["state"]
+        if state.get("note_field") != opts["note_field"] or state.get("link") != opts["link"]:
+            raise cache.CacheRecordError("record does not match note options")
+
+        rebase = rebase or (lambda path: path)
+
+        self = cls.__new__(cls)
+        self.hashfile = opts["hashfile"]
+        self.link = opts["link"]
+        self.note_field = opts["note_field"]
+        self.readonly = opts["readonly"]
+        self.format = self.format0 = opts["format"].lower()
+        self.rewrite_format = opts["rewrite_format"]
+        self.hidden, self.subdir = opts["hidden"], opts["subdir"]
+        self._requested_dir = False
+
+        try:
+            self.filename = rebase(state["filename"])
+            self.filename0 = rebase(state["filename0"])
+            self.destnote = rebase(state["destnote"])
+            self.destnote0 = rebase(state["destnote0"])
+            self.names = get_filenames(self.filename)
+            self.names0 = get_filenames(self.filename0)
+            for attr in [
+                "exists",
+                "exists0",
+                "is_hidden",
+                "is_hidden0",
+                "is_subdir",
+                "is_subdir0",
+                "islink",
+                "target_type",
+                "target_type0",
+                "orphaned",
+            ]:
+                setattr(self, attr, state[attr])
+        except KeyError as E:
+            raise cache.CacheRecordError(f"record is missing {E}")
+
+        if state.get("dest0") is not None:
+            self.dest0 = state["dest0"]
+        self.isdir0 = self.target_type0 == "dir"
+        self.isfile0 = self.target_type0 == "file"
+        self.isdir = self.target_type == "dir"
+        self.isfile = self.target_type == "file"
+
+        self._write_count = 0
+        self._from_cache = True
+        if "data" in record:
+            self._load_cache_record(record)
+            self._track()
+        else:  # Lazy. Loaded from the cache by read() when accessed
+            self._data = self.txt = None
+        self._raw = None
+        return self
+
+    def _recache_moved(self, newnote):
+        """Replace the cache record for this note after it was moved to `newnote`."""
+        fs.invalidate(self.destnote0, newnote, os.path.dirname(newnote))
+        if cache.writer() is None:
+            return
+        cache.discard(self.destnote0)
+        cache.discard(newnote)  # In case of a stale record
+        try:
+            Notefile(newnote, link=self.link, note_field=self.note_field).read()
+        except Exception as E:
+            warn(f"Could not update cache for {newnote!r}: {E}")
+
     @property
     def data(self):
         """Access the note data, loading it lazily on first use."""
@@ -456,6 +750,7 @@ class Notefile:
         debug("data setter")
         self._data = data
 
+    @profiling.timed("serialize")
     def writes(self, format=None, compute_sha256=False):
         """Serialize the current note state to YAML or JSON text.
 
@@ -482,11 +777,7 @@ class Notefile:
         self.data[TARGET_TYPE_FIELD] = "dir" if self.isdir else "file"
 
         if compute_sha256 and self.isfile and self.data.get("sha256", "") == DEFERRED_HASH:
-            self.data["sha256"] = sha256(self.names.filename)
-
-        data = pss(self.data)  # Will recurse into lists and dicts too
-        data["last-updated"] = now_string()
-        data["notefile version"] = __version__
+            self.data["sha256"] = cache.sha256(self.names.filename)
 
         if not format:
             format = self.format0 if self.rewrite_format else self.format
@@ -494,23 +785,31 @@ class Notefile:
         if format.lower() not in {"json", "yaml"}:
             warn(f"Unsupported format '{self.format}'. Using 'yaml'")
 
+        if format.lower() == "json":
+            data = dict(self.data)  # Multiline strings need no special handling
+        else:
+            data = pss(self.data)  # Will recurse into lists and dicts too
+        data["last-updated"] = now_string()
+        data["notefile version"] = __version__
+
         if format.lower() == "json":
             _d = {"__comment": f"JSON Formatted notes created with notefile version {__version__}"}
             _d.update(data)
             return json.dumps(_d, indent=1, ensure_ascii=False)
         else:  # the default
-            data = ruamel_yaml.comments.CommentedMap(data)
+            data = nfyaml.ruamel_yaml.comments.CommentedMap(data)
             data.yaml_set_start_comment(
                 f"YAML Formatted notes created with notefile version {__version__}"
             )
 
             with io.StringIO() as stream:
-                yaml.dump(data, stream)
+                nfyaml.dump(data, stream)
                 debug(f"yaml dumped {self.destnote}")
                 return stream.getvalue()
 
     dumps = writes
 
+    @profiling.timed("note.write")
     def write(self, force=False):
         """Write the note to disk atomically.
 
@@ -526,6 +825,8 @@ class Notefile:
         rebuilt.
         """
 
+        if self.readonly:
+            raise ValueError(f"Cannot write read-only note {self.destnote0!r}")
         if not force and not self.ismod():
             debug("Note not modified. Not saving")
             self.make_links()  # Rebuild the links in case they were broken
@@ -534,16 +835,19 @@ class Notefile:
         txt = self.txt = self.writes(compute_sha256=True)
 
         # Make the write atomic
-        tmpfile = Path(self.destnote).with_suffix(".yaml.swp")
-        tmpfile.parent.mkdir(exist_ok=True, parents=True)
-        tmpfile.write_text(txt)
-        tmpfile.rename(self.destnote)
+        with profiling.stage("write.io"):
+            tmpfile = Path(self.destnote).with_suffix(".yaml.swp")
+            tmpfile.parent.mkdir(exist_ok=True, parents=True)
+            tmpfile.write_text(txt)
+            tmpfile.rename(self.destnote)
+        fs.invalidate(tmpfile, self.destnote, tmpfile.parent)
         debug(f"Wrote {self.destnote}")
 
         self.make_links()
 
         self._write_count += 1
         self.exists = True
+        cache.store(self)
         return self  # for convenience
 
     save = dump = write
@@ -633,6 +937,8 @@ class Notefile:
         """Return whether the note has diverged from the last-read state."""
         # Will do a dictionary compare at the end so pop() certain keys before
         # we get to that. Since we're removing then, make a copy
+        if self.readonly:
+            raise ValueError(f"{self.destnote0!r} is read-only")
         if not hasattr(self, "_data0"):
             return True
 
@@ -665,6 +971,7 @@ class Notefile:
                 pass
 
             os.symlink(linkpath, linknote)
+            fs.invalidate(linknote)
 
     def interactive_edit(self, full=False, manual=False, tags_only=False):
         """Open the note in an editor without saving automatically.
@@ -840,7 +1147,7 @@ class Notefile:
         if desired_destnote == self.destnote0:
             return False  # Do nothing
 
-        if os.path.exists(desired_destnote):
+        if fs.exists(desired_destnote):
             warn(
                 f"Both source and dest notes exist for {repr(self.names.filename)}. Not changing mode"
             )
@@ -849,11 +1156,14 @@ class Notefile:
         if dry_run:
             return True
 
+        import shutil
+
         Path(desired_destnote).parent.mkdir(exist_ok=True, parents=True)
         try:
             shutil.move(self.destnote0, desired_destnote)
         except (OSError, IOError) as E:
             warn(f"Error on move '{src_note}' to '{dst_note}'. Error: {E}")
+        self._recache_moved(desired_destnote)
 
         # Change attributes for this now
         self.is_hidden = mode == "hide"
@@ -885,7 +1195,7 @@ class Notefile:
 
         return True
 
-    def repair_metadata(self, dry_run=False, force=False):
+    def repair_metadata(self, dry_run=False, force=False, defer_hash=False):
         """Refresh tracked metadata for the target if it has drifted.
 
         Parameters
@@ -894,6 +1204,9 @@ class Notefile:
             Report whether a repair is needed without mutating the note.
         force:
             Recompute tracked metadata even when the stored values still match.
+        defer_hash:
+            Mark the SHA-256 as deferred rather than computing it. It is then
+            computed on `write()` or by `hashing.HashPool.resolve_deferred()`.
 
         Notes
         -----
@@ -901,7 +1214,9 @@ class Notefile:
         `write()`.
         """
         # This is designed to be called before reading, etc for orphaned
-        if not os.path.exists(self.names.filename):
+        try:
+            stat = fs.stat(self.names.filename)
+        except OSError:
             warn(f"File {repr(self.names.filename)} is orphaned or link is broken")
             return
 
@@ -915,8 +1230,6 @@ class Notefile:
                 return True
             return False
 
-        stat = os.stat(self.names.filename)
-
         if not dry_run and (self._isbroken_broken_from_hide() or force):
             self.make_links()
 
@@ -931,7 +1244,9 @@ class Notefile:
             self.data["filesize"] = stat.st_size
             self.data["mtime"] = stat.st_mtime
             if self.hashfile:
-                self.data["sha256"] = sha256(self.names.filename)
+                self.data["sha256"] = (
+                    DEFERRED_HASH if defer_hash else cache.sha256(self.names.filename)
+                )
 
             return True
 
@@ -953,8 +1268,9 @@ class Notefile:
         """Relocate an orphaned note by searching for a matching target.
 
         File targets always match on size first, then optionally on modification
-        time, file hash, and basename. Directory targets delegate to
-        `_repair_orphaned_dir()`.
+        time, file hash, and basename. Directory targets match on shallow
+        directory metadata. To repair many notes, use
+        `notefile.repair.repair_orphaned()`, which walks the search path once.
 
         Returns
         -------
@@ -966,152 +1282,24 @@ class Notefile:
         File targets always match size first. Optional filters then refine by
         mtime, file hash, and basename.
         """
-        from .find import find
-
-        if self.exists and self._data is None:
-            self.read()
-
-        self._refresh_target_type_flags()
-
-        if self.isdir:
-            return self._repair_orphaned_dir(
-                mtime=mtime,
-                name=name,
-                dry_run=dry_run,
-                search_path=search_path,
-                search_excludes=search_excludes,
-                search_matchcase=search_matchcase,
-                search_maxdepth=search_maxdepth,
-                search_one_file_system=search_one_file_system,
-                search_exclude_links=search_exclude_links,
-            )
-
-        if filehash and len(self.data.get("sha256", "")) != 64:  # not a computed hash
-            warn(f"Cannot repair {self.names.filename} based on hash since it's missing")
-            return
-
-        files = find(
-            path=search_path,
-            excludes=search_excludes,
-            matchcase=search_matchcase,
-            maxdepth=search_maxdepth,
-            one_file_system=search_one_file_system,
-            exclude_links=search_exclude_links,
-            filemode=True,
+        from .repair import repair_orphaned
+
+        ((_, newnote),) = repair_orphaned(
+            [self],
+            mtime=mtime,
+            filehash=filehash,
+            name=name,
+            dry_run=dry_run,
+            search_path=search_path,
+            search_excludes=search_excludes,
+            search_matchcase=search_matchcase,
+            search_maxdepth=search_maxdepth,
+            search_one_file_system=search_one_file_system,
+            search_exclude_links=search_exclude_links,
         )
-
-        basename = os.path.basename(self.names0.filename)
-
-        candidates = []
-        for file in files:
-            # do the tests in order of simplicity to compute
-            if name and basename != os.path.basename(file):
-                continue  # save the stat call
-
-            try:
-                stat = os.stat(file)
-            except FileNotFoundError:
-                continue  # likely a broken link
-
-            if stat.st_size != self.data.filesize:
-                continue
-            if mtime and abs(self.data.mtime - stat.st_mtime) > DT:
-                continue
-            if filehash and self.data["sha256"] != sha256(file):
-                continue
-
-            candidates.append(file)
-        if len(candidates) > 1:
-            wtxt = f"{len(candidates)} candidates found for '{self.destnote0}'. Not repairing"
-            wtxt += "\n   ".join([""] + candidates)
-            warn(wtxt)
-            return
-
-        elif len(candidates) == 0:
-            warn(f"No match for '{self.destnote0}'")
-            return
-
-        newfile = candidates[0]
-
-        names = get_filenames(newfile)
-        newnote, *_ = hidden_chooser(names, hidden=self.is_hidden, subdir=self.is_subdir)
-        if os.path.exists(newnote):
-            warn(f"Notefile exists. Not Moving!\n   SRC:{self.destnote0}\n   DST:{newnote}")
-            return
-
-        if not dry_run:
-            shutil.move(self.destnote0, newnote)
-
-        return newnote
-
-    def _repair_orphaned_dir(
-        self,
-        *,
-        mtime=True,
-        name=False,
-        dry_run=False,
-        search_path=".",
-        search_excludes=None,
-        search_matchcase=False,
-        search_maxdepth=None,
-        search_one_file_system=False,
-        search_exclude_links=False,
-    ):
-        """Repair an orphaned directory note by matching shallow directory metadata."""
-        from .find import find
-
-        if len(self.data.get(DIR_HASH_FIELD, "")) != 64:
-            warn(f"Cannot repair {self.names.filename} based on directory hash since it's missing")
-            return
-
-        dirs = find(
-            path=search_path,
-            excludes=search_excludes,
-            matchcase=search_matchcase,
-            maxdepth=search_maxdepth,
-            one_file_system=search_one_file_system,
-            exclude_links=search_exclude_links,
-            filemode=True,
-            targetmode="dir",
-        )
-
-        basename = os.path.basename(self.names0.filename)
-        candidates = []
-        for dirpath in dirs:
-            if name and basename != os.path.basename(dirpath):
-                continue
-            try:
-                info = directory_info(dirpath)
-            except (FileNotFoundError, NotADirectoryError, PermissionError):
-                continue
-
-            if info[DIR_SUBDIRS_FIELD] != self.data.get(DIR_SUBDIRS_FIELD, -1):
-                continue
-            if info[DIR_FILES_FIELD] != self.data.get(DIR_FILES_FIELD, -1):
-                continue
-            if info[DIR_HASH_FIELD] != self.data.get(DIR_HASH_FIELD):
-                continue
-            candidates.append(dirpath)
-
-        if len(candidates) > 1:
-            wtxt = f"{len(candidates)} candidates found for '{self.destnote0}'. Not repairing"
-            wtxt += "\n   ".join([""] + candidates)
-            warn(wtxt)
-            return
-        if len(candidates) == 0:
-            warn(f"No match for '{self.destnote0}'")
-            return
-
-        newdir = candidates[0]
-        names = get_filenames(newdir)
-        newnote, *_ = hidden_chooser(names, hidden=self.is_hidden, subdir=self.is_subdir)
-        if os.path.exists(newnote):
-            warn(f"Notefile exists. Not Moving!\n   SRC:{self.destnote0}\n   DST:{newnote}")
-            return
-        if not dry_run:
-            shutil.move(self.destnote0, newnote)
         return newnote
 
+    @profiling.timed("grep")
     def grep(
         self,
         *expr,
@@ -1120,6 +1308,7 @@ class Notefile:
         full_word=False,
         fixed_strings=False,
         match_any=True,
+        matcher=None,
     ):
         """Search note content with regex or fixed-string matching.
 
@@ -1138,54 +1327,47 @@ class Notefile:
             Escape each pattern before compiling it as a regex.
         match_any:
             Return true when any pattern matches. When false, require all of them.
+        matcher:
+            A precompiled `search.GrepMatcher` to use instead of `expr` and the
+            matching options above. Otherwise, compiled expressions are cached
+            by pattern and options.
 
         Returns
         -------
         bool
             Whether the note content matches according to the configured mode.
         """
-        import re
-
-        flags = re.MULTILINE | re.UNICODE
-        if not matchcase:
-            flags |= re.IGNORECASE
-
-        expr = list(flattenlist(expr))  # will make  a list of all strings
-
-        if fixed_strings:
-            expr = [re.escape(e) for e in expr]
-
-        if full_word:
-            expr = [r"\b" + e + r"\b" for e in expr]
-
-        # For all, you need individual regexes but for any, can make a single one
-        if match_any:
-            requery = re.compile("|".join(expr), flags=flags)
-            query = lambda qtext: bool(requery.search(qtext))
-        else:
-            requeries = [re.compile(e, flags=flags) for e in expr]
-            query = lambda qtext: all(r.search(qtext) for r in requeries)
+        if matcher is None:
+            from .search import grep_matcher
+
+            matcher = grep_matcher(
+                expr,
+                matchcase=matchcase,
+                full_word=full_word,
+                fixed_strings=fixed_strings,
+                match_any=match_any,
+            )
 
         if not self._data:
             # To speed this up grep the raw text first before even trying to parse the
             # note. This is a double search but is almost certainly faster than always
             # parsing and only done if we didn't read already
             txt = getattr(self, "txt", None)
-            if txt and not query(txt):
+            if txt and not matcher(txt):
                 return False
             self.read()
 
         txt = self.txt
 
         if full_note:
-            return query(txt)
+            return matcher(txt)
 
         qtext = self.data.get(self.note_field, "")
         if not isinstance(qtext, str):
             debug("Note is {}. Converting to string".format(str(type(qtext))))
             qtext = str(qtext)  # Make it a string
 
-        return query(qtext)
+        return matcher(qtext)
 
     def unsafe_query(self, *expr, allow_exception=False, match_any=True, **kwargs):
         """Evaluate legacy Python queries against the note.
@@ -1295,83 +1477,14 @@ class Notefile:
         -------
         bool
             Whether the note matches according to the requested query mode.
-        """
-        if DISABLE_QUERY:
-            raise ValueError("Query is disabled")
 
-        import re
-        from functools import partial
-
-        expr = list(flattenlist(expr))  # will make  a list of all strings
-
-        ns = {
-            "re": re,
-            "ss": shlex.split,
-            "data": self.data,
-            "tags": frozenset(normalize_tags(self.data.get("tags", []), sort=False)),
-            "notes": self.data.get(self.note_field, ""),
-            "text": getattr(self, "txt", ""),
-            "filename": self.names0.filename,
-            "notefile_path": self.destnote,
-            "isdir": self.isdir0,
-            "isfile": self.isfile0,
-        }
-
-        ns["grep"] = functools.partial(self.grep, match_any=match_any, **kwargs)
-        ns["g"] = ns["grep"]
-        ns["gall"] = functools.partial(self.grep, match_any=False, **kwargs)
-        ns["gany"] = functools.partial(self.grep, match_any=True, **kwargs)
-
-        # Note that these get normalized which includes flattening them
-        ns["tany"] = lambda *tags: any(t.lower() in ns["tags"] for t in normalize_tags(tags))
-        ns["tall"] = lambda *tags: all(t.lower() in ns["tags"] for t in normalize_tags(tags))
-        ns["t"] = ns["tany"]
-        ns["norm_tags"] = normalize_tags
-
-        allowed_callables = {
-            ns["grep"],
-            ns["g"],
-            ns["gall"],
-            ns["gany"],
-            ns["tany"],
-            ns["tall"],
-            ns["t"],
-            ns["ss"],
-            ns["norm_tags"],
-        }
-
-        for expri in expr:
-            try:
-                r = bool(
-                    safe_eval(expri, ns, allowed_callables=allowed_callables, allowed_modules={re})
-                )
-            except SafeEvalError as E:
-                etxt = 'Query error: {}. Note: "{}"'.format(str(E), self.names0.filename)
-                if allow_exception:
-                    warn("Query Error: {}".format(etxt))
-                    r = False
-                else:
-                    raise QueryError(etxt)
-            except Exception as E:
-                etxt = 'Query runtime error: {}. Note: "{}"'.format(
-                    E.__class__.__name__, self.names0.filename
-                )
-                if allow_exception:
-                    warn("Query Error: {}".format(etxt))
-                    r = False
-                else:
-                    raise QueryError(etxt)
-
-            # Short circuit
-            if not match_any:
-                if not r:
-                    return False
-            else:
-                if r:
-                    return True
-
-        # At this point, we either hit them all with ALL, we hit none with ANY
-        return not match_any
+        Notes
+        -----
+        Compiled queries are reused for repeated expressions. See `NoteQuery`.
+        """
+        expr = tuple(flattenlist(expr))
+        kwargs = tuple(sorted(kwargs.items()))
+        return _notequery(expr, allow_exception, match_any, kwargs)(self)
 
     query = safe_query
 
@@ -1381,11 +1494,11 @@ class Notefile:
             return False
 
         # Is it a link and is it NOT broken (is a file)
-        if os.path.islink(self.destnote0) and os.path.isfile(self.destnote0):
+        if fs.islink(self.destnote0) and fs.isfile(self.destnote0):
             return False
 
         # Finally make sure the *correct* dest exists:
-        if not os.path.isfile(self.destnote):
+        if not fs.isfile(self.destnote):
             return False  # Still broken but not repairable
 
         return True
@@ -1397,7 +1510,7 @@ class Notefile:
                 break
         else:
             raise FileNotFoundError(f"Cannot find {repr(self.destnote)}")
-        for linkdest in get_filenames(os.readlink(destnote))[1:]:
+        for linkdest in get_filenames(fs.readlink(destnote))[1:]:
             if exists_or_link(linkdest):
                 break
         else:
@@ -1461,14 +1574,17 @@ def get_filenames(filename):
     )
 
 
-def hidden_chooser(names, *, hidden, subdir):
+def hidden_chooser(names, *, hidden, subdir, exists=None):
     """Choose the active notefile path for a target.
 
     Existing note locations take precedence over the requested layout. The
     return value is `(path, exists, is_hidden, is_subdir)`, where the layout
     flags reflect either the discovered note or the requested destination when
-    no note exists yet.
+    no note exists yet. `exists` optionally replaces `exists_or_link()` as the
+    existence test.
     """
+    exists = exists or exists_or_link
+
     # Set the order to test based on hidden and subdir
     # but note that hidden is considered priority over subdir
     if hidden and subdir:
@@ -1490,7 +1606,7 @@ def hidden_chooser(names, *, hidden, subdir):
     found = []
 
     for testfile in testfiles:
-        if exists_or_link(testfile):
+        if exists(testfile):
             is_hidden, is_subdir = lookup[testfile]
             found.append((testfile, True, is_hidden, is_subdir))
 
@@ -1505,6 +1621,180 @@ def hidden_chooser(names, *, hidden, subdir):
     return testfiles[0], False, hidden, subdir  # Return the first one and does not exists
 
 
+def _listing_lookup(names, listing):
+    """Return a function mapping a path in the listed directory to its entry or `None`.
+
+    `names` are from `get_filenames()` and `listing` as in `Notefile.from_listing()`.
+    """
+    entries, subentries = listing
+    base = os.path.dirname(names.filename)
+
+    def lookup(path):
+        parent, name = os.path.split(path)
+        if parent == base:
+            return entries.get(name)
+        subname = os.path.basename(parent)
+        if os.path.dirname(parent) == base and subname in {"_notefiles", ".notefiles"}:
+            return subentries.get(subname, {}).get(name)
+        raise ValueError(f"{path!r} is not in the listing for {base!r}")
+
+    return lookup
+
+
 def exists_or_link(filename):
     """Return true for existing paths and broken symlinks alike."""
     return _target_exists(filename)
+
+
+class NoteQuery:
+    """Safe query expressions compiled once and evaluated against many notes.
+
+    Parameters
+    ----------
+    *expr:
+        One or more query expressions. Nested iterables are flattened.
+    allow_exception:
+        Convert query failures into warnings and a false result.
+    match_any:
+        Return true when any expression matches. When false, require all.
+    **kwargs:
+        Additional grep options exposed to query helpers such as `grep()`.
+
+    Notes
+    -----
+    Call with a note to evaluate it. The query helpers (`grep()`, `t()`, etc.)
+    are created once and act on the note being evaluated in the calling
+    thread. Instances pickle by their expressions.
+    """
+
+    def __init__(self, *expr, allow_exception=False, match_any=True, **kwargs):
+        if DISABLE_QUERY:
+            raise ValueError("Query is disabled")
+
+        import re
+
+        from .safe_eval import SafeEvalError, SafeEvaluator
+
+        self.expr = list(flattenlist(expr))  # will make  a list of all strings
+        self.allow_exception = allow_exception
+        self.match_any = match_any
+        self.kwargs = kwargs
+
+        current = self._current = threading.local()  # .note and .ns being evaluated
+
+        def grep(*expr, **kw):
+            return current.note.grep(*expr, **{"match_any": match_any, **kwargs, **kw})
+
+        def gall(*expr, **kw):
+            return current.note.grep(*expr, **{"match_any": False, **kwargs, **kw})
+
+        def gany(*expr, **kw):
+            return current.note.grep(*expr, **{"match_any": True, **kwargs, **kw})
+
+        # Note that these get normalized which includes flattening them
+        def tany(*tags):
+            return any(t.lower() in current.ns["tags"] for t in normalize_tags(tags))
+
+        def tall(*tags):
+            return all(t.lower() in current.ns["tags"] for t in normalize_tags(tags))
+
+        self._helpers = {
+            "re": re,
+            "ss": shlex.split,
+            "grep": grep,
+            "g": grep,
+            "gall": gall,
+            "gany": gany,
+            "tany": tany,
+            "tall": tall,
+            "t": tany,
+            "norm_tags": normalize_tags,
+        }
+        allowed_callables = [v for k, v in self._helpers.items() if k != "re"]
+        evaluator = SafeEvaluator(None, allowed_callables=allowed_callables, allowed_modules={re})
+
+        # Errors are kept and raised (or warned) for each note like any other
+        # query error
+        self._compiled = []
+        for expri in self.expr:
+            try:
+                self._compiled.append(evaluator.compile(expri))
+            except SafeEvalError as E:
+                self._compiled.append(str(E))
+
+    def __getstate__(self):
+        return self.expr, dict(
+            allow_exception=self.allow_exception, match_any=self.match_any, **self.kwargs
+        )
+
+    def __setstate__(self, state):
+        expr, kwargs = state
+        self.__init__(*expr, **kwargs)
+
+    def namespace(self, note):
+        """Return the query namespace for a note."""
+        ns = {
+            "data": note.data,
+            "tags": frozenset(normalize_tags(note.data.get("tags", []), sort=False)),
+            "notes": note.data.get(note.note_field, ""),
+            "text": getattr(note, "txt", ""),
+            "filename": note.names0.filename,
+            "notefile_path": note.destnote,
+            "isdir": note.isdir0,
+            "isfile": note.isfile0,
+        }
+        ns.update(self._helpers)
+        return ns
+
+    @profiling.timed("query")
+    def __call__(self, note):
+        """Return whether the note matches according to the query mode."""
+        current = self._current
+        current.note, current.ns = note, self.namespace(note)
+        try:
+            return self._evaluate(note, current.ns)
+        finally:
+            current.note = current.ns = None
+
+    def _evaluate(self, note, ns):
+        from .safe_eval import SafeEvalError
+
+        match_any = self.match_any
+        for compiled in self._compiled:
+            try:
+                if isinstance(compiled, str):  # compile error
+                    raise SafeEvalError(compiled)
+                r = bool(compiled(ns))
+            except SafeEvalError as E:
+                etxt = 'Query error: {}. Note: "{}"'.format(str(E), note.names0.filename)
+                if self.allow_exception:
+                    warn("Query Error: {}".format(etxt))
+                    r = False
+                else:
+                    raise QueryError(etxt)
+            except Exception as E:
+                etxt = 'Query runtime error: {}. Note: "{}"'.format(
+                    E.__class__.__name__, note.names0.filename
+                )
+                if self.allow_exception:
+                    warn("Query Error: {}".format(etxt))
+                    r = False
+                else:
+                    raise QueryError(etxt)
+
+            # Short circuit
+            if not match_any:
+                if not r:
+                    return False
+            else:
+                if r:
+                    return True
+
+        # At this point, we either hit them all with ALL, we hit none with ANY
+        return not match_any
+
+
+@functools.lru_cache(maxsize=64)
+def _notequery(expr, allow_exception, match_any, kwargs):
+    """Compiled `NoteQuery` for `Notefile.safe_query()`. Arguments are hashable."""
+    return NoteQuery(*expr, allow_exception=allow_exception, match_any=match_any, **dict(kwargs))
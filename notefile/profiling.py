@@ -0,0 +1,160 @@
+"""
+Per-stage timing and counts for `--profile`.
+
+Stages are timed with `stage()` (a context manager) or `timed()` (a decorator)
+and events are counted with `count()`. Both do nothing unless profiling is
+enabled (`$NOTEFILE_PROFILE` or the `--profile` CLI flag), so they can stay in
+hot paths. At the end of a command, `report()` prints the calls and seconds of
+each stage to stderr.
+
+Stages nest (e.g. 'note.read' includes 'read.io' and 'parse.yaml') and times
+from threads and `--jobs` worker processes are summed, so stage times can add up
+to more than the command's wall time.
+
+`--profile-dump FILE` (or `$NOTEFILE_PROFILE_DUMP`) also runs the command under
+cProfile and writes the stats to FILE for `pstats` or other viewers.
+"""
+
+import functools
+import os
+import sys
+import time
+
+# Run-level state. Reset by configure() on every CLI call.
+ENABLED = False
+DUMP = None
+
+_stats = {}  # stage: [calls, seconds]
+_lock = None
+
+
+def env_enabled():
+    """Return whether `$NOTEFILE_PROFILE` enables profiling."""
+    return os.environ.get("NOTEFILE_PROFILE", "false").strip().lower() == "true"
+
+
+def env_dump():
+    """Return the cProfile dump path from `$NOTEFILE_PROFILE_DUMP` or `None`."""
+    return os.environ.get("NOTEFILE_PROFILE_DUMP", "").strip() or None
+
+
+def configure(enabled=None, dump=None):
+    """Set the profiling behavior for this run and reset the stats.
+
+    Parameters
+    ----------
+    enabled:
+        `True` or `False` to override `$NOTEFILE_PROFILE`. `None` uses the
+        environment. A `dump` also enables profiling.
+    dump:
+        Path to write cProfile stats to. `None` uses `$NOTEFILE_PROFILE_DUMP`.
+    """
+    global ENABLED, DUMP, _lock
+    DUMP = env_dump() if dump is None else dump
+    ENABLED = (env_enabled() if enabled is None else bool(enabled)) or bool(DUMP)
+    _stats.clear()
+    if ENABLED and _lock is None:
+        import threading
+
+        _lock = threading.Lock()
+
+
+def add(name, seconds=0.0, calls=1):
+    """Add `calls` and `seconds` to a stage."""
+    if not ENABLED:
+        return
+    with _lock:
+        stat = _stats.setdefault(name, [0, 0.0])
+        stat[0] += calls
+        stat[1] += seconds
+
+
+def count(name, n=1):
+    """Count `n` events (without a time) for a stage."""
+    if ENABLED:
+        add(name, calls=n)
+
+
+class _Stage:
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add(self.name, time.perf_counter() - self.t0)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL = _NullStage()
+
+
+def stage(name):
+    """Return a context manager timing a stage (a no-op when disabled)."""
+    return _Stage(name) if ENABLED else _NULL
+
+
+def timed(name):
+    """Decorate a function to time each call as a stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(name, time.perf_counter() - t0)
+
+        return wrapper
+
+    return decorator
+
+
+def take():
+    """Return and reset the stats. Used to send a worker's stats back."""
+    if not ENABLED:
+        return {}
+    with _lock:
+        stats = {name: tuple(stat) for name, stat in _stats.items()}
+        _stats.clear()
+    return stats
+
+
+def merge(stats):
+    """Add stats from `take()` (e.g., from a worker process)."""
+    for name, (calls, seconds) in stats.items():
+        add(name, seconds, calls)
+
+
+def stats():
+    """Return `{stage: (calls, seconds)}`."""
+    return {name: tuple(stat) for name, stat in _stats.items()}
+
+
+def report(command, elapsed, file=None):
+    """Print the stats of a command that took `elapsed` seconds."""
+    file = sys.stderr if file is None else file
+    print(f"PROFILE: {command} {elapsed:.3f} s", file=file)
+    print(f"  {'stage':<24s} {'calls':>10s} {'seconds':>10s} {'per call':>10s}", file=file)
+    for name, (calls, seconds) in sorted(_stats.items()):
+        if seconds:
+            per = f"{1e3 * seconds / calls:.3f} ms" if calls else ""
+            print(f"  {name:<24s} {calls:>10d} {seconds:>10.3f} {per:>10s}", file=file)
+        else:
+            print(f"  {name:<24s} {calls:>10d} {'':>10s} {'':>10s}", file=file)
@@ -0,0 +1,217 @@
+"""
+Batch repair of orphaned notes.
+
+The search path is walked once and shared by every orphan in the batch rather
+than walking it again for each note.
+"""
+
+import os
+import shutil
+import stat
+from collections import defaultdict
+
+from . import DT, fs, warn
+from .cache import sha256
+from .notefile import (
+    DIR_FILES_FIELD,
+    DIR_HASH_FIELD,
+    DIR_SUBDIRS_FIELD,
+    directory_info,
+    get_filenames,
+    hidden_chooser,
+)
+
+
+class SearchIndex:
+    """Single-walk index of candidate targets under the search path.
+
+    Files are indexed by size and directories by basename. File hashes and
+    directory metadata are computed at most once per candidate and shared by
+    every orphan that needs them.
+
+    Parameters
+    ----------
+    search_path, search_excludes, search_matchcase, search_maxdepth,
+    search_one_file_system, search_exclude_links:
+        Passed to `find()` as the path, excludes, etc. The walk is deferred
+        until the first orphan needs candidates.
+    """
+
+    def __init__(
+        self,
+        search_path=".",
+        search_excludes=None,
+        search_matchcase=False,
+        search_maxdepth=None,
+        search_one_file_system=False,
+        search_exclude_links=False,
+    ):
+        self.findopts = dict(
+            path=search_path,
+            excludes=search_excludes,
+            matchcase=search_matchcase,
+            maxdepth=search_maxdepth,
+            one_file_system=search_one_file_system,
+            exclude_links=search_exclude_links,
+        )
+        self._sizes = None
+        self._dirs = None
+        self._dirnames = None
+        self._hashes = {}
+        self._dirinfo = {}
+
+    def _walk(self):
+        """Walk the search path once, recording files by size and dirs by name.
+
+        Lists preserve walk order so candidates (and warnings) come out in
+        the same order as a per-note search.
+        """
+        from .find import find
+
+        sizes = defaultdict(list)
+        dirs = []
+        dirnames = defaultdict(list)
+        for path in find(filemode=True, targetmode="both", **self.findopts):
+            try:
+                st = fs.stat(path)
+            except FileNotFoundError:
+                continue  # likely a broken link
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
+                dirnames[os.path.basename(path)].append(path)
+            else:
+                sizes[st.st_size].append((path, st.st_mtime))
+
+        self._sizes, self._dirs, self._dirnames = sizes, dirs, dirnames
+
+    def files(self, size):
+        """Return [(path, mtime), ...] of files with the given size"""
+        if self._sizes is None:
+            self._walk()
+        return self._sizes.get(size, [])
+
+    def dirs(self, name=None):
+        """Return directories in walk order, optionally only those named `name`"""
+        if self._dirs is None:
+            self._walk()
+        if name is None:
+            return self._dirs
+        return self._dirnames.get(name, [])
+
+    def sha256(self, path):
+        """Memoized sha256 of a candidate file (also persistently when cached)"""
+        try:
+            return self._hashes[path]
+        except KeyError:
+            pass
+        h = self._hashes[path] = sha256(path)
+        return h
+
+    def directory_info(self, path):
+        """Memoized `directory_info()`. Returns None if it can't be read"""
+        try:
+            return self._dirinfo[path]
+        except KeyError:
+            pass
+        try:
+            info = directory_info(path)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            info = None
+        self._dirinfo[path] = info
+        return info
+
+
+def repair_orphaned(notes, *, mtime=True, filehash=True, name=False, dry_run=False, **search):
+    """Relocate orphaned notes against a single walk of the search path.
+
+    Parameters
+    ----------
+    notes:
+        Iterable of Notefile objects. Non-orphaned notes are passed through
+        without a match.
+    mtime, filehash, name:
+        Which attributes, beyond size, must match for a file target.
+        Directory targets always match on their shallow metadata and
+        optionally on name.
+    dry_run:
+        Do not move anything.
+    **search:
+        search_path, search_excludes, etc. See `SearchIndex`.
+
+    Yields
+    ------
+    (note, newnote)
+        `newnote` is the new note path or None when a unique match wasn't
+        found (with a warning). Notes are processed lazily in order, so a
+        repair can see notes moved by the ones before it.
+    """
+    index = SearchIndex(**search)
+    for note in notes:
+        yield note, _repair_one(
+            note, index, mtime=mtime, filehash=filehash, name=name, dry_run=dry_run
+        )
+
+
+def _repair_one(note, index, *, mtime, filehash, name, dry_run):
+    """Find the candidates for one note and move it if unique"""
+    if note.exists and note._data is None:
+        note.read()
+
+    note._refresh_target_type_flags()
+
+    basename = os.path.basename(note.names0.filename)
+    data = note.data
+
+    if note.isdir:
+        if len(data.get(DIR_HASH_FIELD, "")) != 64:
+            warn(f"Cannot repair {note.names.filename} based on directory hash since it's missing")
+            return
+
+        candidates = []
+        for dirpath in index.dirs(name=basename if name else None):
+            info = index.directory_info(dirpath)
+            if info is None:
+                continue
+            if info[DIR_SUBDIRS_FIELD] != data.get(DIR_SUBDIRS_FIELD, -1):
+                continue
+            if info[DIR_FILES_FIELD] != data.get(DIR_FILES_FIELD, -1):
+                continue
+            if info[DIR_HASH_FIELD] != data.get(DIR_HASH_FIELD):
+                continue
+            candidates.append(dirpath)
+    else:
+        if filehash and len(data.get("sha256", "")) != 64:  # not a computed hash
+            warn(f"Cannot repair {note.names.filename} based on hash since it's missing")
+            return
+
+        candidates = []
+        for file, file_mtime in index.files(data.filesize):
+            # do the tests in order of simplicity to compute
+            if name and basename != os.path.basename(file):
+                continue
+            if mtime and abs(data.mtime - file_mtime) > DT:
+                continue
+            if filehash and data["sha256"] != index.sha256(file):
+                continue
+            candidates.append(file)
+
+    if len(candidates) > 1:
+        wtxt = f"{len(candidates)} candidates found for '{note.destnote0}'. Not repairing"
+        wtxt += "\n   ".join([""] + candidates)
+        warn(wtxt)
+        return
+    if len(candidates) == 0:
+        warn(f"No match for '{note.destnote0}'")
+        return
+
+    names = get_filenames(candidates[0])
+    newnote, *_ = hidden_chooser(names, hidden=note.is_hidden, subdir=note.is_subdir)
+    if fs.exists(newnote):
+        warn(f"Notefile exists. Not Moving!\n   SRC:{note.destnote0}\n   DST:{newnote}")
+        return
+
+    if not dry_run:
+        shutil.move(note.destnote0, newnote)
+        note._recache_moved(newnote)
+
+    return newnote
@@ -30,6 +30,9 @@ Not supported:
 - Imports, lambdas, class/def, attribute access on arbitrary objects
 - Private names/attributes, **kwargs, or other dynamic execution features
 
+Queries are parsed and validated once by `SafeEvaluator.compile()` into nested
+closures that can be evaluated against many namespaces (see `NoteQuery`).
+
 Future extensions (guarded):
 - More whitelisted helpers (e.g., basename/dirname, contains_any).
 - Optional resource limits (timeouts, regex limits).
@@ -150,6 +153,21 @@ class SafeEvaluator:
 
         Raises SafeEvalError on syntax errors or unsupported constructs.
         """
+        return self.compile(code)(self._names)
+
+    def compile(self, code):
+        """
+        Parse and validate a restricted query string once.
+
+        Returns a function of a namespace dict that evaluates the query and
+        returns the last expression value. Assignments are stored in that
+        namespace. The query is compiled to nested closures, so evaluating it
+        does not walk the AST again.
+
+        Raises SafeEvalError on syntax errors, an empty query, or when the last
+        line is not an expression. Unsupported constructs raise SafeEvalError
+        when (and if) they are evaluated, just as with `eval()`.
+        """
         try:
             tree = ast.parse(code, mode="exec")
         except SyntaxError as exc:
@@ -163,230 +181,305 @@ class SafeEvaluator:
         if not isinstance(tree.body[-1], ast.Expr):
             raise SafeEvalError("Last line must be an expression")
 
-        last_value = None
-        for stmt in tree.body:
-            if isinstance(stmt, ast.Expr):
-                last_value = self._eval_expr(stmt.value, {})
-            elif isinstance(stmt, ast.Assign):
-                value = self._eval_expr(stmt.value, {})
-                for target in stmt.targets:
-                    self._assign_target(target, value)
-                last_value = value
-            else:
-                self._raise(stmt, "Unsupported statement")
+        stmts = [self._compile_stmt(stmt) for stmt in tree.body]
 
-        return last_value
+        def run(names):
+            last_value = None
+            for stmt in stmts:
+                last_value = stmt(names)
+            return last_value
+
+        return run
+
+    def _eval_expr(self, node, local_vars):
+        """Compile and evaluate a single AST expression node."""
+        return self._compile_expr(node)(self._names, local_vars)
+
+    def _compile_stmt(self, stmt):
+        """Compile a statement to a function of the namespace."""
+        if isinstance(stmt, ast.Expr):
+            value = self._compile_expr(stmt.value)
+            return lambda names: value(names, {})
+        if isinstance(stmt, ast.Assign):
+            value = self._compile_expr(stmt.value)
+            targets = [self._compile_target(target, names_target=True) for target in stmt.targets]
+
+            def assign(names):
+                v = value(names, {})
+                for target in targets:
+                    target(v, names)
+                return v
+
+            return assign
+        return self._raiser(stmt, "Unsupported statement")
+
+    def _compile_target(self, target, names_target=False):
+        """Compile an assignment (or comprehension) target.
+
+        The result is a function of `(value, scope)` that binds names in
+        `scope`. For statements, the scope is the namespace.
+        """
+        if names_target:
+            unpack_msg, length_msg = "Can only unpack tuple/list", "Unpack length mismatch"
+            other_msg = "Unsupported assignment target"
+        else:
+            unpack_msg = "Can only unpack tuple/list in comprehension"
+            length_msg = "Comprehension unpack length mismatch"
+            other_msg = "Unsupported comprehension target"
 
-    def _assign_target(self, target, value):
-        """Assign a statement target inside the evaluator namespace."""
         if isinstance(target, ast.Name):
-            self._names[target.id] = value
-            return
+            name = target.id
+
+            def bind(value, scope):
+                scope[name] = value
+
+            return bind
         if isinstance(target, (ast.Tuple, ast.List)):
-            if not isinstance(value, (tuple, list)):
-                self._raise(target, "Can only unpack tuple/list")
-            if len(target.elts) != len(value):
-                self._raise(target, "Unpack length mismatch")
-            for t, v in zip(target.elts, value):
-                self._assign_target(t, v)
-            return
-        self._raise(target, "Unsupported assignment target")
+            elts = [self._compile_target(t, names_target=names_target) for t in target.elts]
+            unpack_err = self._error(target, unpack_msg)
+            length_err = self._error(target, length_msg)
 
-    def _eval_expr(self, node, local_vars):
-        """Evaluate a supported AST expression node."""
+            def unpack(value, scope):
+                if not isinstance(value, (tuple, list)):
+                    raise SafeEvalError(unpack_err)
+                if len(elts) != len(value):
+                    raise SafeEvalError(length_err)
+                for t, v in zip(elts, value):
+                    t(v, scope)
+
+            return unpack
+        return self._raiser(target, other_msg)
+
+    def _compile_expr(self, node):
+        """Compile a supported AST expression node.
+
+        The result is a function of `(names, local_vars)`.
+        """
         if isinstance(node, ast.Constant):
-            return node.value
+            value = node.value
+            return lambda names, local_vars: value
         if isinstance(node, ast.Name):
-            if node.id in local_vars:
-                return local_vars[node.id]
-            if node.id in self._names:
-                return self._names[node.id]
-            if node.id in _SAFE_BUILTINS:
-                return _SAFE_BUILTINS[node.id]
-            self._raise(node, f"Unknown name: {node.id}")
-        if isinstance(node, ast.List):
-            return [self._eval_expr(e, local_vars) for e in node.elts]
-        if isinstance(node, ast.Tuple):
-            return tuple(self._eval_expr(e, local_vars) for e in node.elts)
-        if isinstance(node, ast.Set):
-            return {self._eval_expr(e, local_vars) for e in node.elts}
+            return self._compile_name(node)
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            elts = [self._compile_expr(e) for e in node.elts]
+            container = {ast.List: list, ast.Tuple: tuple, ast.Set: set}[type(node)]
+            return lambda names, local_vars: container(e(names, local_vars) for e in elts)
         if isinstance(node, ast.Dict):
-            return {
-                self._eval_expr(k, local_vars): self._eval_expr(v, local_vars)
+            items = [
+                (self._compile_expr(k), self._compile_expr(v))
                 for k, v in zip(node.keys, node.values)
+            ]
+            return lambda names, local_vars: {
+                k(names, local_vars): v(names, local_vars) for k, v in items
             }
         if isinstance(node, ast.UnaryOp):
             op = _UNARY_OPS.get(type(node.op))
             if not op:
-                self._raise(node, "Unsupported unary operator")
-            return op(self._eval_expr(node.operand, local_vars))
+                return self._raiser(node, "Unsupported unary operator")
+            operand = self._compile_expr(node.operand)
+            return lambda names, local_vars: op(operand(names, local_vars))
         if isinstance(node, ast.BinOp):
             op = _BIN_OPS.get(type(node.op))
             if not op:
-                self._raise(node, "Unsupported binary operator")
-            return op(
-                self._eval_expr(node.left, local_vars),
-                self._eval_expr(node.right, local_vars),
-            )
+                return self._raiser(node, "Unsupported binary operator")
+            left, right = self._compile_expr(node.left), self._compile_expr(node.right)
+            return lambda names, local_vars: op(left(names, local_vars), right(names, local_vars))
         if isinstance(node, ast.BoolOp):
+            values = [self._compile_expr(value) for value in node.values]
             if isinstance(node.op, ast.And):
-                for value in node.values:
-                    if not self._eval_expr(value, local_vars):
-                        return False
-                return True
+                return lambda names, local_vars: all(v(names, local_vars) for v in values)
             if isinstance(node.op, ast.Or):
-                for value in node.values:
-                    if self._eval_expr(value, local_vars):
-                        return True
-                return False
-            self._raise(node, "Unsupported boolean operator")
+                return lambda names, local_vars: any(v(names, local_vars) for v in values)
+            return self._raiser(node, "Unsupported boolean operator")
         if isinstance(node, ast.Compare):
-            left = self._eval_expr(node.left, local_vars)
-            for op_node, comparator in zip(node.ops, node.comparators):
-                op = _CMP_OPS.get(type(op_node))
-                if not op:
-                    self._raise(node, "Unsupported comparison operator")
-                right = self._eval_expr(comparator, local_vars)
-                if not op(left, right):
-                    return False
-                left = right
-            return True
+            return self._compile_compare(node)
         if isinstance(node, ast.IfExp):
-            return (
-                self._eval_expr(node.body, local_vars)
-                if self._eval_expr(node.test, local_vars)
-                else self._eval_expr(node.orelse, local_vars)
+            test, body = self._compile_expr(node.test), self._compile_expr(node.body)
+            orelse = self._compile_expr(node.orelse)
+            return lambda names, local_vars: (
+                body(names, local_vars) if test(names, local_vars) else orelse(names, local_vars)
             )
         if isinstance(node, ast.Subscript):
-            value = self._eval_expr(node.value, local_vars)
-            slice_val = self._eval_slice(node.slice, local_vars)
-            return value[slice_val]
+            value, slice_val = self._compile_expr(node.value), self._compile_slice(node.slice)
+            return lambda names, local_vars: value(names, local_vars)[slice_val(names, local_vars)]
         if isinstance(node, ast.Call):
-            return self._eval_call(node, local_vars)
+            return self._compile_call(node)
         if isinstance(node, ast.Attribute):
-            return self._eval_attribute(node, local_vars)
+            value, check = self._compile_expr(node.value), self._attribute_check(node, node.attr)
+            return lambda names, local_vars: check(value(names, local_vars))
         if isinstance(node, ast.GeneratorExp):
-            return self._eval_generator(node, local_vars)
+            return self._compile_generator(node)
         if isinstance(node, ast.ListComp):
-            return list(self._eval_generator(node, local_vars))
+            gen = self._compile_generator(node)
+            return lambda names, local_vars: list(gen(names, local_vars))
         if isinstance(node, ast.SetComp):
-            return set(self._eval_generator(node, local_vars))
+            gen = self._compile_generator(node)
+            return lambda names, local_vars: set(gen(names, local_vars))
         if isinstance(node, ast.DictComp):
-            return self._eval_dictcomp(node, local_vars)
+            return self._compile_dictcomp(node)
+
+        return self._raiser(node, "Unsupported expression")
+
+    def _compile_name(self, node):
+        """Compile a name lookup: comprehension scope, namespace, then builtins."""
+        name = node.id
+        missing = self._error(node, f"Unknown name: {name}")
+        builtin = name in _SAFE_BUILTINS
+        builtin_value = _SAFE_BUILTINS.get(name)
+
+        def lookup(names, local_vars):
+            if name in local_vars:
+                return local_vars[name]
+            if name in names:
+                return names[name]
+            if builtin:
+                return builtin_value
+            raise SafeEvalError(missing)
+
+        return lookup
+
+    def _compile_compare(self, node):
+        """Compile a (possibly chained) comparison."""
+        left = self._compile_expr(node.left)
+        pairs = []
+        for op_node, comparator in zip(node.ops, node.comparators):
+            op = _CMP_OPS.get(type(op_node))
+            if not op:
+                return self._raiser(node, "Unsupported comparison operator")
+            pairs.append((op, self._compile_expr(comparator)))
+
+        def compare(names, local_vars):
+            lvalue = left(names, local_vars)
+            for op, comparator in pairs:
+                rvalue = comparator(names, local_vars)
+                if not op(lvalue, rvalue):
+                    return False
+                lvalue = rvalue
+            return True
 
-        self._raise(node, "Unsupported expression")
+        return compare
 
-    def _eval_slice(self, node, local_vars):
-        """Evaluate an index or slice node for subscription."""
+    def _compile_slice(self, node):
+        """Compile an index or slice node for subscription."""
         if isinstance(node, ast.Slice):
-            return slice(
-                self._eval_expr(node.lower, local_vars) if node.lower else None,
-                self._eval_expr(node.upper, local_vars) if node.upper else None,
-                self._eval_expr(node.step, local_vars) if node.step else None,
-            )
-        return self._eval_expr(node, local_vars)
-
-    def _eval_call(self, node, local_vars):
-        """Evaluate an allowed function or method call."""
-        func = None
+            none = lambda names, local_vars: None
+            parts = [
+                self._compile_expr(p) if p else none for p in (node.lower, node.upper, node.step)
+            ]
+            return lambda names, local_vars: slice(*(p(names, local_vars) for p in parts))
+        return self._compile_expr(node)
+
+    def _compile_call(self, node):
+        """Compile an allowed function or method call."""
         if isinstance(node.func, ast.Name):
-            func = self._eval_expr(node.func, local_vars)
-            if func not in self._allowed_callables and node.func.id not in _SAFE_BUILTINS:
-                self._raise(node, f"Call not allowed: {node.func.id}")
+            func_value = self._compile_name(node.func)
+            allowed, builtin = self._allowed_callables, node.func.id in _SAFE_BUILTINS
+            not_allowed = self._error(node, f"Call not allowed: {node.func.id}")
+
+            def get_func(names, local_vars):
+                func = func_value(names, local_vars)
+                if func not in allowed and not builtin:
+                    raise SafeEvalError(not_allowed)
+                return func
+
         elif isinstance(node.func, ast.Attribute):
             # Only allow calls on whitelisted modules, strings, or dicts.
-            value = self._eval_expr(node.func.value, local_vars)
-            attr = node.func.attr
+            obj_value = self._compile_expr(node.func.value)
+            check = self._attribute_check(node, node.func.attr, call=True)
+            get_func = lambda names, local_vars: check(obj_value(names, local_vars))
+        else:
+            return self._raiser(node, "Unsupported call target")
+
+        args = [self._compile_expr(a) for a in node.args]
+        kwargs = []
+        for kw in node.keywords:
+            if kw.arg is None:
+                kwargs.append((None, self._raiser(node, "**kwargs is not allowed")))
+            else:
+                kwargs.append((kw.arg, self._compile_expr(kw.value)))
+
+        def call(names, local_vars):
+            func = get_func(names, local_vars)
+            a = [arg(names, local_vars) for arg in args]
+            kw = {key: value(names, local_vars) for key, value in kwargs}
+            return func(*a, **kw)
+
+        return call
+
+    def _attribute_check(self, node, attr, call=False):
+        """Return a function that resolves a permitted attribute of an object."""
+        private = self._error(node, "Private attribute access is not allowed")
+        restricted = self._error(node, "Attribute access is restricted")
+        call_not_allowed = self._error(node, "Call not allowed")
+
+        def check(value):
             if attr.startswith("_"):
-                self._raise(node, "Private attribute access is not allowed")
+                raise SafeEvalError(private)
             if isinstance(value, types.ModuleType) and value in self._allowed_modules:
                 func = getattr(value, attr)
-                if not self._callable_from_allowed_module(func):
-                    self._raise(node, "Call not allowed")
-            elif isinstance(value, str):
+                if call and not self._callable_from_allowed_module(func):
+                    raise SafeEvalError(call_not_allowed)
+                return func
+            if isinstance(value, str):
                 if attr not in _SAFE_STR_ATTRS:
-                    self._raise(node, "Attribute access is restricted")
-                func = getattr(value, attr)
-            elif isinstance(value, dict):
+                    raise SafeEvalError(restricted)
+                return getattr(value, attr)
+            if isinstance(value, dict):
                 if attr not in _SAFE_DICT_ATTRS:
-                    self._raise(node, "Attribute access is restricted")
-                func = getattr(value, attr)
-            else:
-                self._raise(node, "Attribute access is restricted")
-        else:
-            self._raise(node, "Unsupported call target")
+                    raise SafeEvalError(restricted)
+                return getattr(value, attr)
+            raise SafeEvalError(restricted)
+
+        return check
+
+    def _compile_generator(self, node):
+        """Compile a generator expression to a function returning a generator."""
+        scopes, elt = self._compile_comprehension(node.generators), self._compile_expr(node.elt)
+
+        def generator(names, local_vars):
+            for scope in scopes(names, dict(local_vars)):
+                yield elt(names, scope)
+
+        return generator
+
+    def _compile_dictcomp(self, node):
+        """Compile a dictionary comprehension."""
+        scopes = self._compile_comprehension(node.generators)
+        key, value = self._compile_expr(node.key), self._compile_expr(node.value)
+
+        def dictcomp(names, local_vars):
+            result = {}
+            for scope in scopes(names, dict(local_vars)):
+                k = key(names, scope)
+                result[k] = value(names, scope)
+            return result
+
+        return dictcomp
+
+    def _compile_comprehension(self, generators):
+        """Compile comprehension clauses to a function yielding scope dicts."""
+        clauses = [
+            (
+                self._compile_expr(gen.iter),
+                self._compile_target(gen.target),
+                [self._compile_expr(c) for c in gen.ifs],
+            )
+            for gen in generators
+        ]
 
-        args = [self._eval_expr(a, local_vars) for a in node.args]
-        kwargs = {}
-        for kw in node.keywords:
-            if kw.arg is None:
-                self._raise(node, "**kwargs is not allowed")
-            kwargs[kw.arg] = self._eval_expr(kw.value, local_vars)
-        return func(*args, **kwargs)
-
-    def _eval_attribute(self, node, local_vars):
-        """Resolve a permitted attribute access."""
-        value = self._eval_expr(node.value, local_vars)
-        if node.attr.startswith("_"):
-            self._raise(node, "Private attribute access is not allowed")
-        if isinstance(value, types.ModuleType) and value in self._allowed_modules:
-            return getattr(value, node.attr)
-        if isinstance(value, str):
-            if node.attr not in _SAFE_STR_ATTRS:
-                self._raise(node, "Attribute access is restricted")
-            return getattr(value, node.attr)
-        if isinstance(value, dict):
-            if node.attr not in _SAFE_DICT_ATTRS:
-                self._raise(node, "Attribute access is restricted")
-            return getattr(value, node.attr)
-        self._raise(node, "Attribute access is restricted")
-
-    def _eval_generator(self, node, local_vars):
-        """Return a generator for a validated generator expression."""
-
-        def generator():
-            for scope in self._comprehension_scopes(node.generators, dict(local_vars)):
-                yield self._eval_expr(node.elt, scope)
-
-        return generator()
-
-    def _eval_dictcomp(self, node, local_vars):
-        """Evaluate a dictionary comprehension."""
-        result = {}
-        for scope in self._comprehension_scopes(node.generators, dict(local_vars)):
-            key = self._eval_expr(node.key, scope)
-            value = self._eval_expr(node.value, scope)
-            result[key] = value
-        return result
-
-    def _comprehension_scopes(self, generators, local_vars):
-        """Yield scope dictionaries for each comprehension iteration."""
-        if not generators:
-            yield local_vars
-            return
-
-        gen = generators[0]
-        iterable = self._eval_expr(gen.iter, local_vars)
-        for item in iterable:
-            scope = dict(local_vars)
-            self._assign_comprehension_target(gen.target, item, scope)
-            if all(self._eval_expr(cond, scope) for cond in gen.ifs):
-                yield from self._comprehension_scopes(generators[1:], scope)
-
-    def _assign_comprehension_target(self, target, value, scope):
-        """Bind a comprehension target within a temporary scope."""
-        if isinstance(target, ast.Name):
-            scope[target.id] = value
-            return
-        if isinstance(target, (ast.Tuple, ast.List)):
-            if not isinstance(value, (tuple, list)):
-                self._raise(target, "Can only unpack tuple/list in comprehension")
-            if len(target.elts) != len(value):
-                self._raise(target, "Comprehension unpack length mismatch")
-            for t, v in zip(target.elts, value):
-                self._assign_comprehension_target(t, v, scope)
-            return
-        self._raise(target, "Unsupported comprehension target")
+        def scopes(names, local_vars, i=0):
+            if i == len(clauses):
+                yield local_vars
+                return
+
+            iterable, target, ifs = clauses[i]
+            for item in iterable(names, local_vars):
+                scope = dict(local_vars)
+                target(item, scope)
+                if all(cond(names, scope) for cond in ifs):
+                    yield from scopes(names, scope, i + 1)
+
+        return scopes
 
     def _callable_from_allowed_module(self, func):
         """Check whether a callable originates from an allowed module."""
@@ -398,11 +491,20 @@ class SafeEvaluator:
             return False
         return mod in self._allowed_module_names
 
-    def _raise(self, node, message):
-        """Raise `SafeEvalError` with source-line context."""
+    def _error(self, node, message):
+        """Return a `SafeEvalError` message with source-line context."""
         lineno = getattr(node, "lineno", 1)
         line = self._lines[lineno - 1].strip() if self._lines else ""
-        raise SafeEvalError(f"Line {lineno} `{line}`: {message}")
+        return f"Line {lineno} `{line}`: {message}"
+
+    def _raiser(self, node, message):
+        """Return a compiled node that raises `SafeEvalError` when evaluated."""
+        message = self._error(node, message)
+
+        def raiser(*args):
+            raise SafeEvalError(message)
+
+        return raiser
 
 
 def safe_eval(code, names, allowed_callables=None, allowed_modules=None):
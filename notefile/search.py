@@ -0,0 +1,561 @@
+"""
+Search filters and the parallel read pipeline.
+
+`GrepMatcher` holds compiled grep expressions so they are compiled once per
+search (or once per distinct pattern via `grep_matcher()`) rather than per note.
+
+`SearchFilter.prefilter()` rejects notes whose raw text cannot contain the
+literal tags and terms the filter requires, before any YAML/JSON is parsed.
+
+`parallel_read()` hands note paths to worker processes, which read, parse, and
+(optionally) filter the notes. Only the data of matching notes is sent back and
+loaded into the caller's `Notefile` objects, so the notes themselves are never
+pickled. Workers always read from disk; the cache (if enabled) is updated by the
+calling process.
+"""
+
+import ast
+import functools
+import os
+import re
+from collections import deque
+
+from . import cache, debug, profiling
+from .utils import flattenlist, normalize_tags
+
+# Fixed-string grep with at least this many expressions uses an Aho-Corasick
+# automaton (one pass per note) rather than a regex alternation
+AHO_CORASICK_MIN = 8
+
+
+class GrepMatcher:
+    """Compiled grep expressions. See `Notefile.grep()` for the options.
+
+    Parameters
+    ----------
+    expr:
+        Pattern or patterns. Nested iterables are flattened.
+    matchcase, full_word, fixed_strings, match_any:
+        As in `Notefile.grep()`.
+
+    Notes
+    -----
+    With `fixed_strings` and `AHO_CORASICK_MIN` or more expressions, text is
+    matched with an `ahocorasick.AhoCorasick` automaton so the cost does not
+    grow with the number of expressions. Case-insensitive matching of
+    non-ASCII text (or expressions) uses the regex to keep its case folding.
+    """
+
+    def __init__(
+        self, expr, *, matchcase=False, full_word=False, fixed_strings=False, match_any=True
+    ):
+        self.expr = tuple(flattenlist(expr))
+        self.matchcase = matchcase
+        self.full_word = full_word
+        self.match_any = match_any
+
+        flags = re.MULTILINE | re.UNICODE
+        if not matchcase:
+            flags |= re.IGNORECASE
+
+        expr = self.expr
+        if fixed_strings:
+            expr = [re.escape(e) for e in expr]
+
+        if full_word:
+            expr = [r"\b" + e + r"\b" for e in expr]
+
+        # For all, you need individual regexes but for any, can make a single one
+        if match_any:
+            self.regexes = [re.compile("|".join(expr), flags=flags)]
+        else:
+            self.regexes = [re.compile(e, flags=flags) for e in expr]
+
+        self.automaton = None
+        words = sorted(set(self.expr))
+        if (
+            fixed_strings
+            and len(words) >= AHO_CORASICK_MIN
+            and all(words)
+            and (matchcase or all(w.isascii() for w in words))
+        ):
+            from .ahocorasick import AhoCorasick
+
+            self.automaton = AhoCorasick(words if matchcase else [w.lower() for w in words])
+
+    def __call__(self, text):
+        """Return whether `text` matches"""
+        if self.automaton is not None and (self.matchcase or text.isascii()):
+            return self._literal_match(text if self.matchcase else text.lower())
+        if self.match_any:
+            return bool(self.regexes[0].search(text))
+        return all(r.search(text) for r in self.regexes)
+
+    def _literal_match(self, text):
+        automaton = self.automaton
+        if self.match_any and not self.full_word:
+            return automaton.search(text)
+
+        words, need = automaton.words, len(automaton.words)
+        found = set()
+        for end, index in automaton.finditer(text):
+            if self.full_word:
+                start = end - len(words[index])
+                if not (_word_boundary(text, start) and _word_boundary(text, end)):
+                    continue
+            if self.match_any:
+                return True
+            found.add(index)
+            if len(found) == need:
+                return True
+        return False
+
+
+def _isword(c):
+    return c.isalnum() or c == "_"
+
+
+def _word_boundary(text, i):
+    """Whether position `i` is a `\\b` word boundary as in `re`"""
+    before = i > 0 and _isword(text[i - 1])
+    after = i < len(text) and _isword(text[i])
+    return before != after
+
+
+@functools.lru_cache(maxsize=256)
+def _grep_matcher(expr, matchcase, full_word, fixed_strings, match_any):
+    return GrepMatcher(
+        expr,
+        matchcase=matchcase,
+        full_word=full_word,
+        fixed_strings=fixed_strings,
+        match_any=match_any,
+    )
+
+
+def grep_matcher(expr, *, matchcase=False, full_word=False, fixed_strings=False, match_any=True):
+    """Return a (cached) `GrepMatcher` for the expressions and options"""
+    expr = tuple(flattenlist(expr))
+    opts = (bool(matchcase), bool(full_word), bool(fixed_strings), bool(match_any))
+    return _grep_matcher(expr, *opts)
+
+
+class SearchFilter:
+    """Picklable grep/query/tag test used by search commands.
+
+    Parameters
+    ----------
+    grep:
+        Expressions for `Notefile.grep()`.
+    query:
+        Safe queries. See `NoteQuery`.
+    tags:
+        Tags to test for. Lower case.
+    tag_all:
+        Require all `tags` rather than any.
+    match_all:
+        Require every active test (grep, query, tags) rather than any.
+    allow_exception:
+        Passed to `NoteQuery`.
+    **grepopts:
+        matchcase, full_note, full_word, fixed_strings for grep and query.
+    """
+
+    def __init__(
+        self,
+        grep=None,
+        query=None,
+        tags=None,
+        tag_all=False,
+        match_all=False,
+        allow_exception=False,
+        **grepopts,
+    ):
+        self.grep = grep
+        self.query = query
+        self.tags = set(tags or [])
+        self.tag_all = tag_all
+        self.match_all = match_all
+        self.allow_exception = allow_exception
+        self.grepopts = grepopts
+        self.grepopts["match_any"] = not match_all
+        self._requirement = False  # Not yet computed
+        self._notequery = None
+        self._grepmatcher = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Build the filter from parsed search-command arguments."""
+        return cls(
+            grep=getattr(args, "grep", None),
+            query=getattr(args, "query", None),
+            tags=getattr(args, "tag", None),
+            tag_all=getattr(args, "tag_all", False),
+            match_all=getattr(args, "all", False),
+            allow_exception=getattr(args, "allow_exception", False),
+            matchcase=getattr(args, "match_expr_case", False),
+            full_note=getattr(args, "full_note", False),
+            full_word=getattr(args, "full_word", False),
+            fixed_strings=getattr(args, "fixed_strings", False),
+        )
+
+    @property
+    def active(self):
+        """Whether there is anything to test."""
+        return bool(self.grep or self.query or self.tags)
+
+    @property
+    def grepmatcher(self):
+        """The `GrepMatcher` for `grep`, compiled once for all notes (and reused by
+        later filters in the process)."""
+        if self._grepmatcher is None:
+            opts = {k: v for k, v in self.grepopts.items() if k != "full_note"}
+            self._grepmatcher = grep_matcher(self.grep, **opts)
+        return self._grepmatcher
+
+    @property
+    def notequery(self):
+        """The `NoteQuery` for `query`, compiled once for all notes (and reused by
+        later filters in the process)."""
+        if self._notequery is None:
+            from .notefile import _notequery
+
+            opts = dict(self.grepopts)
+            match_any = opts.pop("match_any")
+            self._notequery = _notequery(
+                tuple(flattenlist(self.query)),
+                self.allow_exception,
+                match_any,
+                tuple(sorted(opts.items())),
+            )
+        return self._notequery
+
+    @property
+    def requirement(self):
+        """Literals the raw note text must contain for the filter to pass.
+
+        A nested `("all" | "any", [...])` of `("lit", term, matchcase)` or
+        `None` when anything could match.
+        """
+        if self._requirement is False:
+            self._requirement = self._build_requirement()
+        return self._requirement
+
+    def _build_requirement(self):
+        match_any = self.grepopts["match_any"]
+        reqs = []
+        if self.grep:
+            reqs.append(self._text_req(flattenlist(self.grep), match_any))
+        if self.query:
+            queries = [self._query_req(q) for q in flattenlist(self.query)]
+            reqs.append(_combine("any" if match_any else "all", queries))
+        if self.tags:
+            tags = [_literal(tag, False) for tag in self.tags]
+            reqs.append(_combine("all" if self.tag_all else "any", tags))
+        return _combine("all" if self.match_all else "any", reqs)
+
+    def _text_req(self, exprs, match_any):
+        """Requirement for grep expressions"""
+        matchcase = self.grepopts.get("matchcase", False)
+        fixed = self.grepopts.get("fixed_strings", False)
+        terms = []
+        for expr in exprs:
+            if not fixed and _REGEX_SPECIAL.search(expr):
+                terms.append(None)  # Not a plain literal
+            else:
+                terms.append(_literal(expr, matchcase))
+        return _combine("any" if match_any else "all", terms)
+
+    def _query_req(self, query):
+        """Requirement for a safe query from its AST.
+
+        Only top-level `and`/`or` of tag and grep calls (and `in` tests) with
+        literal arguments are used. Anything else is unknown.
+        """
+        try:
+            tree = ast.parse(query, mode="exec")
+        except SyntaxError:
+            return None
+        if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Expr):
+            return None  # Assignments may rebind the helpers
+        if any(isinstance(node, ast.NamedExpr) for node in ast.walk(tree)):
+            return None
+        return self._node_req(tree.body[0].value)
+
+    def _node_req(self, node):
+        if isinstance(node, ast.BoolOp):
+            op = "all" if isinstance(node.op, ast.And) else "any"
+            return _combine(op, [self._node_req(value) for value in node.values])
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            args = [_conststr(arg) for arg in node.args]
+            if node.keywords or any(arg is None for arg in args):
+                return None
+            name = node.func.id
+            if name in {"t", "tany", "tall"}:
+                tags = [_literal(tag, False) for tag in normalize_tags(args)]
+                return _combine("all" if name == "tall" else "any", tags)
+            if name in {"g", "grep", "gany", "gall"}:
+                match_any = {"gany": True, "gall": False}.get(name, self.grepopts["match_any"])
+                return self._text_req(args, match_any)
+            return None
+
+        # 'x' in tags, 'x' in notes, 'x' in text
+        if (
+            isinstance(node, ast.Compare)
+            and len(node.ops) == 1
+            and isinstance(node.ops[0], ast.In)
+            and isinstance(node.comparators[0], ast.Name)
+            and _conststr(node.left) is not None
+        ):
+            name = node.comparators[0].id
+            if name == "tags":
+                return _literal(node.left.value, False)
+            if name in {"notes", "text"}:
+                return _literal(node.left.value, True)
+        return None
+
+    @profiling.timed("prefilter")
+    def prefilter(self, note):
+        """Return False if the note's raw text cannot possibly pass the filter.
+
+        Reads (but does not parse) the note text. The text is reused by the
+        following `read()`. Notes already read, or new, always pass.
+        """
+        req = self.requirement
+        if req is None or not note.exists or note._data is not None:
+            return True
+        raw = note.read_raw()
+        if _raw_match(req, raw, raw.casefold()):
+            return True
+        debug(f"prefilter rejected {note.destnote0}")
+        return False
+
+    def __call__(self, note, tag_hit=None):
+        """Return whether a note matches.
+
+        `tag_hit` short-circuits the tag test when it is already known (e.g.
+        from the cache's tag index) so the note need not be read for it.
+        """
+        match_all = self.match_all
+
+        m = False  # whether we did anything
+        if self.grep:
+            full_note = self.grepopts.get("full_note", False)
+            t = note.grep(matcher=self.grepmatcher, full_note=full_note)
+            if match_all and not t:
+                return False  # short circuit
+            elif not match_all and t:
+                return True
+            m = True
+        if self.query:
+            t = self.notequery(note)
+            if match_all and not t:
+                return False  # short circuit
+            elif not match_all and t:
+                return True
+            m = True
+        if self.tags:
+            if tag_hit is not None:
+                t = tag_hit
+            else:
+                tags = set(t.lower() for t in note.data.tags)
+                if self.tag_all:
+                    t = len(self.tags - tags) == 0
+                else:
+                    t = len(self.tags.intersection(tags)) > 0
+            if match_all and not t:
+                return False  # short circuit
+            elif not match_all and t:
+                return True
+            m = True
+
+        # At this point, we either hit them all with ALL, we hit none with ANY,
+        # or didn't have a query
+        return match_all or not m
+
+
+# Literals are only used when they always appear verbatim in the raw text of a
+# note containing them: printable ASCII without whitespace (folded by YAML),
+# quotes or backslashes (escaped by YAML/JSON) and at least one letter (numbers
+# can be written many ways in YAML)
+_LITERAL = re.compile(r"[!#-&(-\[\]-~]*[A-Za-z][!#-&(-\[\]-~]*")
+
+# Also never words that YAML may read as (or from) non-strings and that then get
+# converted, e.g., `on` -> True -> 'yes' or a null note -> 'None'
+_SCALAR_WORDS = ("yes", "no", "on", "off", "true", "false", "null", "none", "inf", "nan")
+
+_REGEX_SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+
+def _conststr(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _literal(term, matchcase):
+    """Return a literal requirement for `term` or `None` if it isn't safe"""
+    if not _LITERAL.fullmatch(term):
+        return None
+    if any(term.casefold() in word for word in _SCALAR_WORDS):
+        return None
+    return ("lit", term if matchcase else term.casefold(), matchcase)
+
+
+def _combine(op, reqs):
+    """Combine requirements with "all" or "any". Unknown (`None`) requirements
+    are dropped from "all" but make "any" unknown."""
+    if op == "all":
+        reqs = [req for req in reqs if req is not None]
+    elif any(req is None for req in reqs):
+        return None
+    if not reqs:
+        return None
+    if len(reqs) == 1:
+        return reqs[0]
+    return (op, reqs)
+
+
+def _raw_match(req, raw, folded):
+    """Test a requirement against the raw text and its casefolded version"""
+    kind = req[0]
+    if kind == "lit":
+        _, term, matchcase = req
+        return term in (raw if matchcase else folded)
+    test = all if kind == "all" else any
+    return test(_raw_match(sub, raw, folded) for sub in req[1])
+
+
+def read_patterns(path):
+    """Return grep expressions from a file (or stdin for '-'), one per line.
+
+    Blank lines are skipped.
+    """
+    if path == "-":
+        import sys
+
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path) as fobj:
+            lines = fobj.read().splitlines()
+    return [line for line in lines if line.strip()]
+
+
+def parse_jobs(jobs):
+    """Return the number of jobs from an int, 'all', or `None` ($NOTEFILE_JOBS)."""
+    if jobs is None:
+        jobs = os.environ.get("NOTEFILE_JOBS", "1")
+    if isinstance(jobs, str):
+        if jobs.strip().lower() == "all":
+            return os.cpu_count() or 1
+        jobs = int(jobs)
+    return max(jobs, 1)
+
+
+# Worker state, set by _init_worker()
+_worker = {}
+
+
+def _init_worker(noteopts, filter, profile=False):
+    cache.configure(enabled=False)
+    profiling.configure(enabled=profile, dump=False)
+    _worker.update(noteopts=noteopts, filter=filter)
+
+
+def _read_chunk(paths):
+    """Read (and filter) notes in a worker.
+
+    Returns `None` or a record for each and the worker's `profiling.take()`.
+    """
+    from .notefile import Notefile
+
+    noteopts, filter = _worker["noteopts"], _worker["filter"]
+    res = []
+    for path in paths:
+        note = Notefile(path, **noteopts)
+        if filter is not None and not filter.prefilter(note):
+            res.append(None)
+            continue
+        note.read()
+        if filter is not None and not filter(note):
+            res.append(None)
+            continue
+        res.append({"data": dict(note._data), "text": note.txt, "state": {"format": note.format}})
+    return res, profiling.take()
+
+
+def parallel_read(notes, jobs, *, filter=None, ordered=True, noteopts=None, chunksize=64):
+    """Read and optionally filter notes with a pool of worker processes.
+
+    Parameters
+    ----------
+    notes:
+        Iterable of unread `Notefile` objects, e.g. from `find()`.
+    jobs:
+        Number of worker processes.
+    filter:
+        Optional picklable callable (e.g., `SearchFilter`) evaluated on each
+        note in the worker. Notes that fail it are dropped.
+    ordered:
+        Yield notes in input order (matching a serial read). Otherwise, yield
+        chunks as they complete.
+    noteopts:
+        `Notefile` options used by the workers. Must match those of `notes`.
+    chunksize:
+        Notes per worker task.
+
+    Yields
+    ------
+    Notefile
+        The input notes, read.
+    """
+    import multiprocessing as mp
+
+    initargs = (noteopts or {}, filter, profiling.ENABLED)
+    window = deque()
+    with mp.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        # Notes are fed from this thread rather than the pool's task thread
+        # since `find()` may be using a cache connection.
+        for chunk in _chunked(notes, chunksize):
+            task = pool.apply_async(_read_chunk, ([note.destnote0 for note in chunk],))
+            window.append((chunk, task))
+            while len(window) > 2 * jobs:
+                yield from _collect(window, ordered)
+        while window:
+            yield from _collect(window, ordered)
+
+
+def _chunked(iterable, n):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _collect(window, ordered):
+    """Pop one finished task from the window and yield its read notes."""
+    if ordered:
+        chunk, task = window.popleft()
+    else:
+        while not any(task.ready() for _, task in window):
+            window[0][1].wait(0.01)
+        for i, (chunk, task) in enumerate(window):
+            if task.ready():
+                break
+        del window[i]
+
+    records, stats = task.get()
+    profiling.merge(stats)
+    for note, record in zip(chunk, records):
+        if record is None:
+            continue
+        note._load_record(record)
+        debug(f"parallel read {note.destnote0}")
+        if note.exists:
+            cache.store(note)
+        yield note
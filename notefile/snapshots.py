@@ -0,0 +1,360 @@
+"""
+Optional per-directory snapshots for incremental `find()`.
+
+A snapshot records a directory's inode and mtime (and those of its note
+subdirectories) along with the part of its listing that a note search needs:
+subdirectories, notes, and the notes' targets. While the directory is unchanged,
+`find()` replays the snapshot rather than listing the directory again so
+searches of mostly static trees only list what changed since the last search.
+Unlike `notefile serve`, this persists between runs without a running process.
+
+Adding, removing, or renaming an entry changes the mtime of its directory, so a
+replayed listing has the same names as a fresh one. Whether a symlink points to
+a directory is not part of the snapshot and is checked when asked. Directories
+modified within `RACY_WINDOW` seconds are not recorded since a later change
+within the filesystem's timestamp resolution would not change their mtime.
+
+Snapshots are off by default. They are enabled with `$NOTEFILE_SNAPSHOTS` or the
+`--snapshots` CLI flag and stored at `$NOTEFILE_SNAPSHOT_DB` (default
+`~/.cache/notefile/notefile-snapshots.sqlite3`). They are not used when the
+note cache answers `find()` or when listing all files (e.g. for repairs).
+"""
+
+import json
+import os
+import stat
+
+from . import NOTESEXT, debug, fs
+from .find import NOTE_SUBDIRS
+
+SCHEMA_VERSION = 1
+
+DEFAULT_DB = os.path.join("~", ".cache", "notefile", "notefile-snapshots.sqlite3")
+
+# Directories modified this recently are not recorded
+RACY_WINDOW = 2.0
+
+# Run-level state. Reset by configure() on every CLI call.
+ENABLED = False
+DBPATH = None
+
+_store = None
+
+
+def env_enabled():
+    """Return whether `$NOTEFILE_SNAPSHOTS` enables snapshots."""
+    return os.environ.get("NOTEFILE_SNAPSHOTS", "false").strip().lower() == "true"
+
+
+def env_dbpath():
+    """Return the snapshot database path from `$NOTEFILE_SNAPSHOT_DB` or the default."""
+    path = os.environ.get("NOTEFILE_SNAPSHOT_DB", "").strip() or DEFAULT_DB
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def configure(enabled=None, dbpath=None):
+    """Set the snapshot behavior for this run.
+
+    Parameters
+    ----------
+    enabled:
+        `True` or `False` to override `$NOTEFILE_SNAPSHOTS`. `None` uses the
+        environment.
+    dbpath:
+        Database path. `None` uses `$NOTEFILE_SNAPSHOT_DB` or the default.
+    """
+    global ENABLED, DBPATH, _store
+    ENABLED = env_enabled() if enabled is None else bool(enabled)
+    dbpath = env_dbpath() if dbpath is None else os.path.abspath(dbpath)
+    if _store is not None and _store.path != dbpath:
+        _store.close()
+        _store = None
+    DBPATH = dbpath
+
+
+def store():
+    """Return the active snapshot store or `None` when disabled."""
+    if not ENABLED:
+        return None
+    global _store
+    if DBPATH is None:
+        configure(enabled=ENABLED)
+    if _store is None:
+        _store = SnapshotStore(DBPATH)
+    return _store
+
+
+def clear(dbpath=None):
+    """Delete the snapshot database (and SQLite side files)."""
+    global _store
+    dbpath = DBPATH if dbpath is None else dbpath
+    if dbpath is None:
+        dbpath = env_dbpath()
+    if _store is not None and _store.path == dbpath:
+        _store.close()
+        _store = None
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        try:
+            os.unlink(dbpath + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class SnapshotStore:
+    """Directory snapshots in an SQLite database. Safe to use from `find()`'s threads."""
+
+    def __init__(self, path):
+        """Open (lazily) the snapshot database at `path`."""
+        import threading
+
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._rows = {}  # Loaded snapshots by path
+        self._loaded = []  # Paths whose subtrees are loaded
+
+    @property
+    def conn(self):
+        """Return a connection for this process, creating the schema as needed."""
+        if self._conn is None or self._pid != os.getpid():
+            import sqlite3  # Lazy
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._init_schema()
+        return self._conn
+
+    def _init_schema(self):
+        """Create tables, resetting the database on a schema-version mismatch."""
+        conn = self._conn
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row and row[0] != str(SCHEMA_VERSION):
+            debug(f"snapshot schema {row[0]} != {SCHEMA_VERSION}. Resetting")
+            conn.execute("DROP TABLE IF EXISTS dirs")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                signature TEXT NOT NULL,
+                listing TEXT NOT NULL
+            )
+            """)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",
+            (str(SCHEMA_VERSION),),
+        )
+        conn.commit()
+
+    def close(self):
+        """Commit and close the connection if it is open in this process."""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.commit()
+                self._conn.close()
+            self._conn = None
+            self._pending = 0
+            self._rows, self._loaded = {}, []
+
+    def commit(self):
+        """Commit recorded snapshots and drop those loaded. Called when a walk finishes."""
+        with self._lock:
+            if self._pending and self._pid == os.getpid():
+                self._conn.commit()
+            self._pending = 0
+            self._rows, self._loaded = {}, []
+
+    def listing(self, path):
+        """Return `find._scandir(path)`, replaying the snapshot if it is current.
+
+        Otherwise the directory is listed and, unless it was modified too
+        recently, recorded.
+        """
+        from .find import _keep_listing, _listing_signature, _scandir_fresh
+
+        key = os.path.abspath(path)
+        row = self._row(key)
+        if row is not None and _unchanged(path, row[0]):
+            return _replay(path, json.loads(row[1]))
+
+        signature = _listing_signature(path, window=RACY_WINDOW)
+        listing = _scandir_fresh(path)
+        with self._lock:
+            if row is not None:
+                entries = listing[0] if listing is not None else {}
+                for name, kind in json.loads(row[1])[0].items():
+                    if kind == _DIR and _kind(entries.get(name)) != _DIR:
+                        self._forget(os.path.join(key, name))
+            if (
+                signature is not None
+                and listing is not None
+                and _keep_listing(listing, signature, symlinks=True)
+            ):
+                signature = [list(sig) if sig else None for sig in signature]
+                record = json.dumps(_record(listing))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO dirs (path, signature, listing) VALUES (?, ?, ?)",
+                    (key, json.dumps(signature), record),
+                )
+                self._rows[key] = signature, record
+                self._pending += 1
+        return listing
+
+    def _row(self, key):
+        """Return `(signature, listing JSON)` for `key` or `None`.
+
+        The first lookup in a walk loads the snapshots of the whole subtree in one
+        query rather than one query per directory.
+        """
+        with self._lock:
+            if not any(key == root or key.startswith(root + os.sep) for root in self._loaded):
+                rows = self.conn.execute(
+                    "SELECT path, signature, listing FROM dirs "
+                    "WHERE path = ? OR (path >= ? AND path < ?)",
+                    (key, key + os.sep, key + _AFTER_SEP),
+                )
+                self._rows.update((p, (json.loads(sig), rec)) for p, sig, rec in rows)
+                self._loaded.append(key)
+            return self._rows.get(key)
+
+    def _forget(self, key):
+        """Drop the snapshots of a directory that is gone and everything below it."""
+        self.conn.execute(
+            "DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            (key, key + os.sep, key + _AFTER_SEP),
+        )
+        for path in list(self._rows):
+            if path == key or path.startswith(key + os.sep):
+                del self._rows[path]
+        self._pending += 1
+
+
+def _unchanged(path, signature):
+    """Whether a directory and its recorded note subdirectories still match `signature`.
+
+    Note subdirectories that did not exist are not checked since creating one
+    changes the directory.
+    """
+    for name, sig in zip([None, *NOTE_SUBDIRS], signature):
+        if sig is None:
+            continue
+        try:
+            st = fs.stat(os.path.join(path, name) if name else path)
+        except OSError:
+            return False
+        if st.st_ino != sig[0] or st.st_mtime_ns != sig[1]:
+            return False
+    return True
+
+
+# Paths below a directory sort in [dir + "/", dir + "0") since "0" follows "/"
+_AFTER_SEP = chr(ord(os.sep) + 1)
+
+# Entry kinds in a record
+_DIR, _FILE, _LINK = "d", "f", "l"
+
+
+def _kind(entry):
+    if entry is None:
+        return None
+    try:
+        if entry.is_symlink():
+            return _LINK
+        return _DIR if entry.is_dir(follow_symlinks=False) else _FILE
+    except OSError:
+        return _FILE
+
+
+def _record(listing):
+    """Return the part of a listing that `find()` uses for notes, as JSON-able dicts.
+
+    All directories (and symlinks that may be), all notes, and the notes'
+    targets. Other files are not needed since only notes are yielded.
+    """
+    from .notefile import get_filenames
+
+    entries, subentries = listing
+    record_entries = {}
+    record_subentries = {}
+    targets = set()
+
+    for name, entry in entries.items():
+        kind = _kind(entry)
+        if name.lower().endswith(NOTESEXT):
+            targets.add(os.path.basename(get_filenames(name).filename))
+        elif kind == _FILE:
+            continue
+        record_entries[name] = kind
+
+    for subname, listed in subentries.items():
+        record_subentries[subname] = {}
+        for name, entry in listed.items():
+            if name.lower().endswith(NOTESEXT):
+                targets.add(os.path.basename(get_filenames(name).filename))
+                record_subentries[subname][name] = _kind(entry)
+
+    for name in targets:
+        entry = entries.get(name)
+        if entry is not None:
+            record_entries[name] = _kind(entry)
+
+    return [record_entries, record_subentries]
+
+
+def _replay(path, record):
+    """Rebuild `(entries, subentries)` from a record."""
+    record_entries, record_subentries = record
+    entries = {
+        name: _Entry(name, os.path.join(path, name), kind) for name, kind in record_entries.items()
+    }
+    subentries = {}
+    for subname, listed in record_subentries.items():
+        subpath = os.path.join(path, subname)
+        subentries[subname] = {
+            name: _Entry(name, os.path.join(subpath, name), kind) for name, kind in listed.items()
+        }
+    return entries, subentries
+
+
+class _Entry:
+    """Stand-in for `os.DirEntry` in a replayed listing."""
+
+    __slots__ = ("name", "path", "_kind")
+
+    def __init__(self, name, path, kind):
+        self.name = name
+        self.path = path
+        self._kind = kind
+
+    def is_symlink(self):
+        return self._kind == _LINK
+
+    def is_dir(self, *, follow_symlinks=True):
+        if self._kind == _LINK:
+            return follow_symlinks and self._test(stat.S_ISDIR)
+        return self._kind == _DIR
+
+    def is_file(self, *, follow_symlinks=True):
+        if self._kind == _LINK:
+            return follow_symlinks and self._test(stat.S_ISREG)
+        return self._kind == _FILE
+
+    def _test(self, is_mode):
+        """Test the mode of what a link points to (`False` if broken), as `os.DirEntry`."""
+        try:
+            return is_mode(fs.stat(self.path).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, *, follow_symlinks=True):
+        return fs.stat(self.path) if follow_symlinks else fs.lstat(self.path)
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"<_Entry {self.name!r}>"
@@ -1,7 +1,7 @@
 import os
 import sys
 
-from . import DT, debug, warn
+from . import DT, debug, fs, profiling, warn
 
 
 def now_string(Z=False):
@@ -56,7 +56,50 @@ class Bunch(dict):
         return "Bunch(**{})".format(s)
 
 
-def sha256(filepath, blocksize=2**20):
+class LRU:
+    """Thread-safe mapping that keeps the `maxsize` most recently used items.
+
+    Parameters
+    ----------
+    maxsize:
+        Number of items to keep.
+    """
+
+    def __init__(self, maxsize):
+        import threading
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the item for `key` (marking it used) or `default`."""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        """Set the item for `key`, dropping the least recently used if full."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+@profiling.timed("hash")
+def sha256(filepath, blocksize=2**20, throttle=None):
     """Hash a file with SHA-256.
 
     Parameters
@@ -65,6 +108,9 @@ def sha256(filepath, blocksize=2**20):
         File to read.
     blocksize:
         Number of bytes to stream per read. Useful for large files.
+    throttle:
+        Optional callable given the number of bytes after each read. Used to
+        limit bandwidth.
     """
     import hashlib
 
@@ -72,6 +118,8 @@ def sha256(filepath, blocksize=2**20):
     with open(filepath, "rb") as afile:
         buf = afile.read(blocksize)
         while len(buf) > 0:
+            if throttle:
+                throttle(len(buf))
             hasher.update(buf)
             buf = afile.read(blocksize)
     return hasher.hexdigest()
@@ -79,7 +127,7 @@ def sha256(filepath, blocksize=2**20):
 
 def tmpfileinpath(dirpath):
     """Return a random temporary filename alongside `dirpath`."""
-    if not os.path.isdir(dirpath):
+    if not fs.isdir(dirpath):
         dirpath = os.path.dirname(dirpath)
     return os.path.join(dirpath, ".notefile." + randstr(15))
 
@@ -177,7 +225,7 @@ def symlink_file(src, dstdir):
     dst = dst0 = os.path.join(dstdir, os.path.basename(src))
 
     for i in range(1, 100):  # Really shouldn't need 100. Make this an upper limit for safety
-        if not os.path.exists(dst):
+        if not fs.exists(dst):
             break
         a, b = os.path.splitext(dst0)
         dst = a + ".{}".format(i) + b
@@ -193,6 +241,7 @@ def symlink_file(src, dstdir):
         pass
 
     os.symlink(src, dst)
+    fs.invalidate(dst)
     debug(f"symlink {src} --> {dst}")
     return src
 
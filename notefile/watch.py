@@ -0,0 +1,470 @@
+"""
+Watch directories and keep the note cache up to date as files change.
+
+`NoteWatcher` turns filesystem events into incremental updates of the cache
+(see `cache`) and flags notes that became orphaned or whose target metadata
+drifted as soon as it happens, rather than finding them with full scans by
+`repair-orphaned`/`repair-metadata` or rebuilding with `cache build`.
+
+Events come from inotify (Linux, through ctypes) or, where that is not
+available or with `poll=`, from comparing periodic snapshots of the tree. Either
+way, an event only says which paths to look at again. Each path is then checked
+as it is now, so bursts of events for the same path are handled once.
+"""
+
+import os
+import time
+
+from . import NOTESEXT, cache, debug, fs, warn
+
+POLL_INTERVAL = 2.0  # Seconds between snapshots when polling
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+# Temporary files of note writes and edits. See `Notefile.write()` and
+# `utils.tmpfileinpath()`
+_TMP_PREFIX = ".notefile."
+_TMP_SUFFIX = NOTESEXT + ".swp"
+
+
+class NoteWatcher:
+    """Keep the note cache current and flag notes as their files change.
+
+    Parameters
+    ----------
+    paths:
+        Directories to watch, recursively. Symlinked directories are not followed.
+    excludes:
+        Glob patterns of names to ignore, as with `find()`.
+    matchcase:
+        Match `excludes` case-sensitively.
+    poll:
+        Poll every `poll` seconds rather than use inotify. Polling is also used,
+        every `POLL_INTERVAL` seconds, if inotify is not available.
+    noteopts:
+        Keyword arguments for `Notefile`.
+    report:
+        Called with `(status, note path)` for each status. Statuses are
+        'updated' (the note was created or changed and re-read), 'removed' (the
+        note was deleted or moved away), 'orphaned' (its target is gone), and
+        'changed' (the target's size, mtime, or directory listing no longer
+        match the note, as `repair_metadata()` would find). 'orphaned' and
+        'changed' are reported once until the note or its target change again.
+
+    Notes
+    -----
+    Notes are re-read from disk (even if the cache is trusted) and, when the
+    cache is enabled, stored in it.
+    """
+
+    def __init__(
+        self,
+        paths=".",
+        excludes=None,
+        matchcase=False,
+        poll=None,
+        noteopts=None,
+        report=None,
+    ):
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        self.paths = [str(path) for path in paths]
+        self.excludes = [excludes] if isinstance(excludes, str) else list(excludes or [])
+        self.matchcase = matchcase
+        self.noteopts = noteopts or {}
+        self.report = report
+        self.flags = {}  # Absolute note path: last reported 'orphaned' or 'changed'
+
+        self.backend = None
+        if poll is None:
+            try:
+                self.backend = _Inotify(self)
+            except OSError as E:
+                debug(f"inotify not available ({E}). Polling")
+                poll = POLL_INTERVAL
+        if self.backend is None:
+            self.backend = _Poller(self, poll)
+
+    def run(self, timeout=None):
+        """Watch until interrupted or, with `timeout`, for that many seconds."""
+        end = None if timeout is None else time.monotonic() + timeout
+        try:
+            while end is None or time.monotonic() < end:
+                left = 1.0 if end is None else min(1.0, max(end - time.monotonic(), 0))
+                self.step(timeout=left)
+        except KeyboardInterrupt:
+            pass
+
+    def step(self, timeout=None):
+        """Wait up to `timeout` seconds for changes and process them.
+
+        Returns
+        -------
+        list
+            `(status, note path)` for the statuses reported.
+        """
+        paths, gone_dirs = self.backend.changes(timeout)
+        results = []
+        trust, cache.TRUST_READS = cache.TRUST_READS, False  # Read the notes from disk
+        try:
+            for path in gone_dirs:
+                results.extend(self._dir_gone(path))
+            results.extend(self._process(paths))
+        finally:
+            cache.TRUST_READS = trust
+        if self.report is not None:
+            for result in results:
+                self.report(*result)
+        return results
+
+    def close(self):
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def excluded(self, name, isdir=False):
+        """Whether a file or directory name matches `excludes`."""
+        from .utils import exclude_in_place
+
+        if not self.excludes:
+            return False
+        names = [name]
+        exclude_in_place(names, self.excludes, isdir=isdir, matchcase=self.matchcase)
+        return not names
+
+    def walk(self, top):
+        """Yield `(root, dirs, files)` below `top` without excluded names or links.
+
+        Top-down like `os.walk` but lists with `fs.scandir` so it is counted.
+        Links to directories are in neither `dirs` nor `files`.
+        """
+        from .utils import exclude_in_place
+
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            try:
+                with fs.scandir(root) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+
+            dirs, files = [], []
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir()
+                except OSError:
+                    isdir = False
+                if not isdir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+
+            exclude_in_place(dirs, self.excludes, isdir=True, matchcase=self.matchcase)
+            if self.excludes:
+                exclude_in_place(files, self.excludes, matchcase=self.matchcase)
+            yield os.path.normpath(root), dirs, files
+            stack.extend(os.path.join(root, d) for d in reversed(dirs))
+
+    def _ignored(self, path):
+        name = os.path.basename(path)
+        if name.startswith(_TMP_PREFIX) or name.lower().endswith(_TMP_SUFFIX):
+            return True
+        return self.excluded(name, isdir=fs.isdir(path, cached=False))
+
+    def _process(self, paths):
+        """Check each changed path (and its directory, as a target) as it is now."""
+        results = []
+        targets = {}  # Ordered set
+        for path in paths:
+            if self._ignored(path):
+                continue
+            if path.lower().endswith(NOTESEXT):
+                results.extend(self._note_changed(path))
+            else:
+                targets[path] = None
+            # Any change in a directory changes its listing
+            parent = os.path.dirname(path)
+            if parent and os.path.basename(parent) not in {"", ".", ".."}:
+                targets[parent] = None
+
+        for path in targets:
+            note = self._note(path)
+            if note is not None and note.exists:
+                results.extend(self._check(note))
+        return results
+
+    def _note(self, path):
+        from .notefile import Notefile
+
+        try:
+            return Notefile(path, **self.noteopts)
+        except Exception as E:
+            debug(f"watch: skipping {path!r}: {E}")
+            return None
+
+    def _note_changed(self, notepath):
+        """Index (or drop) a created, changed, moved, or deleted note."""
+        key = os.path.abspath(notepath)
+        self.flags.pop(key, None)
+        if not fs.exists(notepath, cached=False):
+            cache.discard(notepath)
+            return [("removed", notepath)]
+
+        note = self._note(notepath)
+        if note is None or not note.exists:
+            return []
+        try:
+            note.read()  # Stores it in the cache
+        except Exception as E:
+            warn(f"Could not read {notepath!r}: {E}")
+            return []
+        return [("updated", note.destnote0)] + self._check(note)
+
+    def _check(self, note):
+        """Flag a note whose target is gone or whose metadata drifted."""
+        if note.orphaned:
+            status = "orphaned"
+        else:
+            try:
+                status = "changed" if note.repair_metadata(dry_run=True) else None
+            except Exception as E:
+                debug(f"watch: could not check {note.destnote0!r}: {E}")
+                status = None
+
+        key = os.path.abspath(note.destnote0)
+        if status == self.flags.get(key):
+            return []
+        if status is None:
+            del self.flags[key]
+            return []
+        self.flags[key] = status
+        return [(status, note.destnote0)]
+
+    def _dir_gone(self, path):
+        """Drop the notes below a directory that was deleted or moved away.
+
+        Only needed with inotify. The files in a moved directory do not get
+        their own events.
+        """
+        prefix = os.path.join(path, "")
+        notes = {os.path.abspath(p): p for p in self.backend.notes if p.startswith(prefix)}
+        db = cache.writer()
+        if db is not None:
+            for record in db.iter_records(path, with_data=False):
+                notepath = record["canonical_note_path"]
+                notes.setdefault(notepath, _relative_like(notepath, path))
+
+        results = []
+        for key, notepath in sorted(notes.items()):
+            if not fs.exists(key, cached=False):
+                self.backend.notes.discard(notepath)
+                cache.discard(key)
+                self.flags.pop(key, None)
+                results.append(("removed", notepath))
+        return results
+
+
+def _join(root, name):
+    return os.path.normpath(os.path.join(root, name))
+
+
+def _relative_like(abspath, like):
+    """Return `abspath` relative to the cwd if `like` is relative"""
+    return abspath if os.path.isabs(like) else os.path.relpath(abspath)
+
+
+class _Inotify:
+    """Recursive directory watch with inotify through ctypes.
+
+    Raises `OSError` if inotify is not available.
+    """
+
+    def __init__(self, watcher):
+        import ctypes
+        import ctypes.util
+
+        self.watcher = watcher
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as E:
+            raise OSError(f"no inotify: {E}")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), "inotify_init1 failed")
+        self.wds = {}  # wd: directory
+        self.notes = set()  # Note paths below the watched directories
+        try:
+            for path in watcher.paths:
+                self.add_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top):
+        """Watch `top` and the directories below it. Return the files found.
+
+        Raises `OSError` if the watch limit is reached.
+        """
+        import errno
+
+        files = []
+        for root, dirs, names in self.watcher.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(root), _WATCH_MASK)
+            if wd < 0:
+                err = self._get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "inotify watch limit reached (fs.inotify.max_user_watches)")
+                debug(f"watch: cannot watch {root!r}: {os.strerror(err)}")
+                dirs.clear()
+                continue
+            self.wds[wd] = root
+            files.extend(_join(root, name) for name in names)
+        self.notes.update(file for file in files if file.lower().endswith(NOTESEXT))
+        return files
+
+    def remove_tree(self, top):
+        """Stop watching `top` and the directories below it."""
+        prefix = os.path.join(top, "")
+        for wd, path in list(self.wds.items()):
+            if path == top or path.startswith(prefix):
+                self._rm_watch(self.fd, wd)  # Fails (harmlessly) if already gone
+                del self.wds[wd]
+
+    def changes(self, timeout):
+        """Return `(paths, gone directories)` from the events within `timeout`."""
+        import select
+        import struct
+
+        paths, gone = {}, []  # Ordered set and list
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return [], []
+
+        header = struct.Struct("iIII")
+        while True:
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, size = header.unpack_from(buf, pos)
+                pos += header.size
+                name = os.fsdecode(buf[pos : pos + size].rstrip(b"\0"))
+                pos += size
+                self._event(wd, mask, name, paths, gone)
+        return list(paths), gone
+
+    def _event(self, wd, mask, name, paths, gone):
+        if mask & IN_Q_OVERFLOW:
+            warn("Filesystem events were lost. Checking all paths")
+            for top in self.watcher.paths:
+                self.remove_tree(top)
+                paths.update(dict.fromkeys(self.add_tree(top)))
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        root = self.wds.get(wd)
+        if root is None or not name:  # A gone watch or an event on the directory itself
+            return
+
+        path = _join(root, name)
+        if path.lower().endswith(NOTESEXT):
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.notes.discard(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.notes.add(path)
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.remove_tree(path)
+                gone.append(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and not self.watcher.excluded(name, True):
+                # Files can be added before the watch is. Check everything in it
+                paths.update(dict.fromkeys(self.add_tree(path)))
+        paths[path] = None
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+
+
+class _Poller:
+    """Find changes by comparing snapshots of the tree taken every `interval`."""
+
+    notes = frozenset()  # Not needed since every path is in the snapshot
+
+    def __init__(self, watcher, interval):
+        self.watcher = watcher
+        self.interval = interval
+        self.snapshot = self._snapshot()
+        self.next = time.monotonic() + interval
+
+    def _snapshot(self):
+        snapshot = {}  # path: (inode, size, mtime_ns)
+        for top in self.watcher.paths:
+            for root, _, files in self.watcher.walk(top):
+                for path in [root] + [_join(root, name) for name in files]:
+                    try:
+                        st = fs.lstat(path, cached=False)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout):
+        """Return `(paths, [])` changed since the last snapshot, waiting up to `timeout`."""
+        wait = self.next - time.monotonic()
+        if timeout is not None and wait > timeout:
+            time.sleep(max(timeout, 0))
+            return [], []
+        time.sleep(max(wait, 0))
+        self.next = time.monotonic() + self.interval
+
+        old, new = self.snapshot, self._snapshot()
+        self.snapshot = new
+        paths = [path for path, sig in new.items() if old.get(path) != sig]
+        paths.extend(path for path in old if path not in new)
+        return sorted(paths), []
+
+    def close(self):
+        pass
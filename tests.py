@@ -19,6 +19,7 @@ import itertools
 import json
 import os
 import pickle
+import re
 import shlex
 import shutil
 import sys
@@ -798,6 +799,90 @@ def test_find_exclusions():
     os.chdir(TESTDIR)
 
 
+def test_find_walk_threads():
+    """
+    Test that the threaded walker yields the same results in the same order
+    """
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "find-walk-threads"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(40):
+        file = Path(f"D{i % 3}/sub{i % 4}/.deeper{i % 2}/file{i}.txt")
+        file.parent.mkdir(exist_ok=True, parents=True)
+        file.write_text(f"{file}")
+        call(f"mod -t tag{i % 3} {file} {'-H' if i % 5 else ''} {'-S' if i % 7 else ''}")
+    writefile("top.txt", "top")
+    call("mod -t top top.txt")
+    os.symlink("D1", "linked")  # Listed as a dir but not walked
+    os.unlink("D1/sub1/.deeper1/file13.txt")  # orphan
+
+    for kwargs in [
+        {},
+        dict(maxdepth=1),
+        dict(excludes=["sub2/", "*9*"]),
+        dict(include_orphaned=True, exclude_links=True),
+        dict(filemode=True, targetmode="both"),
+    ]:
+        names = lambda threads: [
+            r if isinstance(r, str) else r.destnote0
+            for r in notefile.find(threads=threads, **kwargs)
+        ]
+        serial = names(0)
+        assert serial, kwargs
+        assert names(3) == serial, kwargs
+
+    o0, _ = call("find", capture=True)
+    o3, _ = call("find --walk-threads 3", capture=True)
+    assert o0 == o3
+
+    os.chdir(TESTDIR)
+
+
+def test_find_from_listing():
+    """
+    Test that find() builds notes from the directory listing without probing
+    """
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "find-from-listing"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(12):
+        writefile(f"sub{i % 2}/file{i}.txt", f"{i}")
+        call(f"mod -t tag sub{i % 2}/file{i}.txt {'-H' if i % 3 else ''} {'-S' if i % 4 else ''}")
+    Path("adir").mkdir()
+    call("mod -t tag adir/")
+    writefile("gone.txt", "gone")
+    call("mod -t tag gone.txt")
+    os.unlink("gone.txt")
+
+    expected = [
+        (n.destnote0, n.orphaned, n.isdir0)
+        for n in notefile.find(include_orphaned=True, targetmode="both")
+    ]
+    expected2 = [(n.destnote0, n.orphaned, n.isdir0) for n in (Notefile(d) for d, *_ in expected)]
+    assert expected == expected2
+    assert len(expected) == 14
+
+    probes = []
+    patched = {}
+    for mod, name in [(os.path, "exists"), (os.path, "lexists"), (os.path, "islink"), (os, "stat")]:
+        orig = patched[mod, name] = getattr(mod, name)
+        setattr(mod, name, lambda *a, _o=orig, _n=name, **k: probes.append(_n) or _o(*a, **k))
+    try:
+        notes = list(notefile.find(include_orphaned=True, targetmode="both"))
+    finally:
+        for (mod, name), orig in patched.items():
+            setattr(mod, name, orig)
+
+    assert [(n.destnote0, n.orphaned, n.isdir0) for n in notes] == expected
+    assert probes == ["stat"]  # isfile() of the root
+
+    os.chdir(TESTDIR)
+
+
 def test_outputs_export():
     os.chdir(TESTDIR)
     dirpath = TESTDIR / "outputs"
@@ -1895,6 +1980,54 @@ def test_orphan_repair():
     os.chdir(TESTDIR)
 
 
+def test_orphan_repair_batch():
+    """
+    Test that batch repair walks once and hashes each candidate once
+    """
+    import notefile.repair
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "orphan-repair-batch"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    Path("old").mkdir()
+    Path("new").mkdir()
+    for name in "abc":
+        writefile(f"old/{name}.txt", f"content {name}")  # all the same size
+        call(f"mod -t tag old/{name}.txt")
+        shutil.move(f"old/{name}.txt", f"new/{name}2.txt")
+    writefile("new/decoy.txt", "content d")
+
+    Index = notefile.repair.SearchIndex
+    walk0, sha0 = Index._walk, notefile.repair.sha256
+    walks, hashed = [], []
+
+    def counting_walk(self):
+        walks.append(self.findopts["path"])
+        return walk0(self)
+
+    def counting_sha256(path):
+        hashed.append(path)
+        return sha0(path)
+
+    try:
+        Index._walk = counting_walk
+        notefile.repair.sha256 = counting_sha256
+        o, e = call("repair-orphaned --path old --search-path new", capture=True)
+    finally:
+        Index._walk, notefile.repair.sha256 = walk0, sha0
+
+    assert walks == [["new"]]
+    assert sorted(hashed) == ["new/a2.txt", "new/b2.txt", "new/c2.txt", "new/decoy.txt"]
+    assert set(o.strip().split("\n")) == {
+        f"old/{name}.txt.notes.yaml --> new/{name}2.txt.notes.yaml" for name in "abc"
+    }
+    assert not e
+
+    os.chdir(TESTDIR)
+
+
 def test_cat():
     """
     cat
@@ -2106,6 +2239,1453 @@ def test_subdir():
     }
 
 
+def test_cache():
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "cache"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    dbpath = dirpath / "cache.sqlite3"
+    env0 = os.environ.get("NOTEFILE_CACHE_DB")
+    os.environ["NOTEFILE_CACHE_DB"] = str(dbpath)
+    try:
+        writefile("file1.txt", "file1")
+        writefile("sub/file2.txt", "file2")
+        writefile("sub/file3.txt", "file3")
+        call('mod file1.txt -t tag1 -n "note one"')
+        call('mod sub/file2.txt -t tag2 -n "note two" -H')
+        call('mod sub/file3.txt -t tag2 -n "note three" --subdir')
+        assert not dbpath.exists()  # Off by default
+
+        call("--cache find -o tmp")
+        assert not Path("tmp").exists()  # Trusted but empty cache
+
+        o, _ = call("cache build", capture=True)
+        assert o == "cached 3 notes\n"
+
+        call("--cache find -o tmp")
+        assert Path("tmp").read_text() == "file1.txt\nsub/file3.txt\nsub/file2.txt\n"  # Walk order
+        call("find --cache --max-depth 0 -o tmp")
+        assert readout("tmp") == {"file1.txt"}
+        call("find --cache --exclude 'sub/' -o tmp")
+        assert readout("tmp") == {"file1.txt"}
+        call("find --cache -p sub --exclude '*3*' -o tmp")
+        assert readout("tmp") == {"sub/file2.txt"}
+
+        # Cached reads are trusted. Change the file behind the cache's back
+        Path("file1.txt.notes.yaml").write_text(
+            Path("file1.txt.notes.yaml").read_text().replace("note one", "edited")
+        )
+        o, _ = call("cat --cache file1.txt", capture=True)
+        assert o == "note one\n"
+        o, _ = call("cat --no-cache file1.txt", capture=True)
+        assert o == "edited\n"
+
+        # Writes go to the file and then update the cache
+        call('mod --cache file1.txt -n "more"')
+        assert Notefile("file1.txt").read().data.notes == "note one\nmore"
+        call("--cache grep more -o tmp")
+        assert readout("tmp") == {"file1.txt"}
+        call("--cache tags --tag-counts -o tmp")
+        assert readtags("tmp") == {"tag1": 1, "tag2": 2}
+
+        # New notes written with the cache enabled are found
+        writefile("file4.txt", "file4")
+        call("mod --cache file4.txt -t tag4")
+        call("--cache search --tag tag4 -o tmp")
+        assert readout("tmp") == {"file4.txt"}
+
+        # Moves replace the old record
+        call("--cache hide file4.txt")
+        call("--cache find -o tmp")
+        assert readout("tmp") == {"file1.txt", "file4.txt", "sub/file2.txt", "sub/file3.txt"}
+        assert Notefile("file4.txt").destnote0 == ".file4.txt.notes.yaml"
+
+        # Tag index. Answered without reading the (now stale) note files
+        Path("sub/.file2.txt.notes.yaml").write_text("{}")
+        call("--cache search --tag tag2 -o tmp")
+        assert readout("tmp") == {"sub/file2.txt", "sub/file3.txt"}
+        Path("tmp").unlink()
+        call("--cache search --tag tag2 --tag tag4 --tag-all -o tmp")
+        assert not Path("tmp").exists()
+        call("--cache tags -o tmp")
+        assert readtags("tmp") == {
+            "tag1": {"file1.txt"},
+            "tag2": {"sub/file2.txt", "sub/file3.txt"},
+            "tag4": {"file4.txt"},
+        }
+        call("cache build")
+        call("--cache tags --tag-counts -o tmp")
+        assert readtags("tmp") == {"tag1": 1, "tag2": 1, "tag4": 1}
+
+        # Index is updated by change-tag
+        call("--cache change-tag tag4 tag5")
+        call("--cache tags --tag-counts -o tmp")
+        assert readtags("tmp") == {"tag1": 1, "tag2": 1, "tag5": 1}
+
+        call("cache clear")
+        assert not dbpath.exists()
+    finally:
+        notefile.cache.configure(enabled=False)
+        if env0 is None:
+            del os.environ["NOTEFILE_CACHE_DB"]
+        else:
+            os.environ["NOTEFILE_CACHE_DB"] = env0
+
+    os.chdir(TESTDIR)
+
+
+def test_hash_memo():
+    import notefile.utils
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "hash-memo"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    env0 = os.environ.get("NOTEFILE_CACHE_DB")
+    os.environ["NOTEFILE_CACHE_DB"] = str(dirpath / "cache.sqlite3")
+    sha0 = notefile.utils.sha256
+    hashed = []
+
+    def counting_sha256(path, *args, **kwargs):
+        hashed.append(os.path.basename(path))
+        return sha0(path, *args, **kwargs)
+
+    def backdate(path):
+        t = time.time() - 100
+        os.utime(path, (t, t))
+
+    try:
+        notefile.utils.sha256 = counting_sha256
+        writefile("old.txt", "old")
+        writefile("new.txt", "new")
+        backdate("old.txt")
+
+        call("--cache mod -t tag old.txt new.txt")
+        assert sorted(hashed) == ["new.txt", "old.txt"]
+
+        hashed.clear()
+        call("--cache repair-metadata --force-refresh")
+        assert hashed == ["new.txt"]  # Too recent to memoize
+
+        hashed.clear()
+        call("--cache cache build")
+        call("--cache repair-metadata --force-refresh")
+        assert hashed == ["new.txt"]  # build keeps the memo
+
+        # Same size, new mtime
+        writefile("old.txt", "OLD")
+        backdate("old.txt")
+        hashed.clear()
+        call("--cache repair-metadata --force-refresh")
+        assert sorted(hashed) == ["new.txt", "old.txt"]
+        assert Notefile("old.txt").read().data.sha256 == sha0("old.txt")
+
+        # Without the cache, no memo
+        hashed.clear()
+        call("repair-metadata --force-refresh")
+        assert sorted(hashed) == ["new.txt", "old.txt"]
+    finally:
+        notefile.utils.sha256 = sha0
+        notefile.cache.configure(enabled=False)
+        if env0 is None:
+            del os.environ["NOTEFILE_CACHE_DB"]
+        else:
+            os.environ["NOTEFILE_CACHE_DB"] = env0
+
+    os.chdir(TESTDIR)
+
+
+def test_hash_pool():
+    from notefile.hashing import HashPool, RateLimiter, parse_rate
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "hash-pool"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    assert parse_rate("100") == 100
+    assert parse_rate("1.5K") == 1536
+    assert parse_rate("2MB/s") == 2 * 2**20
+    assert parse_rate("0") is None
+    with pytest.raises(ValueError):
+        parse_rate("fast")
+
+    limiter = RateLimiter(1000)
+    t0 = time.monotonic()
+    for _ in range(3):
+        limiter(100)
+    assert time.monotonic() - t0 >= 0.19  # 3rd call waits for the first two
+
+    files = [f"file{i}.txt" for i in range(10)]
+    for i, file in enumerate(files):
+        writefile(file, f"file {i}" * (i + 1))
+
+    # Order and hashes are preserved across workers
+    o, _ = call(f"mod -t new --hash-workers 3 {' '.join(files)}", capture=True)
+    assert o.split() == files
+    for file in files:
+        assert Notefile(file).read().data.sha256 == notefile.utils.sha256(file)
+
+    # mod writes each note before reading the next
+    writefile("a.txt", "a")
+    writefile("b.txt", "b")
+    with pytest.raises(SysExitError):
+        call("mod a.txt missing.txt -t x")
+    assert Notefile("a.txt").read().data.tags == ["x"]
+    call("mod b.txt b.txt --note foo --hash-workers 3")
+    assert Notefile("b.txt").read().data.notes == "foo\nfoo"
+
+    for file in files:
+        with open(file, "at") as f:
+            f.write("more")
+    o, _ = call("repair-metadata --hash-workers 3 --hash-bwlimit 1M", capture=True)
+    assert len(o.splitlines()) == len(files)
+    for file in files:
+        assert Notefile(file).read().data.sha256 == notefile.utils.sha256(file)
+
+    # API: notes without a deferred hash pass through untouched
+    note = Notefile("file0.txt").read()
+    with HashPool(workers=2) as pool:
+        assert list(pool.resolve_deferred([note])) == [note]
+
+    os.chdir(TESTDIR)
+
+
+def test_export_stream():
+    from notefile.export import write_export
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "export-stream"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    notes = []
+    for i in range(10):
+        file = f"file{i}.txt" if i % 3 else f"sub dir/file {i}: \u00e9.txt"
+        writefile(file, f"file {i}")
+        note = Notefile(file).read()
+        note.add_note(f"note {i}\nsecond line" if i % 2 else f"note {i} " + "long " * 30)
+        note.modify_tags(add=[f"t{i % 3}"])
+        note.data["custom"] = {"n": i, "list": [1, {"a": None}]}
+        note.write()
+        notes.append(note.read())
+
+    def notime(text):
+        return re.sub(r'(?m)^time: .*$|"time": "[^"]*"', "", text)
+
+    def exported(notes, format, **kw):
+        out = io.BytesIO()
+        assert write_export(notes, out, format, **kw) == len(notes)
+        return out.getvalue().decode("utf8")
+
+    # Same as dumping it all at once
+    res = {"__comment": "YAML formatted notefile export", "description": "notefile export"}
+    res["time"] = ""
+    res["notefile version"] = notefile.__version__
+    res["notes"] = {note.names0.filename: note.data for note in notes}
+    assert notime(exported(notes, "json")) == notime(json.dumps(res, indent=1, ensure_ascii=False))
+    res["notes"] = {}
+    assert notime(exported([], "json")) == notime(json.dumps(res, indent=1, ensure_ascii=False))
+
+    del res["__comment"]
+    res["notes"] = {note.names0.filename: note.data for note in notes}
+    res = notefile.nfyaml.ruamel_yaml.comments.CommentedMap(notefile.nfyaml.pss(res))
+    res.yaml_set_start_comment("YAML formatted notefile export")
+    buf = io.StringIO()
+    notefile.nfyaml.yaml.dump(res, buf)
+    assert notime(exported(notes, "yaml")) == notime(buf.getvalue())
+    assert notefile.nfyaml.load_yaml(exported([], "yaml"))["notes"] == {}
+
+    for format in ["yaml", "json", "jsonl"]:
+        serial = exported(notes, format)
+        assert notime(exported(notes, format, jobs=3, chunksize=2)) == notime(serial)
+
+    # Notes are written as they come
+    out = io.BytesIO()
+
+    def produce():
+        for i, note in enumerate(notes):
+            if i == 2:
+                assert out.getvalue().count(b"__filename") == 2
+            yield note
+
+    write_export(produce(), out, "jsonl")
+
+    with pytest.raises(ValueError):
+        write_export(notes, io.BytesIO(), "xml")
+
+    os.chdir(TESTDIR)
+
+
+@pytest.mark.parametrize("format", ("yaml", "json", "jsonl"))
+def test_import(format):
+    from notefile.export import read_export
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "import"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(6):
+        writefile(f"sub/file{i}.txt", f"file {i}")
+        note = Notefile(f"sub/file{i}.txt", subdir=i == 1, hidden=i == 2).read()
+        note.add_note(f"note {i}\nline" if i % 2 else f"note {i}")
+        note.modify_tags(add=[f"t{i}"])
+        note.write()
+    os.makedirs("dir")
+    call("mod dir -t dirtag")
+    writefile("new.txt", "new")
+
+    call(f"export -o export.{format} --export-format {format}")
+    before = {name: data for name, data in read_export(open(f"export.{format}"))}
+    assert len(before) == 7 and "dir" in before
+    assert before["sub/file1.txt"]["notes"] == "note 1\nline"
+
+    # Nothing changed so nothing is written
+    mtimes = {p: os.stat(p).st_mtime_ns for p in glob.glob("**/*.yaml", recursive=True)}
+    o, _ = call(f"import export.{format}", capture=True)
+    assert not o
+    assert mtimes == {p: os.stat(p).st_mtime_ns for p in glob.glob("**/*.yaml", recursive=True)}
+
+    # Edit the export
+    with open(f"export.{format}") as f:
+        text = f.read()
+    text = text.replace("note 3", "edited 3").replace("t5", "t55")
+    if format == "jsonl":
+        text += json.dumps({"__filename": "new.txt", "notes": "new note", "tags": ["n"]}) + "\n"
+        text += json.dumps({"__filename": "missing.txt", "notes": "nope"}) + "\n"
+    with open(f"edited.{format}", "wt") as f:
+        f.write(text)
+
+    o, _ = call(f"import --dry-run edited.{format}", capture=True)
+    expected = ["sub/file3.txt", "sub/file5.txt"] + (["new.txt"] if format == "jsonl" else [])
+    assert o.splitlines() == ["# DRY RUN"] + expected
+    assert Notefile("sub/file3.txt").read().data.notes == "note 3\nline"
+
+    o, _ = call(f"import edited.{format} --import-format {format}", capture=True)
+    assert o.splitlines() == expected
+    assert Notefile("sub/file3.txt").read().data.notes == "edited 3\nline"
+    assert Notefile("sub/file5.txt").read().data.tags == ["t55"]
+    assert Notefile("sub/file2.txt").read().is_hidden  # Existing notes stay put
+    if format == "jsonl":
+        assert Notefile("new.txt").read().data.tags == ["n"]
+        assert not Notefile("missing.txt").exists
+
+    o, _ = call(f"import edited.{format}", capture=True)
+    assert not o
+
+    # Restore
+    o, _ = call(f"import export.{format}", capture=True)
+    assert sorted(o.splitlines()) == ["sub/file3.txt", "sub/file5.txt"]
+    exported = {name: data for name, data in read_export(open(f"export.{format}"))}
+    call(f"export -o export2.{format} --export-format {format}")
+    again = {name: data for name, data in read_export(open(f"export2.{format}"))}
+    for data in [*exported.values(), *again.values()]:
+        del data["last-updated"]
+    if format == "jsonl":
+        del again["new.txt"]
+    assert again == exported
+
+    # Not our layout
+    if format == "yaml":
+        with open("flow.yaml", "wt") as f:
+            f.write("notes: {sub/file0.txt: {notes: flow, tags: [f]}}\n")
+        assert list(read_export(open("flow.yaml"))) == [
+            ("sub/file0.txt", {"notes": "flow", "tags": ["f"]})
+        ]
+    elif format == "json":
+        with open("compact.json", "wt") as f:
+            json.dump({"notes": {"a": {"tags": []}, "b": {}}, "description": "x"}, f)
+        assert list(read_export(open("compact.json"))) == [("a", {"tags": []}), ("b", {})]
+        with pytest.raises(ValueError):
+            list(read_export(io.StringIO('{"notes": [1]}'), format="json"))
+
+    os.chdir(TESTDIR)
+
+
+def test_batch():
+    import subprocess
+
+    from notefile import batch, daemon
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "batch"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    files = [f"d{i % 4}/file {i}.txt" for i in range(40)]
+    for file in files:
+        writefile(file, file)
+    Notefile(files[0]).read().modify_tags(add=["old"]).write()
+
+    changes = [{"path": file, "add": [f"t{i % 3}"]} for i, file in enumerate(files)]
+    changes[1]["note"] = "one"
+    changes[2].update(remove="old", fields={"other": "text"})
+    changes.append({"path": files[1], "note": "again", "add": "more"})  # Same note
+    changes.append(files[0])  # Nothing to do
+    changes.append({"path": "missing/file.txt"})
+
+    summary = batch.apply(changes, threads=4, add="all")
+    assert summary == {"written": 41, "unchanged": 1, "failed": 1}
+    note = Notefile(files[1]).read()
+    assert note.data.tags == ["all", "more", "t1"] and note.data.notes == "one\nagain"
+    assert Notefile(files[0]).read().data.tags == ["all", "old", "t0"]
+    assert Notefile(files[2]).read().data.other == "text"
+
+    results = list(batch.iter_apply(changes[:5], threads=2, remove="all", dry_run=True))
+    assert [r.path for r in results] == files[:5]
+    assert all(r.status == "written" for r in results)
+    assert "all" in Notefile(files[3]).read().data.tags
+
+    with pytest.raises(ValueError):
+        batch.apply([{"path": files[0], "tag": "typo"}])
+
+    # CLI
+    with open("changes.txt", "wt") as f:
+        f.write(f"{files[5]}\n\n")
+        f.write(json.dumps({"path": files[6], "remove": ["t0"], "note": "json"}) + "\n")
+    o, e = call("mod --from-file changes.txt -t cli --threads 2", capture=True)
+    assert o.splitlines() == files[5:7]
+    assert e.strip() == "written: 2, unchanged: 0, failed: 0"
+    assert Notefile(files[6]).read().data.tags == ["all", "cli"]
+    assert Notefile(files[6]).read().data.notes == "json"
+
+    with pytest.raises(SysExitError):
+        call("mod -t tag")  # Nothing to modify
+    with pytest.raises(SysExitError):
+        call("mod --from-file changes.txt --edit")
+    with pytest.raises(SysExitError):
+        call("mod --stdin0 --from-file - -t tag")  # Both read stdin
+
+    env = dict(os.environ, PYTHONPATH=str(Path(notefile.__file__).parents[1]))
+    res = subprocess.run(
+        [sys.executable, "-m", "notefile", "mod", "--stdin0", "-t", "zero"],
+        input="\0".join(files[10:13]).encode() + b"\0",
+        capture_output=True,
+        env=env,
+        check=True,
+    )
+    assert res.stdout.decode().splitlines() == files[10:13]
+    assert "zero" in Notefile(files[12]).read().data.tags
+    assert not daemon.forwardable(["mod", "--stdin0", "-t", "tag"])
+    assert not daemon.forwardable(["mod", "--from-file=-", "-t", "tag"])
+
+    assert list(batch.read_paths0(io.BytesIO(b"a\0b c\0\0d"), blocksize=3)) == ["a", "b c", "d"]
+
+    os.chdir(TESTDIR)
+
+
+def test_parallel_read():
+    def notime(export):  # Remove the export time
+        return re.sub(r'(?m)^time: .*$|"time": "[^"]*"', "", export)
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "parallel-read"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(150):
+        file = f"d{i % 7}/file{i:03d}.txt"
+        writefile(file, f"file {i}")
+        note = Notefile(file)
+        note.modify_tags(add=[f"t{i % 3}", f"t{i % 5}"])
+        note.add_note(f"note {i} {'odd' if i % 2 else 'even'}")
+        note.write()
+
+    for cmd in [
+        "search --tag t1",
+        "search --tag t1 --tag t2 --all",
+        "grep even",
+        "grep even --tag t4 --all",
+        "query \"t('t0') and not g('odd')\"",
+        "tags --tag-counts",
+        "export",
+    ]:
+        serial, _ = call(cmd, capture=True)
+        par, _ = call(f"{cmd} --jobs 3", capture=True)
+        serial, par = notime(serial), notime(par)
+        assert serial and serial == par, cmd
+
+    for cmd in ["grep even", "export --export-format jsonl"]:
+        serial, _ = call(cmd, capture=True)
+        unordered, _ = call(f"{cmd} --jobs 3 --unordered", capture=True)
+        serial, unordered = notime(serial), notime(unordered)
+        assert sorted(serial.splitlines()) == sorted(unordered.splitlines()), cmd
+
+    serial, _ = call("grep even", capture=True)
+    assert len(serial.splitlines()) == 75
+    os.environ["NOTEFILE_JOBS"] = "all"
+    try:
+        assert call("grep even", capture=True)[0] == serial
+    finally:
+        del os.environ["NOTEFILE_JOBS"]
+
+    # Modifying commands work on notes read by the workers
+    call("change-tag t0 t00 --jobs 2")
+    o, _ = call("search --tag t00", capture=True)
+    assert len(o.splitlines()) == 70
+    assert "t0" not in Notefile("d0/file000.txt").read().data.tags
+
+    os.chdir(TESTDIR)
+
+
+def test_search_prefilter():
+    """
+    Test that notes are rejected on their raw text without changing results
+    """
+    from notefile.search import SearchFilter
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "search-prefilter"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(30):
+        file = f"file{i:02d}.txt"
+        writefile(file, f"file {i}")
+        note = Notefile(file, format="json" if i % 4 == 0 else "yaml")
+        note.modify_tags(add=[f"tag{i % 3}", "Yes" if i % 5 == 0 else "other"])
+        note.add_note(f"note {i} {'Odd' if i % 2 else 'even'}")
+        note.write()
+
+    def expected(**kw):
+        filt = SearchFilter(**kw)
+        names = (n.names0.filename for n in notefile.find(noteopts={}))
+        return [f"{name}\n" for name in names if filt(Notefile(name).read())]
+
+    for cmd, kw, nrejected in [
+        ("search --tag tag1", dict(tags=["tag1"]), 20),
+        ("search --tag tag1 --tag tag2", dict(tags=["tag1", "tag2"]), 10),
+        ("search --tag yes", dict(tags=["yes"]), 0),  # may be read from `true`
+        ("grep odd", dict(grep=["odd"]), 15),
+        ("grep Odd --match-expr-case", dict(grep=["Odd"], matchcase=True), 15),
+        ("grep 'od+'", dict(grep=["od+"]), 0),  # not a literal
+        ("grep 'o d'", dict(grep=["o d"]), 0),  # YAML could fold it
+        ("grep even --tag tag0 --all", dict(grep=["even"], tags=["tag0"], match_all=True), 25),
+        ("grep even --tag tag0", dict(grep=["even"], tags=["tag0"]), 10),
+        ("query \"t('tag0') and g('odd')\"", dict(query=["t('tag0') and g('odd')"]), 25),
+        ("query \"tall('tag0', 'tag1')\"", dict(query=["tall('tag0', 'tag1')"]), 30),
+        (
+            "query \"t('tag0') or 'even' in notes\"",
+            dict(query=["t('tag0') or 'even' in notes"]),
+            10,
+        ),
+        ("query \"t('tag0') or len(tags) > 5\"", dict(query=["t('tag0') or len(tags) > 5"]), 0),
+        ("query \"not t('tag0')\"", dict(query=["not t('tag0')"]), 0),
+    ]:
+        with CaptureDebug():
+            out, err = call(cmd, capture=True)
+        assert out.splitlines(keepends=True) == expected(**kw), cmd
+        assert err.count("prefilter rejected") == nrejected, cmd
+
+        par, _ = call(f"{cmd} --jobs 2", capture=True)
+        assert par == out, cmd
+
+    # Rejected notes are not parsed and passing notes are only opened once
+    with CaptureDebug():
+        _, err = call("grep odd", capture=True)
+    assert err.count("DEBUG: loading") == 30
+
+    os.chdir(TESTDIR)
+
+
+def test_note_query_compiled():
+    """
+    Test that NoteQuery parses once and matches per-note safe_query
+    """
+    import ast
+
+    from notefile.notefile import NoteQuery, QueryError
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "note-query-compiled"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    notes = []
+    for i in range(12):
+        writefile(f"file{i}.txt", f"{i}")
+        note = Notefile(f"file{i}.txt")
+        note.modify_tags(add=[f"t{i % 3}", f"u{i % 2}"])
+        note.add_note(f"note {i} {'odd' if i % 2 else 'even'}")
+        note.write()
+        notes.append(Notefile(f"file{i}.txt").read())
+
+    queries = [
+        "t('t0') and not g('odd')",
+        "tall('t1', 'u1') or gany('note 4', 'nope')",
+        "x = len(tags)\nx == 2 and 'u0' in tags",
+        "any(t.startswith('t2') for t in tags) and data.get('filesize') == 1",
+        "[n for n in notes.split() if n in {'odd', 'even'}] == ['even']",
+        "re.search(r'note \\d', notes) is not None and filename.endswith('.txt')",
+    ]
+
+    real_parse = ast.parse
+    parses = []
+    ast.parse = lambda *a, **k: parses.append(a) or real_parse(*a, **k)
+    try:
+        results = {}
+        for match_any in [True, False]:
+            query = NoteQuery(queries, match_any=match_any)
+            got = results[match_any] = [query(note) for note in notes]
+            assert len(parses) == len(queries)
+            del parses[:]
+
+            expected = [note.safe_query(queries, match_any=match_any) for note in notes]
+            assert got == expected
+            del parses[:]
+        assert any(results[True]) and not all(results[False])
+
+        # Per-expression assignments are visible to later ones as before
+        query = NoteQuery("y = 1\nTrue", "y == 1", match_any=False)
+        assert all(query(note) for note in notes)
+
+        # Pickles by the expressions (for --jobs workers)
+        query = pickle.loads(pickle.dumps(NoteQuery(queries[0])))
+        assert [query(note) for note in notes] == [n.safe_query(queries[0]) for n in notes]
+    finally:
+        ast.parse = real_parse
+
+    # Compile errors are raised, or warned about, for each note
+    query = NoteQuery("t('t0') and", allow_exception=True)
+    with CaptureDebug() as de:
+        assert not any(query(note) for note in notes)
+    assert de.stderr.count("Query Error") == len(notes)
+    with pytest.raises(QueryError):
+        NoteQuery("lambda: 1")(notes[0])
+    assert NoteQuery("True or (lambda: 1)")(notes[0])
+
+    os.chdir(TESTDIR)
+
+
+def test_grep_matcher_cache():
+    """
+    Test that grep expressions are compiled once and not per note
+    """
+    from notefile.search import GrepMatcher, SearchFilter, _grep_matcher
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "grep-matcher-cache"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    notes = []
+    for i in range(10):
+        writefile(f"file{i}.txt", f"{i}")
+        note = Notefile(f"file{i}.txt")
+        note.add_note(f"Line {i}\n{'odd.one' if i % 2 else 'even'} word{i}")
+        note.write()
+        notes.append(Notefile(f"file{i}.txt").read())
+
+    _grep_matcher.cache_clear()
+    for opts in [
+        {},
+        dict(matchcase=True),
+        dict(full_word=True),
+        dict(fixed_strings=True),
+        dict(match_any=False),
+    ]:
+        for expr in [["odd.one"], ["line"], ["Line", "WORD3"], ["odd", "word1"], ["d.o", "ven"]]:
+            got = [note.grep(expr, **opts) for note in notes]
+            matcher = GrepMatcher(expr, **opts)
+            assert got == [note.grep(matcher=matcher) for note in notes], (expr, opts)
+    info = _grep_matcher.cache_info()
+    assert info.misses == 25 and info.hits == 25 * 9
+
+    # Queries reuse them too
+    query = notefile.notefile.NoteQuery("g('odd') and not gall('even', 'odd')")
+    assert sum(query(note) for note in notes) == 5
+    info = _grep_matcher.cache_info()
+    assert info.misses == 27 and info.hits == 25 * 9 + 9 + 4  # gall() only if g()
+
+    # A filter compiles once for all notes, and later filters reuse it
+    filt = SearchFilter(grep=["word[13]"])
+    assert sum(filt(note) for note in notes) == 2
+    assert _grep_matcher.cache_info().misses == 28
+    assert SearchFilter(grep=["word[13]"]).grepmatcher is filt.grepmatcher
+    assert _grep_matcher.cache_info().misses == 28
+    assert pickle.loads(pickle.dumps(filt.grepmatcher))("word3")
+
+    os.chdir(TESTDIR)
+
+
+def test_grep_aho_corasick():
+    """
+    Test that many fixed strings match as with the regexes, and --patterns-file
+    """
+    import random
+
+    from notefile.ahocorasick import AhoCorasick
+    from notefile.search import AHO_CORASICK_MIN, GrepMatcher
+
+    ac = AhoCorasick(["he", "she", "his", "hers", "he"])
+    assert sorted(ac.finditer("ushers")) == [(4, 0), (4, 1), (4, 4), (6, 3)]
+    assert ac.search("xhisx") and not ac.search("hx")
+
+    rng = random.Random(0)
+    alphabet = "abAB_ .-\u00e9\u212a"  # e-acute and the Kelvin sign
+    for _ in range(300):
+        nwords = rng.randint(AHO_CORASICK_MIN, 4 * AHO_CORASICK_MIN)
+        words = ["".join(rng.choices("abAB_.", k=rng.randint(1, 3))) for _ in range(nwords)]
+        texts = ["".join(rng.choices(alphabet, k=rng.randint(0, 30))) for _ in range(5)]
+        texts.append(rng.choice(words) + " " + rng.choice(words))
+        for opts in itertools.product([True, False], repeat=3):
+            matchcase, full_word, match_any = opts
+            matcher = GrepMatcher(
+                words,
+                fixed_strings=True,
+                matchcase=matchcase,
+                full_word=full_word,
+                match_any=match_any,
+            )
+            assert (matcher.automaton is not None) == (len(set(words)) >= AHO_CORASICK_MIN)
+            for text in texts:
+                if match_any:
+                    expected = bool(matcher.regexes[0].search(text))
+                else:
+                    expected = all(r.search(text) for r in matcher.regexes)
+                assert matcher(text) == expected, (words, text, opts)
+
+    assert GrepMatcher(["a"] * 20, fixed_strings=True).automaton is None  # one word
+    assert GrepMatcher(list("abcdefgh") + [""], fixed_strings=True).automaton is None
+    assert GrepMatcher(list("abcdefgh") + ["\u00e9"], fixed_strings=True).automaton is None
+    assert GrepMatcher(list("abcdefgh") + ["\u00e9"], fixed_strings=True, matchcase=True).automaton
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "grep-aho-corasick"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(20):
+        writefile(f"file{i:02d}.txt", f"{i}")
+        call(f"mod file{i:02d}.txt -n 'word{i} (x{i % 4}) [y{i % 5}]'")
+
+    keywords = [f"(x{i})" for i in range(1, 4)] + [f"[y{i}]" for i in range(1, 10)]
+    with open("keywords.txt", "wt") as fobj:
+        fobj.write("\n".join(keywords[:6]) + "\n\n" + "\n".join(keywords[6:]) + "\n")
+
+    out, _ = call("grep --fixed-strings --patterns-file keywords.txt", capture=True)
+    assert sorted(out.split()) == [f"file{i:02d}.txt" for i in range(20) if i % 4 or i % 5]
+    regex = " ".join(f"--grep {shlex.quote(re.escape(k))}" for k in keywords)
+    assert call(f"search {regex}", capture=True)[0] == out
+
+    with open("both.txt", "wt") as fobj:
+        fobj.write("(x1)\n[y1]\n")
+    cmd = "grep --fixed-strings --patterns-file both.txt --patterns-file keywords.txt --all"
+    out, _ = call(cmd, capture=True)
+    assert out == ""
+    out, _ = call("grep --fixed-strings --patterns-file both.txt --all word", capture=True)
+    assert out.split() == ["file01.txt"]
+
+    os.chdir(TESTDIR)
+
+
+def test_json_without_yaml():
+    """
+    Test that JSON notes never import the YAML libraries and nfjson parity
+    """
+    import subprocess
+
+    from notefile import nfjson
+
+    for txt in [
+        '{"a": [1, 2.5, "\\u00e9", null]}',
+        '{"a": NaN}',
+        '{"big": 123456789012345678901234}',
+    ]:
+        assert repr(nfjson.loads(txt)) == repr(json.loads(txt))
+    with pytest.raises(nfjson.JSONDecodeError):
+        nfjson.loads("# YAML\na: 1")
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "json-without-yaml"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+    writefile("file.txt", "file")
+
+    code = """
+import sys
+import notefile
+import notefile.cli
+
+notefile.cli.cli(["mod", "file.txt", "-t", "tag", "-n", "multi\\nline"])
+notefile.cli.cli(["search", "--tag", "tag"])
+note = notefile.Notefile("file.txt").read()
+assert note.format == "json" and note.data.notes.startswith("multi\\nline"), note.data
+print(sorted(m for m in sys.modules if "yaml" in m and m != "notefile.nfyaml"))
+"""
+    env = dict(
+        os.environ, NOTEFILE_FORMAT="json", PYTHONPATH=str(Path(notefile.__file__).parents[1])
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    )
+    assert res.stdout.splitlines() == ["file.txt"] * 2 + ["[]"], (
+        res.stdout + res.stderr
+    )  # mod, search
+    assert Path("file.txt.notes.yaml").read_text().startswith("{")
+
+    # A YAML note loads them when it is encountered
+    writefile("other.txt", "other")
+    call("mod other.txt -t tag --format yaml")
+    res = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    )
+    assert "yaml" in res.stdout.splitlines()[-1]
+
+    os.chdir(TESTDIR)
+
+
+def test_startup_imports():
+    """
+    Test that the CLI starts without the heavy modules and within the import-time
+    budget (`python -X importtime`). Set $NOTEFILE_IMPORT_BUDGET_MS to change it
+    """
+    import subprocess
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "startup"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+    writefile("file.txt", "file")
+
+    env = dict(os.environ, PYTHONPATH=str(Path(notefile.__file__).parents[1]))
+    heavy = {"notefile.notefile", "notefile.search", "notefile.safe_eval", "ast", "orjson"}
+    heavy |= {"yaml", "ruamel.yaml", "ruamel_yaml", "multiprocessing", "sqlite3"}
+
+    def importtime(*args):
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times = {}  # module: cumulative microseconds
+        for line in res.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+                _, cumulative, name = line.split("|")
+                times[name.strip()] = int(cumulative)
+        return res.stdout, times
+
+    # Budgets are generous since this is a timing test. Best of a few runs
+    budget = float(os.environ.get("NOTEFILE_IMPORT_BUDGET_MS", 100)) * 1000
+    best = float("inf")
+    for _ in range(3):
+        _, times = importtime("-c", "import notefile.cli")
+        assert not heavy & set(times), heavy & set(times)
+        best = min(best, times["notefile.cli"])
+    assert best < budget, f"notefile.cli import took {best / 1000:.1f} ms"
+
+    # A quick command loads the note machinery but not YAML, queries, or search
+    out, times = importtime("-m", "notefile", "note-path", "--candidate", "file.txt")
+    assert out.strip() == "file.txt.notes.yaml"
+    assert "notefile.notefile" in times
+    assert not (heavy - {"notefile.notefile"}) & set(times)
+
+    # Only the requested subparser is built, but help and errors see all of them
+    parser = notefile.cli.build_parser(command="note-path")
+    choices = parser._subparsers._group_actions[0].choices
+    assert list(choices) == ["note-path"]
+    for command in [None, "notacommand"]:
+        parser = notefile.cli.build_parser(command=command)
+        assert {"mod", "note-path", "query"} <= set(parser._subparsers._group_actions[0].choices)
+    assert notefile.cli._command_name(["--note-fi", "cat", "--debug", "note-path"]) == "note-path"
+    assert notefile.cli._command_name(["--", "cat"]) is None
+
+    os.chdir(TESTDIR)
+
+
+def test_daemon():
+    """
+    Test `notefile serve`, forwarding from the command line, and kept listings
+    """
+    import subprocess
+    import time
+
+    from notefile import daemon
+    from notefile.utils import LRU
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "daemon"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+    writefile("file.txt", "file")
+
+    sockpath = str(dirpath / "nf.sock")
+    env = dict(os.environ, PYTHONPATH=str(Path(notefile.__file__).parents[1]))
+    env["NOTEFILE_SOCKET"] = sockpath
+
+    def run(*args, **kw):
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "notefile", *args],
+            env=dict(env, **kw),
+            capture_output=True,
+            text=True,
+        )
+
+    def local(res):
+        return "notefile.notefile" in res.stderr
+
+    assert daemon.forwardable(["cat", "file.txt"])
+    assert daemon.forwardable(["--debug", "mod", "-t", "tag", "file.txt"])
+    assert not daemon.forwardable(["edit", "file.txt"])
+    assert not daemon.forwardable(["mod", "-rs", "tag", "file.txt"])
+    assert not daemon.forwardable(["mod", "--std", "file.txt"])
+    assert not daemon.forwardable(["query", "-"])
+    assert not daemon.forwardable(["repair"])
+
+    assert local(run("note-path", "--candidate", "file.txt"))  # No server
+
+    # Only a stale socket is removed, never a file at the socket path
+    with pytest.raises(ValueError, match="not a socket"):
+        daemon.serve("file.txt")
+    assert os.path.exists("file.txt")
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "notefile", "serve", "--socket", sockpath],
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert server.stdout.readline().strip() == f"serving on {sockpath}"
+        assert daemon.running(sockpath)
+
+        res = run("mod", "file.txt", "-t", "tag1", "-n", "served note")
+        assert res.returncode == 0 and res.stdout == "file.txt\n" and not local(res)
+        res = run("cat", "file.txt")
+        assert res.stdout == "served note\n" and not local(res)
+
+        # Parsed notes are kept by text so changes from elsewhere are seen
+        call("mod file.txt -t tag2")
+        res = run("cat", "-t", "file.txt")
+        assert "tag2" in res.stdout and not local(res)
+        res = run("tags")
+        assert res.stdout == "tag1:\n- file.txt\ntag2:\n- file.txt\n" and not local(res)
+        res = run("grep", "served")
+        assert res.stdout == "file.txt\n" and not local(res)
+
+        # Exit codes and errors
+        res = run("note-path", "nothere.txt")
+        assert res.returncode == 1 and res.stdout == "" and not local(res)
+        res = run("cat", "nothere.txt")
+        assert res.returncode == 1 and "ERROR" in res.stderr and not local(res)
+
+        # Run here when not forwardable, opted out, or the environment differs
+        res = run("mod", "file.txt", "-t", "tag3", "--stdin")
+        assert res.returncode == 0 and local(res)
+        assert local(run("cat", "file.txt", NOTEFILE_DAEMON="false"))
+        res = run("cat", "file.txt", NOTEFILE_FORMAT="json")
+        assert res.stdout == "served note\n" and local(res)
+
+        reply = daemon.request(["note-path", "file.txt"], sockpath)
+        assert reply["returncode"] == 0 and reply["stdout"] == "file.txt.notes.yaml\n"
+
+        with pytest.raises(ValueError):
+            daemon.serve(sockpath)
+    finally:
+        assert daemon.stop(sockpath)
+        assert server.wait(10) == 0
+    assert not os.path.exists(sockpath)
+    assert not daemon.stop(sockpath)
+
+    # Kept listings are reused until the directory changes
+    find = sys.modules["notefile.find"]
+    try:
+        find.LISTINGS = LRU(10)
+        os.makedirs("listed")
+        writefile("listed/a.txt", "a")
+        os.utime("listed", (time.time() - 10,) * 2)
+        listing = find._scandir("listed")
+        assert find._scandir("listed") is listing
+        writefile("listed/b.txt", "b")
+        assert find._scandir("listed") is not listing  # Recent so not kept
+        os.utime("listed", (time.time() - 5,) * 2)
+        assert set(find._scandir("listed")[0]) == {"a.txt", "b.txt"}
+
+        os.symlink("a.txt", "listed/link.txt")
+        os.utime("listed", (time.time() - 5,) * 2)
+        assert find._scandir("listed") is not find._scandir("listed")
+    finally:
+        find.LISTINGS = None
+
+    os.chdir(TESTDIR)
+
+
+def test_snapshots():
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "snapshots"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    find = sys.modules["notefile.find"]
+    scandir_fresh = find._scandir_fresh
+    listed = []
+
+    def counting(path):
+        listed.append(os.path.normpath(path))
+        return scandir_fresh(path)
+
+    def age(*paths):
+        for path in paths:
+            os.utime(path, (time.time() - 10,) * 2)
+
+    def recorded():
+        rows = notefile.snapshots.store().conn.execute("SELECT path FROM dirs")
+        return [row[0] for row in rows]
+
+    def found(*args, command="find"):
+        del listed[:]
+        o, _ = call(f"--snapshots {command} {' '.join(args)}", capture=True)
+        return o.split()
+
+    dbpath = TESTDIR / "snapshots.sqlite3"  # Not in the searched directory
+    for suffix in ["", "-wal", "-shm"]:
+        Path(f"{dbpath}{suffix}").unlink(missing_ok=True)
+    env0 = os.environ.get("NOTEFILE_SNAPSHOT_DB")
+    os.environ["NOTEFILE_SNAPSHOT_DB"] = str(dbpath)
+    try:
+        find._scandir_fresh = counting
+        writefile("file1.txt", "file1")
+        writefile("other.txt", "other")
+        writefile("sub/file2.txt", "file2")
+        writefile("sub/deep/file3.txt", "file3")
+        os.makedirs("sub/dir")
+        call("mod file1.txt -t one")
+        call("mod sub/file2.txt -t two -H")
+        call("mod sub/deep/file3.txt -t three --subdir")
+        call("mod sub/dir -t dir")
+        expected = ["file1.txt", "sub/dir/", "sub/file2.txt", "sub/deep/file3.txt"]
+        assert found() == expected
+        assert not recorded()  # Recent so not recorded
+
+        age(".", "sub", "sub/deep", "sub/deep/_notefiles", "sub/dir")
+        assert found() == expected
+        assert sorted(listed) == [".", "sub", "sub/deep", "sub/dir"]
+        assert found() == expected
+        assert not listed  # All replayed
+        assert found("-p", "sub") == expected[1:]
+        assert not listed
+        assert found("--type", "file", "--tag", "one", command="search") == ["file1.txt"]
+        assert not listed
+
+        # Changed directories are listed again but not their (unchanged) subdirs
+        writefile("sub/file4.txt", "file4")
+        call("mod sub/file4.txt -t four")
+        age("sub")
+        expected = expected[:3] + ["sub/file4.txt"] + expected[3:]
+        assert found() == expected
+        assert listed == ["sub"]
+
+        # As are note subdirectories
+        call("mod sub/deep/file3.txt -t more")
+        os.rename("sub/deep/_notefiles/file3.txt.notes.yaml", "sub/deep/_notefiles/tmp")
+        os.rename("sub/deep/_notefiles/tmp", "sub/deep/_notefiles/file3.txt.notes.yaml")
+        age("sub/deep/_notefiles")
+        assert found() == expected
+        assert listed == ["sub/deep"]
+        assert found("--tag", "more", command="search") == ["sub/deep/file3.txt"]  # Notes are read
+
+        # Orphans are from the replayed listing
+        os.unlink("other.txt")  # Not a target
+        os.unlink("file1.txt")
+        age(".")
+        assert found() == expected[1:]
+        assert found("--orphaned") == ["file1.txt"]
+        assert not listed
+
+        # Removed directories are forgotten
+        shutil.rmtree("sub/deep")
+        age("sub")
+        assert found() == expected[1:4]
+        assert len(recorded()) == 3 and not any("deep" in path for path in recorded())
+
+        # Replaced with a symlink to a dir without changing the listing's names
+        os.rename("sub/dir", "dir2")
+        os.symlink("../dir2", "sub/dir")
+        age(".", "sub")
+        assert found() == expected[1:4]
+        assert sorted(listed) == [".", "dir2", "sub"]
+        assert found() == expected[1:4]
+        assert not listed
+
+        # Replayed entries probe through notefile.fs like live ones
+        def probes(*args):
+            _, e = call(f"{' '.join(args)} find --profile", capture=True)
+            rows = (line.split() for line in e.splitlines()[2:])
+            return {row[0]: int(row[1]) for row in rows if row[0].startswith("fs.")}
+
+        # Replays stat each recorded directory rather than listing it and the
+        # symlinked directory is probed (and counted) either way
+        replayed = probes("--snapshots")
+        assert not listed
+        assert replayed == {"fs.stat": 5, "fs.lstat": 1, "fs.cached": 2}
+        assert probes("--no-snapshots") == {"fs.scandir": 3, "fs.stat": 2, "fs.lstat": 1}
+
+        assert found("--no-snapshots") == expected[1:4]
+        assert "." in listed
+
+        call("cache clear")
+        assert not dbpath.exists()
+    finally:
+        find._scandir_fresh = scandir_fresh
+        notefile.snapshots.configure(enabled=False)
+        if env0 is None:
+            os.environ.pop("NOTEFILE_SNAPSHOT_DB", None)
+        else:
+            os.environ["NOTEFILE_SNAPSHOT_DB"] = env0
+
+    os.chdir(TESTDIR)
+
+
+@pytest.mark.parametrize("poll", (None, 0.01))
+def test_watch(poll):
+    """
+    Test that the watcher keeps the cache current and flags notes (inotify and polling)
+    """
+    from notefile.cache import configure, writer
+    from notefile.watch import NoteWatcher
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / f"watch-{bool(poll)}"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    writefile("file.txt", "file")
+    writefile("other.txt", "other")
+    os.makedirs("sub")
+    writefile("sub/subfile.txt", "subfile")
+    call("mod file.txt -t tag1")
+    call("mod -H sub/subfile.txt -t subtag")
+
+    def cached():
+        return sorted(os.path.relpath(r["canonical_note_path"]) for r in writer().iter_records("."))
+
+    def step():
+        # CLI calls reset the cache configuration
+        configure(enabled=True, dbpath=str(dirpath / "cache.sqlite3"))
+        # Changes have been made so their events are ready in one step. Check
+        # that there are no more
+        results = watcher.step(timeout=1)
+        assert watcher.step(timeout=0.05) == []
+        return results
+
+    try:
+        watcher = NoteWatcher(".", excludes=["*.skip"], poll=poll)
+        assert step() == []
+        assert cached() == []  # Only changes are indexed
+
+        call("mod file.txt -t tag2")
+        call("mod other.txt -t tag3")
+        writefile("excluded.skip", "skip")
+        call("mod excluded.skip -t tag4")
+        assert sorted(step()) == [
+            ("updated", "file.txt.notes.yaml"),
+            ("updated", "other.txt.notes.yaml"),
+        ]
+        assert cached() == ["file.txt.notes.yaml", "other.txt.notes.yaml"]
+        assert Notefile("file.txt").read().data.tags == ["tag1", "tag2"]  # not trusted reads
+
+        # Target changes
+        with open("file.txt", "at") as fp:
+            fp.write("more")
+        assert step() == [("changed", "file.txt.notes.yaml")]
+        os.utime("file.txt")
+        assert step() == []  # Already flagged
+        os.unlink("other.txt")
+        assert step() == [("orphaned", "other.txt.notes.yaml")]
+        call("repair-metadata file.txt")
+        assert step() == [("updated", "file.txt.notes.yaml")]  # Flag cleared
+
+        # Notes, including in new and moved directories
+        os.unlink("other.txt.notes.yaml")
+        assert step() == [("removed", "other.txt.notes.yaml")]
+        os.makedirs("new/deeper")
+        writefile("new/deeper/deep.txt", "deep")
+        call("mod new/deeper/deep.txt -t deep")
+        assert ("updated", "new/deeper/deep.txt.notes.yaml") in step()
+        os.rename("sub", "moved")
+        assert set(step()) == {
+            ("removed", "sub/.subfile.txt.notes.yaml"),
+            ("updated", "moved/.subfile.txt.notes.yaml"),
+        }
+        assert cached() == [
+            "file.txt.notes.yaml",
+            "moved/.subfile.txt.notes.yaml",
+            "new/deeper/deep.txt.notes.yaml",
+        ]
+        watcher.close()
+    finally:
+        configure(enabled=False)
+
+    os.chdir(TESTDIR)
+
+
+def test_profile():
+    """--profile reports per-stage times and counts, including from --jobs workers"""
+    import pstats
+
+    from notefile import profiling
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "profile"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(6):
+        writefile(f"file{i}.txt", f"file {i}")
+        call(f"mod -t tag{i % 2} -n 'word {i}' {'--format json' if i % 3 else ''} file{i}.txt")
+
+    def stages(stderr):
+        lines = stderr.splitlines()
+        start = lines.index(next(line for line in lines if line.startswith("PROFILE: ")))
+        return {line.split()[0]: int(line.split()[1]) for line in lines[start + 2 :]}
+
+    o, e = call("grep --profile word", capture=True)
+    assert len(o.split()) == 6
+    assert e.startswith("PROFILE: grep ")
+    got = stages(e)
+    assert got["note.read"] == got["grep"] == 6
+    assert got["parse.yaml"] == 2 and got["parse.json"] == 4
+    assert got["walk.list"] >= 1
+
+    o, e = call("query --profile --jobs 2 \"t('tag0')\"", capture=True)
+    assert len(o.split()) == 3
+    got = stages(e)
+    assert got["prefilter"] == 6 and got["query"] == 3  # From the workers
+    assert "serialize" not in got
+
+    o, e = call("mod --profile -t new file0.txt", capture=True)
+    got = stages(e)
+    assert got["note.write"] == got["write.io"] == got["serialize"] == 1
+
+    # Off unless asked for and reset every call
+    o, e = call("grep word", capture=True)
+    assert "PROFILE" not in e
+    assert not profiling.ENABLED and not profiling.stats()
+    with profiling.stage("anything"):
+        profiling.count("anything")
+    assert not profiling.stats()
+
+    dump = dirpath / "prof.out"
+    o, e = call(f"tags --profile-dump {dump}", capture=True)
+    assert "PROFILE: tags" in e
+    assert pstats.Stats(str(dump)).total_calls > 0
+
+    os.chdir(TESTDIR)
+
+
+def test_fs_probes():
+    """Probes go through notefile.fs, are counted, and are not repeated needlessly"""
+    from notefile import fs, profiling
+    from notefile.notefile import Notefile, directory_info
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "fs_probes"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    writefile("file.txt", "file")
+    writefile("dir/sub/a.txt", "a")
+    writefile("dir/b.txt", "b")
+    writefile("dir/b.txt.notes.yaml", "{}")
+    os.symlink("sub", "dir/linked")
+    os.symlink("nothere.txt", "broken.txt")
+    call("mod -t tag file.txt")
+
+    assert fs.exists("file.txt") and fs.lexists("file.txt")
+    assert not fs.exists("broken.txt") and fs.lexists("broken.txt") and fs.islink("broken.txt")
+    assert not fs.lexists("nothere.txt") and not fs.islink("nothere.txt")
+    assert fs.isdir("dir") and not fs.isfile("dir") and fs.isfile("file.txt")
+    assert not fs.isdir("file.txt/x")  # NotADirectoryError is not raised
+
+    info = directory_info("dir")
+    assert (info["dir-subdirs"], info["dir-files"]) == (2, 1)  # The link to a dir counts
+
+    def probes(func):
+        profiling.configure(enabled=True)
+        try:
+            func()
+            return {k: v[0] for k, v in profiling.stats().items() if k.startswith("fs.")}
+        finally:
+            profiling.configure(enabled=False)
+
+    # Each of the four note locations is one lstat, then the link test and target stat
+    got = probes(lambda: Notefile("file.txt"))
+    assert got == {"fs.lstat": 5, "fs.stat": 1}, got
+    got = probes(lambda: Notefile("file.txt").read())
+    assert got == {"fs.lstat": 5, "fs.stat": 2}, got
+
+    # Notes from a listing are not probed until read. One stat is of the search path
+    got = probes(lambda: [n.read() for n in notefile.find(path=str(dirpath))])
+    assert got == {"fs.scandir": 3, "fs.stat": 1 + 2}, got
+
+    os.chdir(TESTDIR)
+
+
+def test_stat_cache():
+    """The run-scoped stat cache probes paths once and sees notefile's own changes"""
+    from notefile import fs, profiling
+    from notefile.notefile import Notefile
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "stat_cache"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    for i in range(4):
+        writefile(f"file{i}.txt", f"file {i}")
+        call(f"mod -t tag file{i}.txt")
+    writefile("file0.txt", "changed")
+
+    o, e = call("repair --profile", capture=True)
+    counts = {line.split()[0]: int(line.split()[1]) for line in e.splitlines()[2:]}
+    assert counts["fs.cached"] > 0
+    assert counts["fs.stat"] <= 4 + 4 + 1  # Candidates, targets, and the path
+    assert fs._stats is None  # Only during the call
+
+    os.environ["NOTEFILE_STAT_CACHE"] = "false"
+    try:
+        o, e2 = call("repair --profile", capture=True)
+    finally:
+        del os.environ["NOTEFILE_STAT_CACHE"]
+    assert "fs.cached" in e and "fs.cached" not in e2
+
+    fs.configure(cache=True)
+    profiling.configure(enabled=True)
+    try:
+        with pytest.raises(FileNotFoundError):
+            fs.stat("new.txt")
+        writefile("new.txt", "new")
+        assert not fs.exists("new.txt")  # Cached as missing
+        fs.invalidate("new.txt")
+        assert fs.exists("new.txt") and fs.exists(str(dirpath / "new.txt"))  # Same key
+        assert fs.lexists("file1.txt") and fs.isfile("file1.txt")  # lstat answers stat
+        assert profiling.stats()["fs.stat"][0] == 2
+        assert profiling.stats()["fs.lstat"][0] == 1
+
+        # Writes, links, and moves invalidate
+        note = Notefile("new.txt")
+        assert not note.exists
+        note.modify_tags(add="new").write()
+        assert Notefile("new.txt").exists
+
+        os.symlink("new.txt", "link.txt")
+        Notefile("link.txt").modify_tags(add="link").write()
+        assert fs.islink("link.txt.notes.yaml")
+        assert Notefile("link.txt").read().data.tags == ["link", "new"]
+
+        Notefile("file1.txt").change_visibility_subdir(mode="hide")
+        note = Notefile("file1.txt")
+        assert note.exists and note.is_hidden
+        assert note.read().data.tags == ["tag"]
+
+        assert fs.stat("file2.txt", cached=False).st_size == 6
+
+        # Probes can skip the cache and symlinks made by notefile invalidate it
+        assert not fs.exists("later.txt")
+        writefile("later.txt", "later")
+        assert not fs.exists("later.txt") and fs.exists("later.txt", cached=False)
+        assert fs.isfile("later.txt", cached=False) and not fs.islink("later.txt", cached=False)
+        notefile.utils.symlink_file("later.txt", "links")
+        notefile.utils.symlink_file("later.txt", "links")
+        assert sorted(os.listdir("links")) == ["later.1.txt", "later.txt"]
+    finally:
+        profiling.configure(enabled=False)
+        fs.configure(cache=False)
+
+    os.chdir(TESTDIR)
+
+
+def test_readonly():
+    """Read-only notes skip the change-tracking copy; others still see nested changes"""
+    from notefile.notefile import Notefile, _snapshot
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "readonly"
+    cleanmkdir(dirpath)
+    os.chdir(dirpath)
+
+    writefile("file.txt", "file")
+    call("mod -t one -t two file.txt")
+    call("mod -n text file.txt")
+    note = Notefile("file.txt").read()
+    note.data.other = {"a": [1, {"b": 2}]}
+    note.write()
+
+    data = {"a": [1, {"b": "x" * 100}], "c": None}
+    snap = _snapshot(data)
+    assert snap == data and snap["a"][1] is not data["a"][1]
+    assert snap["a"][1]["b"] is data["a"][1]["b"]  # Shared, not copied
+
+    note = Notefile("file.txt", readonly=True).read()
+    assert note._data0 is None and note.data.tags == ["one", "two"]
+    with pytest.raises(ValueError):
+        note.ismod()
+    with pytest.raises(ValueError):
+        note.write()
+
+    # Nested (in-place) changes are still detected
+    note = Notefile("file.txt").read()
+    assert not note.ismod()
+    note.data.tags.append("three")
+    assert note.ismod()
+
+    note = Notefile("file.txt").read()
+    note.data.other["a"][1]["b"] = 3
+    assert note.ismod()
+
+    o, _ = call("search --tag two", capture=True)
+    assert o.strip() == "file.txt"
+    o, _ = call("export", capture=True)
+    assert "text" in o
+
+    os.chdir(TESTDIR)
+
+
+def test_benchmarks():
+    """The benchmark suite runs and its synthesized tree is what it claims"""
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location(
+        "bench", Path(notefile.__file__).parents[1] / "benchmarks" / "bench.py"
+    )
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+
+    os.chdir(TESTDIR)
+    dirpath = TESTDIR / "benchmarks"
+    cleanmkdir(dirpath)
+    outpath = str(TESTDIR / "benchmarks.json")
+
+    argv = ["--notes", "250", "--repeat", "2", "--dir", str(dirpath), "--output", outpath]
+    report = bench.main(argv)
+    made = report["made"]
+    assert made == {"notes": 250, "dirs": 2, "links": 1}
+    with open(outpath) as fobj:
+        assert json.load(fobj)["results"].keys() == set(bench.Benchmarks.NAMES)
+
+    results = report["results"]
+    assert results["find"]["count"] == made["notes"] + made["dirs"] + made["links"]
+    assert results["read"]["count"] == results["find"]["count"]
+    assert all(len(res["times"]) == 2 for res in results.values())
+
+    # The generated notes read the same as written ones and the repairs leave nothing
+    assert not call(f"find --orphaned -p {dirpath}", capture=True)[0].strip()
+    for note in notefile.find(path=str(dirpath), targetmode="both"):
+        note.read()
+        assert not note.ismod()
+
+    # Reused
+    report = bench.main(argv[:-2] + ["--only", "find", "--repeat", "1"])
+    assert report["results"].keys() == {"find"}
+
+    os.chdir(TESTDIR)
+
+
 def test_pickle():
     os.chdir(TESTDIR)
     dirpath = TESTDIR / "pickle"